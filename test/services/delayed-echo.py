@@ -27,16 +27,24 @@ class EchoHandler(http.server.BaseHTTPRequestHandler):
         while now < finish:
             now = int(time.monotonic()*1000000000)
         
+        content = ("waited: %d\n" % (now - received)).encode('utf-8')
         self.send_response(200)
         self.send_header('Content-Type','text/plain; charset=UTF-8')
+        self.send_header('Content-Length',str(len(content)))
         self.end_headers()
 
-        content = "waited: %d\n" % (now - received)
-        self.wfile.write(content.encode('utf-8'))
+        self.wfile.write(content)
         self.wfile.flush()
 
 
 if __name__ == "__main__":
     HOST, PORT = "0.0.0.0", 3240
-    server = socketserver.TCPServer((HOST, PORT), EchoHandler)
+    # With --keep-alive, speak HTTP/1.1 so that connections persist between
+    # requests (sampler --keep-alive), handling each connection in a thread.
+    if '--keep-alive' in sys.argv[1:]:
+        EchoHandler.protocol_version = 'HTTP/1.1'
+        EchoHandler.disable_nagle_algorithm = True
+        server = socketserver.ThreadingTCPServer((HOST, PORT), EchoHandler)
+    else:
+        server = socketserver.TCPServer((HOST, PORT), EchoHandler)
     server.serve_forever()
@@ -12,6 +12,7 @@ import tempfile
 import json
 import gzip
 import statistics
+import threading
 
 try:
     import requests
@@ -21,6 +22,8 @@ except:
     sys.exit(1)
 
 from .stats import *
+from . import capture
+import numpy
 
 
 def getLocalIP(remote_host, remote_port):
@@ -47,31 +50,119 @@ def getIfaceForIP(ip):
                     return iface
 
 
+# Tuning passed to nanown-listen as capture_options:
+#   buffer_size  kernel capture buffer size in bytes
+#   immediate    deliver packets as soon as they arrive (lower latency, more CPU)
+#   timeout      capture timeout in milliseconds
+#   mmap         read from a TPACKET_V3 packet-mmap ring rather than libpcap
+def _captureArguments(capture_options):
+    ret_val = []
+    if capture_options.get('buffer_size'):
+        ret_val.extend(['-B', "%d" % capture_options['buffer_size']])
+    if capture_options.get('immediate'):
+        ret_val.append('-I')
+    if capture_options.get('timeout'):
+        ret_val.extend(['-t', "%d" % capture_options['timeout']])
+    if capture_options.get('mmap'):
+        ret_val.append('-m')
+    return ret_val
+
+
+def _listenCommand(my_iface, my_ip, target_ip, target_port, output_file, binary, ring=False,
+                   stats_file=None, capture_options=None):
+    options = []
+    if capture_options:
+        options.extend(_captureArguments(capture_options))
+    if stats_file:
+        options.extend(['-s', stats_file])
+    if ring:
+        options.append('-r')
+    elif binary:
+        options.append('-b')
+    return ['chrt', '-r', '99', 'nanown-listen'] + options + [my_iface, my_ip, target_ip,
+                                                              "%d" % target_port, output_file, '0']
+
+
+# With binary set, nanown-listen writes fixed-width records (see
+# nanownlib.capture) instead of JSON lines.  Read them with packetRecords()
+# rather than openPacketLog(), or incrementally with newPacketRecords().
+# With ring set (which implies binary), records are passed through a
+# shared-memory ring of ring_capacity records instead of a spool file, so
+# only newPacketRecords() is available and records not collected before the
+# ring fills are dropped (see ringDropped()).  captureStats() returns the
+# statistics nanown-listen reported for the current or last run.
+# capture_options tunes the capture itself (see _captureArguments).
 class snifferProcess(object):
     my_ip = None
     my_iface = None
     target_ip = None
     target_port = None
+    binary = False
+    ring = False
+    ring_capacity = None
+    capture_options = None
     _proc = None
     _spool = None
+    _stats = None
+    _ring = None
+    _consumed = 0
     
-    def __init__(self, target_ip, target_port):
+    def __init__(self, target_ip, target_port, binary=False, ring=False, ring_capacity=None,
+                 capture_options=None):
         self.target_ip = target_ip
         self.target_port = target_port
+        self.binary = binary or ring
+        self.ring = ring
+        self.ring_capacity = ring_capacity
+        self.capture_options = capture_options
         self.my_ip = getLocalIP(target_ip, target_port)
         self.my_iface = getIfaceForIP(self.my_ip)
         print(self.my_ip, self.my_iface)
 
     def start(self):
-        self._spool = tempfile.NamedTemporaryFile('w+t')
-        self._proc = subprocess.Popen(['chrt', '-r', '99', 'nanown-listen',
-                                       self.my_iface, self.my_ip,
-                                       self.target_ip, "%d" % self.target_port,
-                                       self._spool.name, '0'])
+        self._consumed = 0
+        self._stats = tempfile.NamedTemporaryFile('w+t')
+        if self.ring:
+            if self._ring:
+                self._ring.close()
+            self._ring = capture.packetRing(self.ring_capacity)
+            output_file = self._ring.path
+        else:
+            self._spool = tempfile.NamedTemporaryFile('w+b' if self.binary else 'w+t')
+            output_file = self._spool.name
+        self._proc = subprocess.Popen(_listenCommand(self.my_iface, self.my_ip,
+                                                     self.target_ip, self.target_port,
+                                                     output_file, self.binary, self.ring,
+                                                     self._stats.name, self.capture_options))
         time.sleep(0.25)
 
     def openPacketLog(self):
         return open(self._spool.name, 'rt')
+
+    def packetRecords(self):
+        return capture.readPacketLog(self._spool.name)
+
+    # Returns the binary records captured since the last call
+    def newPacketRecords(self):
+        if self.ring:
+            return self._ring.readNew()
+
+        records = self.packetRecords()
+        ret_val = numpy.array(records[self._consumed:])
+        self._consumed = len(records)
+        return ret_val
+
+    def captureStats(self):
+        if not self._stats:
+            return []
+        # a line still being written is left for the next call
+        with open(self._stats.name, 'rt') as fp:
+            return [json.loads(line) for line in fp if line.endswith('\n')]
+
+    def ringDropped(self):
+        if self._ring:
+            return self._ring.dropped()
+        return 0
         
     def stop(self):
         if self._proc:
@@ -87,13 +178,22 @@ class snifferProcess(object):
             
     def __del__(self):
         self.stop()
+        if self._ring:
+            self._ring.close()
 
             
-def startSniffer(target_ip, target_port, output_file):
+# output_file may be a capture.packetRing, in which case its path is used
+# and records are delivered through the ring.
+def startSniffer(target_ip, target_port, output_file, binary=False, stats_file=None,
+                 capture_options=None):
     my_ip = getLocalIP(target_ip, target_port)
     my_iface = getIfaceForIP(my_ip)
-    return subprocess.Popen(['chrt', '-r', '99', 'nanown-listen', my_iface, my_ip,
-                             target_ip, "%d" % target_port, output_file, '0'])
+    ring = isinstance(output_file, capture.packetRing)
+    if ring:
+        output_file = output_file.path
+    return subprocess.Popen(_listenCommand(my_iface, my_ip, target_ip, target_port,
+                                           output_file, binary, ring, stats_file,
+                                           capture_options))
 
 def stopSniffer(sniffer):
     sniffer.terminate()
@@ -103,17 +203,80 @@ def stopSniffer(sniffer):
         sniffer.wait(1)
 
 
+# Client-side timing of a probe connection, as time.perf_counter_ns
+# timestamps named after the probes table columns
+def clientTiming(connect_start=None, connect_end=None):
+    return {'client_connect_start':connect_start,
+            'client_connect_end':connect_end,
+            'client_first_write':None,
+            'client_first_read':None,
+            'client_last_read':None}
+
+
+# A socket that records clientTiming as data is written and read
+class timedSocket(socket.socket):
+    timing = None
+    
+    @classmethod
+    def wrap(cls, sock, connect_start, connect_end):
+        timeout = sock.gettimeout()
+        ret_val = cls(sock.family, sock.type, sock.proto, fileno=sock.detach())
+        ret_val.settimeout(timeout)
+        ret_val.timing = clientTiming(connect_start, connect_end)
+        return ret_val
+
+    def _written(self):
+        if self.timing['client_first_write'] == None:
+            self.timing['client_first_write'] = time.perf_counter_ns()
+
+    def _read(self, count):
+        if count > 0:
+            now = time.perf_counter_ns()
+            if self.timing['client_first_read'] == None:
+                self.timing['client_first_read'] = now
+            self.timing['client_last_read'] = now
+
+    def send(self, *args, **kwargs):
+        self._written()
+        return super(timedSocket, self).send(*args, **kwargs)
+
+    def sendall(self, *args, **kwargs):
+        self._written()
+        return super(timedSocket, self).sendall(*args, **kwargs)
+
+    def recv(self, *args, **kwargs):
+        ret_val = super(timedSocket, self).recv(*args, **kwargs)
+        self._read(len(ret_val))
+        return ret_val
+
+    def recv_into(self, *args, **kwargs):
+        ret_val = super(timedSocket, self).recv_into(*args, **kwargs)
+        self._read(ret_val)
+        return ret_val
+
+
 # Monkey patching that instruments the HTTPResponse to collect connection source port info
 class MonitoredHTTPResponse(http.client.HTTPResponse):
     local_address = None
+    timing = None
 
     def __init__(self, sock, *args, **kwargs):
         self.local_address = sock.getsockname()
+        self.timing = getattr(sock, 'timing', None)
         #print(self.local_address)
         super(MonitoredHTTPResponse, self).__init__(sock,*args,**kwargs)
             
 requests.packages.urllib3.connection.HTTPConnection.response_class = MonitoredHTTPResponse
 
+# ...and times each connection's socket
+_newHTTPConnection = requests.packages.urllib3.connection.HTTPConnection._new_conn
+def _newTimedHTTPConnection(self):
+    start = time.perf_counter_ns()
+    sock = _newHTTPConnection(self)
+    return timedSocket.wrap(sock, start, time.perf_counter_ns())
+
+requests.packages.urllib3.connection.HTTPConnection._new_conn = _newTimedHTTPConnection
+
 
 def removeDuplicatePackets(packets):
     #return packets
@@ -187,32 +350,280 @@ def analyzePackets(packets, timestamp_precision, trim_sent=0, trim_rcvd=0):
             'rcvd_trimmed':trim_rcvd},len(sent),len(rcvd)
 
 
+def _runStarts(*keys):
+    ret_val = numpy.zeros(len(keys[0]), dtype=bool)
+    if len(ret_val) > 0:
+        ret_val[0] = True
+        for k in keys:
+            ret_val[1:] |= k[1:] != k[:-1]
+    return ret_val
+
+
+def _groupedRunningMin(values, starts):
+    # Running minimum of values that restarts at each True in starts.  Values
+    # are replaced by their ranks and each group is lifted above all later
+    # ones so that a single accumulate never crosses a group boundary.
+    uniq,ranks = numpy.unique(values, return_inverse=True)
+    group = numpy.cumsum(starts)
+    lifted = ranks + (group[-1]-group)*len(uniq)
+    return numpy.minimum.accumulate(lifted),lifted
+
+
+# Columnar equivalent of removeDuplicatePackets plus the sorting done by
+# analyzePackets, for the packets of many probes at once.  columns maps
+# probe_id, sent, observed, tsval, payload_len, tcpseq and tcpack to
+# sequences, with each probe's packets stored contiguously.
+def preparePacketColumns(columns):
+    probe_id = numpy.empty(len(columns['probe_id']), dtype=object)
+    probe_id[:] = columns['probe_id']
+    cols = {k:numpy.asarray(columns[k], dtype=numpy.int64)
+            for k in ('sent','observed','tsval','payload_len','tcpseq','tcpack')}
+    n = len(probe_id)
+    starts = _runStarts(probe_id)
+    group = numpy.cumsum(starts)-1
+    probe_ids = probe_id[starts]
+    num_probes = len(probe_ids)
+
+    # Duplicates: same probe and (sent,tcpseq,tcpack,payload_len).  Within each
+    # duplicate set, in input order, every new strict minimum of observed
+    # replaces the packet kept so far and marks the probe suspect.
+    # The key fields are packed into two integers using the capture's field
+    # widths (sent:1, payload_len:16, tcpseq/tcpack:32 bits); lexsort is
+    # stable, so input order is preserved within each duplicate set.
+    position = numpy.arange(n)
+    probe_key = (group << 17) | (cols['sent'] << 16) | cols['payload_len']
+    seqack_key = (cols['tcpseq'].astype(numpy.uint64) << 32) | cols['tcpack'].astype(numpy.uint64)
+    order = numpy.lexsort((seqack_key, probe_key))
+    key_starts = _runStarts(probe_key[order], seqack_key[order])
+    dedup_suspect = ['']*num_probes
+    if n > 0:
+        running,lifted = _groupedRunningMin(cols['observed'][order], key_starts)
+        replaced = numpy.zeros(n, dtype=bool)
+        replaced[1:] = ~key_starts[1:] & (lifted[1:] < running[:-1])
+        key_index = numpy.flatnonzero(key_starts)
+        kept = numpy.maximum.reduceat(numpy.where(key_starts|replaced, position, -1), key_index)
+        keep = order[kept]
+        first = order[key_index]
+
+        for i in sorted(order[replaced].tolist()):
+            if cols['sent'][i] == 1:
+                dedup_suspect[group[i]] += 's'
+            elif cols['sent'][i] == 0:
+                dedup_suspect[group[i]] += 'r'
+    else:
+        keep = first = position
+
+    # Kept packets are stored in the order their duplicate set was first
+    # seen, like seen.values(), so the stable sorts below break ties the same
+    # way sorted() does.
+    seen_order = numpy.argsort(first, kind='stable')
+    keep = keep[seen_order]
+    kept_cols = {k:v[keep] for k,v in cols.items()}
+    kept_cols['group'] = group[keep]
+
+    k = kept_cols
+    has_payload = k['payload_len'] > 0
+    sent = numpy.flatnonzero(has_payload & (k['sent'] == 1))
+    sent = sent[numpy.lexsort((k['tcpseq'][sent], k['observed'][sent], k['group'][sent]))]
+    rcvd_all = numpy.flatnonzero(has_payload & (k['sent'] == 0))
+    rcvd = rcvd_all[numpy.lexsort((k['tcpseq'][rcvd_all], k['observed'][rcvd_all], k['group'][rcvd_all]))]
+    rcvd_alt = rcvd_all[numpy.lexsort((k['observed'][rcvd_all], k['tcpseq'][rcvd_all], k['group'][rcvd_all]))]
+    acks = numpy.flatnonzero(k['sent'] == 0)
+
+    num_sent = numpy.bincount(k['group'][sent], minlength=num_probes)
+    num_rcvd = numpy.bincount(k['group'][rcvd], minlength=num_probes)
+
+    return {'probe_ids':probe_ids,
+            'dedup_suspect':dedup_suspect,
+            'packets':kept_cols,
+            'sent':sent,
+            'rcvd':rcvd,
+            'rcvd_alt':rcvd_alt,
+            'acks':acks,
+            'num_sent':num_sent,
+            'num_rcvd':num_rcvd,
+            'sent_start':numpy.cumsum(num_sent)-num_sent,
+            'rcvd_start':numpy.cumsum(num_rcvd)-num_rcvd}
+
+
+# Runs analyzePackets over every probe in the output of
+# preparePacketColumns with grouped array operations.  Returns a dict of
+# per-probe arrays; probes analyzePackets would fail on have valid=False.
+def analyzePacketColumns(prepared, timestamp_precision, trim_sent=0, trim_rcvd=0):
+    k = prepared['packets']
+    num_sent = prepared['num_sent']
+    num_rcvd = prepared['num_rcvd']
+    num_probes = len(prepared['probe_ids'])
+
+    valid = (num_sent > 0) & (num_rcvd > 0)
+    sent_dropped = trim_sent >= num_sent
+    s_off = numpy.where(sent_dropped, num_sent-1, trim_sent)
+    r_off = num_rcvd - trim_rcvd - 1
+    rcvd_dropped = r_off < 0
+    r_off = numpy.where(rcvd_dropped, 0, r_off)
+
+    last_sent = numpy.zeros(num_probes, dtype=numpy.int64)
+    last_rcvd = numpy.zeros(num_probes, dtype=numpy.int64)
+    reordered = numpy.zeros(num_probes, dtype=bool)
+    last_sent[valid] = prepared['sent'][(prepared['sent_start']+s_off)[valid]]
+    last_rcvd[valid] = prepared['rcvd'][(prepared['rcvd_start']+r_off)[valid]]
+    reordered[valid] = last_rcvd[valid] != prepared['rcvd_alt'][(prepared['rcvd_start']+r_off)[valid]]
+
+    # last_sent_ack: the received packet with the smallest (tcpack,observed)
+    # acknowledging last_sent.  min() over tuples that tie on both ends up
+    # comparing dicts and raising, so a tie with the running minimum (in the
+    # order packets were first seen) also leaves it unset.
+    acks = prepared['acks']
+    ack_group = k['group'][acks]
+    acks = acks[valid[ack_group]]
+    ack_group = k['group'][acks]
+    acks = acks[k['payload_len'][acks]+k['tcpseq'][last_sent[ack_group]] >= k['tcpack'][acks]]
+    ack_group = k['group'][acks]
+    last_sent_ack = numpy.full(num_probes, -1, dtype=numpy.int64)
+    if len(acks) > 0:
+        by_key = numpy.lexsort((k['observed'][acks], k['tcpack'][acks]))
+        key_rank = numpy.empty(len(acks), dtype=numpy.int64)
+        key_rank[by_key] = numpy.cumsum(_runStarts(k['tcpack'][acks][by_key], k['observed'][acks][by_key]))
+        ack_starts = _runStarts(ack_group)
+        running,lifted = _groupedRunningMin(key_rank, ack_starts)
+        tied = numpy.zeros(len(acks), dtype=bool)
+        tied[1:] = ~ack_starts[1:] & (lifted[1:] == running[:-1])
+        ack_index = numpy.flatnonzero(ack_starts)
+        # The running minimum ends at the group's minimum; locate its packet
+        group_min = running[numpy.append(ack_index[1:], len(acks))-1]
+        is_best = lifted == numpy.repeat(group_min, numpy.diff(numpy.append(ack_index, len(acks))))
+        best_pos = numpy.maximum.reduceat(numpy.where(is_best, numpy.arange(len(acks)), -1), ack_index)
+        has_tie = numpy.logical_or.reduceat(tied, ack_index)
+        groups = ack_group[ack_index]
+        last_sent_ack[groups] = numpy.where(has_tie, -1, acks[best_pos])
+
+    packet_rtt = k['observed'][last_rcvd] - k['observed'][last_sent]
+    has_tsval = (last_sent_ack >= 0) & (timestamp_precision != None)
+    tsval_rtt = numpy.zeros(num_probes, dtype=numpy.int64)
+    if timestamp_precision != None:
+        tsval_diff = (k['tsval'][last_rcvd] - k['tsval'][numpy.maximum(last_sent_ack, 0)]).astype(numpy.float64)
+        tsval_rtt[has_tsval] = numpy.rint(tsval_diff*timestamp_precision)[has_tsval]
+    negative = (packet_rtt < 0) | (has_tsval & (tsval_rtt < 0))
+
+    missing_acks = int(numpy.count_nonzero(valid & (last_sent_ack < 0)))
+    if missing_acks > 0:
+        sys.stderr.write("WARN: Could not find last_sent_ack for %d probes.\n" % missing_acks)
+
+    suspect = []
+    for i,s in enumerate(prepared['dedup_suspect']):
+        suspect.append(s + 'd'*int(sent_dropped[i]) + 'd'*int(rcvd_dropped[i])
+                       + 'R'*int(reordered[i]) + 'N'*int(negative[i]))
+
+    return {'probe_ids':prepared['probe_ids'],
+            'valid':valid,
+            'packet_rtt':packet_rtt,
+            'tsval_rtt':tsval_rtt,
+            'has_tsval':has_tsval,
+            'suspect':suspect,
+            'num_sent':num_sent,
+            'num_rcvd':num_rcvd,
+            'sent_trimmed':trim_sent,
+            'rcvd_trimmed':trim_rcvd}
+
+
+def packetAnalysisRows(analyzed):
+    ret_val = []
+    for i in numpy.flatnonzero(analyzed['valid']).tolist():
+        tsval_rtt = None
+        if analyzed['has_tsval'][i]:
+            tsval_rtt = int(analyzed['tsval_rtt'][i])
+        ret_val.append({'probe_id':analyzed['probe_ids'][i],
+                        'packet_rtt':int(analyzed['packet_rtt'][i]),
+                        'tsval_rtt':tsval_rtt,
+                        'suspect':analyzed['suspect'][i],
+                        'sent_trimmed':analyzed['sent_trimmed'],
+                        'rcvd_trimmed':analyzed['rcvd_trimmed']})
+    return ret_val
+
+
 # septasummary and mad for each dist of differences
-def evaluateTrim(db, unusual_case, strim, rtrim):
-    cursor = db.conn.cursor()
-    query="""
-      SELECT packet_rtt-(SELECT avg(packet_rtt) FROM probes,trim_analysis 
-                         WHERE sent_trimmed=:strim AND rcvd_trimmed=:rtrim AND trim_analysis.probe_id=probes.id AND probes.test_case!=:unusual_case AND sample=u.s AND probes.type in ('train','test'))
-      FROM (SELECT probes.sample s,packet_rtt FROM probes,trim_analysis WHERE sent_trimmed=:strim AND rcvd_trimmed=:rtrim AND trim_analysis.probe_id=probes.id AND probes.test_case=:unusual_case AND probes.type in ('train','test') AND 1 NOT IN (select 1 from probes p,trim_analysis t WHERE p.sample=s AND t.probe_id=p.id AND t.suspect LIKE '%R%')) u
-    """
-    query="""
-      SELECT packet_rtt-(SELECT avg(packet_rtt) FROM probes,trim_analysis 
-                         WHERE sent_trimmed=:strim AND rcvd_trimmed=:rtrim AND trim_analysis.probe_id=probes.id AND probes.test_case!=:unusual_case AND sample=u.s AND probes.type in ('train','test'))
-      FROM (SELECT probes.sample s,packet_rtt FROM probes,trim_analysis WHERE sent_trimmed=:strim AND rcvd_trimmed=:rtrim AND trim_analysis.probe_id=probes.id AND probes.test_case=:unusual_case AND probes.type in ('train','test')) u
-    """
+def evaluateTrim(analyzed, probes, unusual_case):
+    valid = analyzed['valid'] & probes['train_test']
+    differences = pairedDifferences(probes['sample'][valid],
+                                    probes['test_case'][valid] == unusual_case,
+                                    analyzed['packet_rtt'][valid])
     #TODO: check for "N" in suspect field and return a flag
-    
-    params = {"strim":strim,"rtrim":rtrim,"unusual_case":unusual_case}
-    cursor.execute(query, params)
-    differences = [row[0] for row in cursor]
 
     return septasummary(differences),mad(differences)
 
 
+def pairedDifferences(samples, is_unusual, values):
+    # For each sample with an unusual case value, that value minus the mean of
+    # the sample's other cases.  Samples without other cases are skipped.
+    sample_ids,sample_index = numpy.unique(samples, return_inverse=True)
+    other_sum = numpy.bincount(sample_index[~is_unusual], weights=values[~is_unusual],
+                               minlength=len(sample_ids))
+    other_count = numpy.bincount(sample_index[~is_unusual], minlength=len(sample_ids))
+    unusual_index = sample_index[is_unusual]
+    has_others = other_count[unusual_index] > 0
+    unusual_index = unusual_index[has_others]
+
+    return values[is_unusual][has_others] - other_sum[unusual_index]/other_count[unusual_index]
+
+
+# Request index (request_seq) of each packet of a keep-alive connection,
+# for packets sorted by observed.  A request is only written once the
+# previous response has been read, so each request starts at the first sent
+# packet carrying data beyond anything sent before that follows received
+# data.  Packets before the first request (the handshake) belong to it.
+def connectionSegments(packets):
+    ret_val = []
+    segment = 0
+    started = False
+    base = None
+    sent_end = 0
+    rcvd_since = False
+    for p in packets:
+        if p['payload_len'] > 0 and p['sent'] == 1:
+            if base == None:
+                base = p['tcpseq']
+            offset = (p['tcpseq']-base) % 2**32
+            if started and rcvd_since and offset >= sent_end:
+                segment += 1
+                rcvd_since = False
+            started = True
+            sent_end = max(sent_end, offset+p['payload_len'])
+        elif p['payload_len'] > 0 and started:
+            rcvd_since = True
+        ret_val.append(segment)
+    return ret_val
 
-def analyzeProbes(db, trim=None, recompute=False):
-    db.conn.execute("CREATE INDEX IF NOT EXISTS packets_probe ON packets (probe_id)")
+
+# Moves the packets of each keep-alive connection, all associated with
+# the connection's first probe, to the probes of the requests they belong
+# to (see connectionSegments).  Packets of requests with no stored probe
+# are left unassociated.  Connections already split are skipped.
+def splitKeepAliveConnections(db):
+    cursor = db.conn.cursor()
+    cursor.execute("SELECT DISTINCT probe_id FROM packets WHERE probe_id IS NOT NULL")
+    with_packets = set(row[0] for row in cursor)
+    
+    updates = []
+    for head,request_probes in db.keepAliveConnections():
+        if any(pid in with_packets for pid in request_probes.values() if pid != head):
+            continue
+        cursor.execute("SELECT id,sent,observed,payload_len,tcpseq FROM packets"
+                       " WHERE probe_id=? ORDER BY observed,rowid", (head,))
+        rows = cursor.fetchall()
+        segments = connectionSegments(rows)
+        if len(segments) > 0 and segments[-1] > max(request_probes):
+            sys.stderr.write("WARN: connection of probe_id=%s has %d requests but %d probes\n"
+                             % (head, segments[-1]+1, len(request_probes)))
+        updates.extend((request_probes.get(seg),row['id']) for row,seg in zip(rows, segments)
+                       if request_probes.get(seg) != head)
+
+    cursor.executemany("UPDATE packets SET probe_id=? WHERE id=?", updates)
     db.conn.commit()
+    return len(updates)
+
+
+def analyzeProbes(db, trim=None, recompute=False):
+    splitKeepAliveConnections(db)
 
     pcursor = db.conn.cursor()
     pcursor.execute("SELECT tcpts_mean FROM meta")
@@ -221,52 +632,33 @@ def analyzeProbes(db, trim=None, recompute=False):
     except:
         timestamp_precision = None
     
-    pcursor.execute("DELETE FROM trim_analysis")
-    db.conn.commit()
     if recompute:
-        pcursor.execute("DELETE FROM analysis")
-        db.conn.commit()
+        db.deleteAnalyses()
 
     def loadPackets(db):
         cursor = db.conn.cursor()
         #cursor.execute("SELECT * FROM packets ORDER BY probe_id")
-        cursor.execute("SELECT * FROM packets WHERE probe_id NOT IN (SELECT probe_id FROM analysis) ORDER BY probe_id")
-
-        probe_id = None
-        entry = []
-        ret_val = []
-        for p in cursor:
-            if probe_id == None:
-                probe_id = p['probe_id']
-            if p['probe_id'] != probe_id:
-                ret_val.append((probe_id,entry))
-                probe_id = p['probe_id']
-                entry = []
-            entry.append(dict(p))
-        ret_val.append((probe_id,entry))
-        return ret_val
+        cursor.execute("SELECT probe_id,sent,observed,tsval,payload_len,tcpseq,tcpack FROM packets"
+                       " WHERE probe_id IS NOT NULL AND probe_id NOT IN (SELECT probe_id FROM analysis)"
+                       " ORDER BY probe_id")
+        cursor.row_factory = None
+        names = ('probe_id','sent','observed','tsval','payload_len','tcpseq','tcpack')
+        columns = dict(zip(names, zip(*cursor.fetchall()))) or {n:() for n in names}
+        return preparePacketColumns(columns)
+
+    def loadProbes(db, probe_ids):
+        cursor = db.conn.cursor()
+        cursor.execute("SELECT id,sample,test_case,type FROM probes")
+        info = {row['id']:row for row in cursor}
+        rows = [info[pid] for pid in probe_ids]
+        test_case = numpy.empty(len(rows), dtype=object)
+        test_case[:] = [r['test_case'] for r in rows]
+        return {'sample':numpy.array([r['sample'] for r in rows], dtype=numpy.int64),
+                'test_case':test_case,
+                'train_test':numpy.array([r['type'] in ('train','test') for r in rows], dtype=bool)}
 
     def processPackets(packet_cache, strim, rtrim):
-        sent_tally = []
-        rcvd_tally = []
-        analyses = []
-        for probe_id,packets in packet_cache:
-            try:
-                analysis,s,r = analyzePackets(packets, timestamp_precision,strim,rtrim)
-                analysis['probe_id'] = probe_id
-                analyses.append(analysis)
-                sent_tally.append(s)
-                rcvd_tally.append(r)
-            except Exception as e:
-                #traceback.print_exc()
-                sys.stderr.write("WARN: couldn't find enough packets for probe_id=%s\n" % probe_id)
-
-        start = time.time()    
-        db.addTrimAnalyses(analyses)
-        db.conn.commit()
-        print("addTrimAnalyses: %f" % (time.time()-start))
-
-        return statistics.mode(sent_tally),statistics.mode(rcvd_tally)
+        return analyzePacketColumns(packet_cache, timestamp_precision, strim, rtrim)
     
     #start = time.time()
     packet_cache = loadPackets(db)
@@ -274,49 +666,64 @@ def analyzeProbes(db, trim=None, recompute=False):
 
     if trim != None:
         best_strim,best_rtrim = trim
-        processPackets(packet_cache, best_strim, best_rtrim)
+        best = processPackets(packet_cache, best_strim, best_rtrim)
     else:
-        num_sent,num_rcvd = processPackets(packet_cache, 0, 0)
+        # Every candidate trim is analyzed in memory from the same packet
+        # cache; only the selected one is written to the analysis table.
+        best = processPackets(packet_cache, 0, 0)
+        valid = best['valid']
+        num_sent = statistics.mode(best['num_sent'][valid].tolist())
+        num_rcvd = statistics.mode(best['num_rcvd'][valid].tolist())
         print("num_sent: %d, num_rcvd: %d" % (num_sent,num_rcvd))
-        unusual_case,delta = findUnusualTestCase(db, (0,0))
+
+        probes = loadProbes(db, packet_cache['probe_ids'])
+        in_tt = valid & probes['train_test']
+        case_rtts = {tc:best['packet_rtt'][in_tt & (probes['test_case'] == tc)]
+                     for tc in enumStoredTestCases(db)}
+        unusual_case,delta = unusualTestCase(case_rtts)
         print("unusual_case: %s, delta: %f" % (unusual_case,delta))
         
         delta_margin = 0.15
         best_strim = 0
         best_rtrim = 0
         
-        good_delta,good_mad = evaluateTrim(db, unusual_case, best_strim, best_rtrim)
+        good_delta,good_mad = evaluateTrim(best, probes, unusual_case)
         print("trim (%d,%d): delta=%f, mad=%f" % (best_strim,best_rtrim, good_delta, good_mad))
         
         for strim in range(1,num_sent):
-            processPackets(packet_cache, strim, best_rtrim)
-            delta,mad = evaluateTrim(db, unusual_case, strim, best_rtrim)
+            analyzed = processPackets(packet_cache, strim, best_rtrim)
+            delta,mad = evaluateTrim(analyzed, probes, unusual_case)
             print("trim (%d,%d): delta=%f, mad=%f" % (strim,best_rtrim, delta, mad))
             if delta*good_delta > 0.0 and (abs(good_delta) - abs(delta)) < abs(delta_margin*good_delta) and mad < good_mad:
                 best_strim = strim
+                best = analyzed
                 good_delta,good_mad = delta,mad
             else:
                 break
 
         for rtrim in range(1,num_rcvd):
-            processPackets(packet_cache, best_strim, rtrim)
-            delta,mad = evaluateTrim(db, unusual_case, best_strim, rtrim)
+            analyzed = processPackets(packet_cache, best_strim, rtrim)
+            delta,mad = evaluateTrim(analyzed, probes, unusual_case)
             print("trim (%d,%d): delta=%f, mad=%f" % (best_strim, rtrim, delta, mad))            
             if delta*good_delta > 0.0 and (abs(good_delta) - abs(delta)) < abs(delta_margin*good_delta) and mad < good_mad:
                 best_rtrim = rtrim
+                best = analyzed
             else:
                 break
 
         print("selected trim parameters:",(best_strim,best_rtrim))
-    
-    pcursor.execute("""INSERT OR IGNORE INTO analysis 
-                         SELECT id,probe_id,suspect,packet_rtt,tsval_rtt 
-                           FROM trim_analysis 
-                           WHERE sent_trimmed=? AND rcvd_trimmed=?""",
-                    (best_strim,best_rtrim))
+
+    for probe_id in packet_cache['probe_ids'][~best['valid']]:
+        sys.stderr.write("WARN: couldn't find enough packets for probe_id=%s\n" % probe_id)
+
+    analyses = packetAnalysisRows(best)
+    for a in analyses:
+        del a['sent_trimmed']
+        del a['rcvd_trimmed']
+    db.addAnalyses(analyses)
     db.conn.commit()
     
-    return len(packet_cache)
+    return len(packet_cache['probe_ids'])
 
 
         
@@ -325,69 +732,232 @@ def parseJSONLines(fp):
         yield json.loads(line)
 
 
-def associatePackets(sniffer_fp, db):
-    sniffer_fp.seek(0)
-
-    # now combine sampler data with packet data
-    buffered = []
-
+def associationWindow(db):
     cursor = db.conn.cursor()
     cursor.execute("SELECT count(*) count,min(time_of_day) start,max(time_of_day+userspace_rtt) end from probes")
     ptimes = cursor.fetchone()
+    if ptimes['count'] == 0:
+        return None,None
     window_size = 100*int((ptimes['end']-ptimes['start'])/ptimes['count'])
     #print("associate window_size:", window_size)
 
-    db.addPackets(parseJSONLines(sniffer_fp), window_size)
+    # No probe committed later can start before the latest committed probe
+    # finished, so packets observed before this point can be associated now.
+    return window_size,ptimes['end']
 
+
+# Warns about losses in the last (cumulative) statistics of a capture run
+def reportCaptureStats(stats):
+    if len(stats) == 0:
+        sys.stderr.write("WARNING: packet sniffer reported no capture statistics\n")
+        return
+    
+    last = stats[-1]
+    lost = last['dropped']+last['ifdropped']+last['ring_dropped']
+    if lost > 0:
+        sys.stderr.write("WARNING: packet capture lost %d packets (kernel: %d, interface: %d, ring: %d)\n"
+                         % (lost, last['dropped'], last['ifdropped'], last['ring_dropped']))
+    if last['ring_capacity'] > 0 and last['ring_high_water'] > last['ring_capacity']/2:
+        sys.stderr.write("WARNING: packet ring reached %d of %d records\n"
+                         % (last['ring_high_water'], last['ring_capacity']))
+    if not last['nano_precision']:
+        sys.stderr.write("INFO: packet timestamps only have microsecond precision (source: %s)\n"
+                         % last['tstamp_source'])
+
+
+def reportUnmatchedPackets(db):
+    cursor = db.conn.cursor()
     cursor.execute("SELECT count(*) count FROM packets WHERE probe_id is NULL")
     unmatched = cursor.fetchone()['count']
     if unmatched > 0:
         sys.stderr.write("WARNING: %d observed packets didn't find a home...\n" % unmatched)
- 
+
+
+def associatePackets(sniffer_fp, db):
+    sniffer_fp.seek(0)
+
+    # now combine sampler data with packet data
+    window_size,watermark = associationWindow(db)
+    db.addPackets(parseJSONLines(sniffer_fp), window_size)
+    reportUnmatchedPackets(db)
+
     return None
 
 
+def associatePacketRecords(records, db):
+    window_size,watermark = associationWindow(db)
+    db.addPacketRecords(records, window_size)
+    reportUnmatchedPackets(db)
+
+
+class PacketsExistError(Exception):
+    pass
+
+
+# Associates the packets in a pcap/pcapng file captured elsewhere, one
+# chunk at a time.  my_ip is the sampler's (client's) address.  Packets
+# already in the database would be duplicated, so unless replace is set
+# (which deletes them first) a database holding any raises
+# PacketsExistError.  A file that isn't a pcap or pcapng raises ValueError
+# before anything is deleted.
+def associatePcap(path, db, my_ip, target_ip, target_port, chunk_size=2**20, replace=False):
+    capture.checkPcap(path)
+    cursor = db.conn.cursor()
+    cursor.execute("SELECT count(*) count FROM packets")
+    existing = cursor.fetchone()['count']
+    if existing > 0:
+        if not replace:
+            raise PacketsExistError("database already holds %d packets" % existing)
+        db.deletePackets()
+
+    window_size,watermark = associationWindow(db)
+    count = 0
+    for records in capture.readPcap(path, my_ip, target_ip, target_port, chunk_size=chunk_size):
+        db.addPacketRecords(records, window_size)
+        count += len(records)
+    reportUnmatchedPackets(db)
+    return count
+
+
+# Tails a sniffer's packet log in a background thread, associating and
+# committing packets in batches once the probes they could belong to have
+# been committed.  Batches are associated with the window size known at
+# that point; whatever remains when stop() is called gets the final one.
+#
+# If probes may be committed out of order (e.g. concurrent samples from
+# engine.probeEngine), set horizon to a callable returning the earliest
+# time_of_day of any probe not yet committed (or None); packets observed
+# after it are held back.
+#
+# If associating fails (e.g. the database stays locked), the thread stops
+# and stop() re-raises the error.
+class streamingAssociator(object):
+    db = None
+    sniffer = None
+    interval = None
+    horizon = None
+    associated = 0
+    error = None
+    _thread = None
+    _stopping = None
+
+    def __init__(self, db, sniffer, interval=1.0):
+        self.db = db
+        self.sniffer = sniffer
+        self.interval = interval
+        self._stopping = threading.Event()
+
+    def start(self):
+        self.associated = 0
+        self.error = None
+        self._stopping.clear()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        if self._thread:
+            self._stopping.set()
+            self._thread.join()
+            self._thread = None
+            if self.error != None:
+                raise self.error
+            reportUnmatchedPackets(self.db)
+        return self.associated
+
+    def _run(self):
+        try:
+            self._tail()
+        except Exception as e:
+            sys.stderr.write("ERROR: failed to associate packets: %s\n" % repr(e))
+            self.db.conn.rollback()
+            self.error = e
+
+    def _tail(self):
+        binary = getattr(self.sniffer, 'binary', False)
+        if binary:
+            pending = numpy.zeros(0, dtype=capture.packet_dtype)
+        else:
+            log = self.sniffer.openPacketLog()
+            partial = ''
+            pending = []
+        while True:
+            finishing = self._stopping.is_set()
+            if binary:
+                pending = numpy.concatenate((pending, self.sniffer.newPacketRecords()))
+            else:
+                lines = (partial + log.read()).split('\n')
+                partial = lines.pop()
+                pending.extend(json.loads(line) for line in lines if line)
+
+            window_size,watermark = associationWindow(self.db)
+            # Must be read after the watermark: anything started since then
+            # starts after every probe the watermark covers finished.
+            if self.horizon != None and watermark != None:
+                earliest = self.horizon()
+                if earliest != None:
+                    watermark = min(watermark, earliest)
+            if finishing:
+                ready = pending
+                pending = pending[0:0]
+            elif watermark != None and binary:
+                is_ready = pending['observed'] <= watermark
+                ready = pending[is_ready]
+                pending = pending[~is_ready]
+            elif watermark != None:
+                ready = [p for p in pending if p['observed'] <= watermark]
+                pending = [p for p in pending if p['observed'] > watermark]
+            else:
+                ready = pending[0:0]
+
+            if len(ready) > 0:
+                if binary:
+                    self.db.addPacketRecords(ready, window_size)
+                else:
+                    self.db.addPackets(ready, window_size)
+                self.associated += len(ready)
+            if finishing:
+                break
+            self._stopping.wait(self.interval)
+        if binary:
+            dropped = getattr(self.sniffer, 'ringDropped', lambda: 0)()
+            if dropped > 0:
+                sys.stderr.write("WARNING: packet ring overflowed; %d packets were dropped\n" % dropped)
+        else:
+            log.close()
+
+
 def enumStoredTestCases(db):
     cursor = db.conn.cursor()
     cursor.execute("SELECT test_case FROM probes GROUP BY test_case")
     return [tc[0] for tc in cursor]
 
 
-def findUnusualTestCase(db, trim=None):
+def findUnusualTestCase(db):
     test_cases = enumStoredTestCases(db)
-    if trim != None:
-        params = {'strim':trim[0], 'rtrim':trim[1]}
-        qsuffix = " AND sent_trimmed=:strim AND rcvd_trimmed=:rtrim"
-        table = "trim_analysis"
-    else:
-        params = {}
-        qsuffix = ""
-        table = "analysis"
     
     cursor = db.conn.cursor()
-    cursor.execute("SELECT packet_rtt FROM probes,"+table+" a WHERE probes.id=a.probe_id AND probes.type in ('train','test')"+qsuffix, params)
-    global_tm = quadsummary([row['packet_rtt'] for row in cursor])
+    case_rtts = {tc:[] for tc in test_cases}
+    # XXX: if more speed needed, percentile extension to sqlite might be handy...
+    cursor.execute("SELECT test_case,packet_rtt FROM probes,analysis a WHERE probes.id=a.probe_id AND probes.type in ('train','test')")
+    for row in cursor:
+        case_rtts[row['test_case']].append(row['packet_rtt'])
+
+    return unusualTestCase(case_rtts)
+
+
+def unusualTestCase(case_rtts):
+    test_cases = list(case_rtts.keys())
+    global_tm = quadsummary(numpy.concatenate([numpy.asarray(case_rtts[tc]) for tc in test_cases]))
 
     tm_abs = []
     tm_map = {}
-
-    # XXX: if more speed needed, percentile extension to sqlite might be handy...
     for tc in test_cases:
-        params['test_case']=tc
-        query = """SELECT packet_rtt FROM probes,"""+table+""" a
-                   WHERE probes.id=a.probe_id AND probes.type in ('train','test') 
-                   AND probes.test_case=:test_case""" + qsuffix
-        cursor.execute(query, params)
-        tm_map[tc] = quadsummary([row['packet_rtt'] for row in cursor])
+        tm_map[tc] = quadsummary(case_rtts[tc])
         tm_abs.append((abs(tm_map[tc]-global_tm), tc))
 
     magnitude,tc = max(tm_abs)
-    params['test_case']=tc
-    query = """SELECT packet_rtt FROM probes,"""+table+""" a
-               WHERE probes.id=a.probe_id AND probes.type in ('train','test') 
-               AND probes.test_case<>:test_case""" + qsuffix
-    cursor.execute(query,params)
-    remaining_tm = quadsummary([row['packet_rtt'] for row in cursor])
+    remaining_tm = quadsummary(numpy.concatenate([numpy.asarray(case_rtts[t]) for t in test_cases if t != tc]))
 
     delta = tm_map[tc]-remaining_tm
     # Hack to make the chosen unusual_case more intuitive to the user
@@ -463,3 +1033,32 @@ def evaluateTestResults(db):
 
 
     return best_obs,best_error
+
+
+# The sequentialTest for a classifier trained and tested in db (see
+# stats.sprtTest), using the tested parameters evaluateTestResults would
+# report, along with db's (unusual_case, greater).  Returns None if the
+# classifier hasn't been tested in db.
+def trainedSequentialTest(db, classifier='sprt_client'):
+    best_obs,best_error = evaluateTestResults(db)
+    for result in best_obs+best_error:
+        if result['classifier'] == classifier:
+            return (sequentialTest(json.loads(result['params']), result['num_observations']),
+                    db.getUnusualCase())
+    return None
+
+
+# A sample's paired difference in the given rtt column ('client', as in
+# the client_diff population column), from its probe rows as stored by the
+# sampler
+def sampleDifference(results, unusual_case, column='client'):
+    def rtt(r):
+        if column == 'client' and r.get('client_first_read') != None and r.get('client_first_write') != None:
+            return r['client_first_read']-r['client_first_write']
+        return None
+    unusual = [rtt(r) for r in results if r['test_case'] == unusual_case]
+    others = [rtt(r) for r in results if r['test_case'] != unusual_case]
+    if len(unusual) == 0 or None in unusual or len(others) == 0 or None in others:
+        return float('nan')
+    return unusual[0]-statistics.mean(others)
+
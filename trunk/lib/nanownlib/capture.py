@@ -0,0 +1,410 @@
+#-*- mode: Python;-*-
+
+import sys
+import os
+import tempfile
+import socket
+import struct
+try:
+    import numpy
+except:
+    sys.stderr.write('ERROR: Could not import numpy module.  Ensure it is installed.\n')
+    sys.stderr.write('       Under Debian, the package name is "python3-numpy"\n.')
+    sys.exit(1)
+
+
+# Binary packet log format written by "nanown-listen -b".  These must match
+# struct capture_header and struct capture_record in src/listen.c.
+CAPTURE_MAGIC = b'NANOWNPK'
+CAPTURE_VERSION = 1
+CAPTURE_FLAG_NANO = 0x1
+
+header_dtype = numpy.dtype([('magic','S8'),
+                            ('version','<u4'),
+                            ('header_size','<u4'),
+                            ('record_size','<u4'),
+                            ('flags','<u4'),
+                            ('reserved','V8')])
+
+packet_dtype = numpy.dtype([('observed','<u8'),
+                            ('tcpseq','<u4'),
+                            ('tcpack','<u4'),
+                            ('tsval','<u4'),
+                            ('local_port','<u2'),
+                            ('payload_len','<u2'),
+                            ('sent','u1'),
+                            ('reserved','V7')])
+
+packet_fields = ('local_port','sent','observed','tsval','payload_len','tcpseq','tcpack')
+
+
+def isPacketLog(path):
+    with open(path, 'rb') as f:
+        return f.read(len(CAPTURE_MAGIC)) == CAPTURE_MAGIC
+
+
+def readPacketLogHeader(path):
+    with open(path, 'rb') as f:
+        raw = f.read(header_dtype.itemsize)
+    if len(raw) < header_dtype.itemsize:
+        return None
+
+    header = numpy.frombuffer(raw, dtype=header_dtype)[0]
+    if header['magic'] != CAPTURE_MAGIC:
+        raise ValueError("%s is not a binary packet log" % path)
+    if header['version'] != CAPTURE_VERSION or header['record_size'] != packet_dtype.itemsize:
+        raise ValueError("%s has unsupported packet log version %d (record size %d)"
+                         % (path, header['version'], header['record_size']))
+    return header
+
+
+# Returns the complete records currently in a binary packet log as a
+# read-only structured array (see packet_dtype) mapped directly from the
+# file.  A log still being written may end in a partial record, which is
+# left out until a later call.
+def readPacketLog(path):
+    header = readPacketLogHeader(path)
+    if header == None:
+        return numpy.zeros(0, dtype=packet_dtype)
+
+    offset = int(header['header_size'])
+    count = (os.path.getsize(path) - offset)//packet_dtype.itemsize
+    if count <= 0:
+        return numpy.zeros(0, dtype=packet_dtype)
+    return numpy.memmap(path, dtype=packet_dtype, mode='r', offset=offset, shape=(count,))
+
+
+# Converts packet records to the dicts produced by parseJSONLines
+def packetRecordDicts(records):
+    columns = [records[f].tolist() for f in packet_fields]
+    return [dict(zip(packet_fields, values)) for values in zip(*columns)]
+
+
+# Shared-memory ring written by "nanown-listen -r".  These must match
+# struct ring_header in src/listen.c.  Each index sits on its own cache
+# line: the producer only writes write_index/dropped/state and the consumer
+# only writes read_index.
+RING_MAGIC = b'NANOWNRB'
+RING_VERSION = 1
+RING_STATE_RUNNING = 1
+RING_STATE_STOPPED = 2
+
+ring_dtype = numpy.dtype([('magic','S8'),
+                          ('version','<u4'),
+                          ('header_size','<u4'),
+                          ('record_size','<u4'),
+                          ('capacity','<u4'),
+                          ('flags','<u4'),
+                          ('reserved1','V36'),
+                          ('write_index','<u8'),
+                          ('dropped','<u8'),
+                          ('state','<u4'),
+                          ('reserved2','V44'),
+                          ('read_index','<u8'),
+                          ('reserved3','V56')])
+
+# Default number of records in a ring (32MB)
+ring_capacity = 2**20
+
+
+def _ringPath():
+    if os.path.isdir('/dev/shm'):
+        return '/dev/shm'
+    return None
+
+
+# Single-consumer side of the ring.  The file is created here, so it exists
+# with a valid header before nanown-listen is started on it.  Records that
+# arrive while the ring is full are dropped by the producer and counted in
+# dropped(); size the capacity to cover the longest gap between reads.
+class packetRing(object):
+    path = None
+    capacity = None
+    _fp = None
+    _map = None
+    _header = None
+    _records = None
+    
+    def __init__(self, capacity=None, path=None):
+        if capacity == None:
+            capacity = ring_capacity
+        if capacity <= 0:
+            raise ValueError("ring capacity must be positive")
+        self.capacity = capacity
+
+        if path == None:
+            self._fp = tempfile.NamedTemporaryFile('w+b', prefix='nanown-ring-', dir=_ringPath())
+        else:
+            self._fp = open(path, 'w+b')
+        self.path = self._fp.name
+        
+        self._fp.truncate(ring_dtype.itemsize + capacity*packet_dtype.itemsize)
+        self._map = numpy.memmap(self._fp, dtype=numpy.uint8, mode='r+')
+        self._header = self._map[:ring_dtype.itemsize].view(ring_dtype)
+        self._records = self._map[ring_dtype.itemsize:].view(packet_dtype)
+        self._header['magic'] = RING_MAGIC
+        self._header['version'] = RING_VERSION
+        self._header['header_size'] = ring_dtype.itemsize
+        self._header['record_size'] = packet_dtype.itemsize
+        self._header['capacity'] = capacity
+        self._map.flush()
+
+    def written(self):
+        return int(self._header['write_index'][0])
+        
+    def dropped(self):
+        return int(self._header['dropped'][0])
+
+    def pending(self):
+        return self.written() - int(self._header['read_index'][0])
+    
+    def is_running(self):
+        return self._header['state'][0] == RING_STATE_RUNNING
+
+    def flags(self):
+        return int(self._header['flags'][0])
+    
+    # Copies out and releases every record published since the last call,
+    # oldest first.  The copy is taken before read_index is advanced, since
+    # the producer may reuse those slots as soon as it is.
+    def readNew(self):
+        if self._map is None:
+            return numpy.zeros(0, dtype=packet_dtype)
+        
+        start = int(self._header['read_index'][0])
+        end = self.written()
+        first = start % self.capacity
+        last = first + (end - start)
+        if last <= self.capacity:
+            records = self._records[first:last].copy()
+        else:
+            records = numpy.concatenate((self._records[first:],
+                                         self._records[:last-self.capacity]))
+        self._header['read_index'] = end
+        return records
+
+    def close(self):
+        self._header = None
+        self._records = None
+        self._map = None
+        if self._fp:
+            self._fp.close()
+            self._fp = None
+        
+    def __del__(self):
+        self.close()
+
+
+# Offline ingestion of pcap and pcapng files (e.g. from tcpdump on a SPAN
+# port).  Packets are filtered and their fields extracted as nanown-listen
+# does (see extract_packet_fields in src/listen.c), so the records can be
+# associated exactly like a live capture.
+PCAP_MAGIC_MICRO = 0xa1b2c3d4
+PCAP_MAGIC_NANO = 0xa1b23c4d
+PCAPNG_SHB = 0x0a0d0d0a
+PCAPNG_BYTE_ORDER = 0x1a2b3c4d
+
+# Link-layer header lengths for the supported link types
+_link_headers = {0:4,     # DLT_NULL
+                 1:14,    # DLT_EN10MB
+                 101:0,   # DLT_RAW
+                 113:16,  # DLT_LINUX_SLL
+                 228:0,   # DLT_IPV4
+                 276:20}  # DLT_LINUX_SLL2 (tcpdump -i any)
+
+
+def _pcapPackets(fp, byte_order, nano):
+    record = struct.Struct(byte_order+'IIII')
+    header = fp.read(20)
+    if len(header) < 20:
+        return
+    linktype = struct.unpack(byte_order+'I', header[16:20])[0] & 0xffff
+    scale = 1 if nano else 1000
+    while True:
+        raw = fp.read(record.size)
+        if len(raw) < record.size:
+            return
+        sec,frac,caplen,length = record.unpack(raw)
+        data = fp.read(caplen)
+        if len(data) < caplen:
+            return
+        yield linktype,sec*1000000000+frac*scale,data
+
+
+def _tsresolNS(tsresol):
+    if tsresol & 0x80:
+        return lambda ts: (ts*1000000000) >> (tsresol & 0x7f)
+    if tsresol <= 9:
+        factor = 10**(9-tsresol)
+        return lambda ts: ts*factor
+    divisor = 10**(tsresol-9)
+    return lambda ts: ts//divisor
+
+
+def _pcapngOptions(body, byte_order):
+    options = {}
+    pos = 0
+    while pos+4 <= len(body):
+        code,length = struct.unpack_from(byte_order+'HH', body, pos)
+        if code == 0:
+            break
+        options[code] = body[pos+4:pos+4+length]
+        pos += 4 + ((length+3) & ~3)
+    return options
+
+
+def _pcapngPackets(fp):
+    byte_order = '<'
+    interfaces = []
+    while True:
+        raw = fp.read(8)
+        if len(raw) < 8:
+            return
+        block_type = struct.unpack('<I', raw[:4])[0]
+        if block_type == PCAPNG_SHB:
+            # The byte order magic follows the length, which is in that order
+            magic = fp.read(4)
+            byte_order = '<' if struct.unpack('<I', magic)[0] == PCAPNG_BYTE_ORDER else '>'
+            length = struct.unpack(byte_order+'I', raw[4:])[0]
+            body = fp.read(length-12)
+            interfaces = []
+            continue
+
+        block_type,length = struct.unpack(byte_order+'II', raw)
+        if length < 12:
+            raise ValueError("corrupt pcapng block (length %d)" % length)
+        body = fp.read(length-8)
+        if len(body) < length-8:
+            return
+        
+        if block_type == 1: # interface description
+            linktype = struct.unpack_from(byte_order+'H', body, 0)[0]
+            options = _pcapngOptions(body[8:-4], byte_order)
+            tsresol = options.get(9, b'\x06')[0]
+            interfaces.append((linktype, _tsresolNS(tsresol)))
+        elif block_type in (6,2): # enhanced packet, (obsolete) packet
+            if block_type == 6:
+                iface,ts_high,ts_low,caplen = struct.unpack_from(byte_order+'IIII', body, 0)
+            else:
+                iface,drops,ts_high,ts_low,caplen = struct.unpack_from(byte_order+'HHIII', body, 0)
+            linktype,toNS = interfaces[iface]
+            yield linktype,toNS((ts_high << 32) | ts_low),body[20:20+caplen]
+        # Simple packet blocks carry no timestamp and everything else is
+        # irrelevant here.
+
+
+# Yields (linktype, observed ns, frame bytes) for each packet in a pcap or
+# pcapng file
+def pcapPackets(fp):
+    raw = fp.read(4)
+    if len(raw) < 4:
+        return iter(())
+    magic = struct.unpack('<I', raw)[0]
+    if magic == PCAPNG_SHB:
+        fp.seek(-4, 1)
+        return _pcapngPackets(fp)
+    for byte_order in ('<','>'):
+        magic = struct.unpack(byte_order+'I', raw)[0]
+        if magic in (PCAP_MAGIC_MICRO, PCAP_MAGIC_NANO):
+            return _pcapPackets(fp, byte_order, magic == PCAP_MAGIC_NANO)
+    raise ValueError("not a pcap or pcapng file")
+
+
+# Raises ValueError unless path begins with a pcap or pcapng header
+def checkPcap(path):
+    with open(path, 'rb') as fp:
+        if len(fp.read(4)) < 4:
+            raise ValueError("%s is not a pcap or pcapng file" % path)
+        fp.seek(0)
+        pcapPackets(fp)
+
+
+def _extractPacketFields(linktype, data, my_ip, target_ip, target_port, payloads_only):
+    offset = _link_headers.get(linktype)
+    if offset == None:
+        return None
+    if linktype == 1:
+        # Skip 802.1Q tags, which a SPAN port may leave in place
+        while data[offset-2:offset] in (b'\x81\x00', b'\x88\xa8') and len(data) >= offset+4:
+            offset += 4
+        if data[offset-2:offset] != b'\x08\x00':
+            return None
+    elif linktype == 113 and data[14:16] != b'\x08\x00':
+        return None
+    elif linktype == 276 and data[0:2] != b'\x08\x00':
+        return None
+    
+    if len(data) < offset+20 or (data[offset] >> 4) != 4 or data[offset+9] != 6:
+        return None
+    iphdr_size = (data[offset] & 0x0f)*4
+    if iphdr_size < 20 or len(data) < offset+iphdr_size+20:
+        return None
+    ip_len = struct.unpack_from('!H', data, offset+2)[0]
+    src = data[offset+12:offset+16]
+    dst = data[offset+16:offset+20]
+
+    tcp = offset+iphdr_size
+    sport,dport,tcpseq,tcpack,off = struct.unpack_from('!HHIIB', data, tcp)
+    if src == target_ip and dst == my_ip and sport == target_port:
+        sent = 0
+        local_port = dport
+    elif src == my_ip and dst == target_ip and dport == target_port:
+        sent = 1
+        local_port = sport
+    else:
+        return None
+
+    tcphdr_size = (off >> 4)*4
+    payload_len = ip_len - iphdr_size - tcphdr_size
+    if tcphdr_size < 20 or payload_len < 0 or (payloads_only and payload_len == 0):
+        return None
+
+    tsval = 0
+    pos = tcp+20
+    end = min(tcp+tcphdr_size, len(data))
+    while pos < end and data[pos] != 0:
+        if data[pos] == 1: # NOP
+            pos += 1
+            continue
+        if data[pos] == 8 and pos+6 <= end: # timestamp
+            tsval = struct.unpack_from('!I', data, pos+2)[0]
+            break
+        if pos+1 >= end or data[pos+1] < 2:
+            break
+        pos += data[pos+1]
+
+    return local_port,sent,tsval,payload_len,tcpseq,tcpack
+
+
+def _packetRecordArray(rows):
+    records = numpy.zeros(len(rows), dtype=packet_dtype)
+    for name,column in zip(('observed','local_port','sent','tsval','payload_len','tcpseq','tcpack'),
+                           zip(*rows)):
+        records[name] = column
+    return records
+
+
+# Reads the packets between my_ip and target_ip:target_port from a pcap or
+# pcapng file, yielding them as packet record arrays of at most chunk_size
+# records so that large captures can be processed in bounded memory.
+def readPcap(path, my_ip, target_ip, target_port, payloads_only=False, chunk_size=2**20):
+    my_ip = socket.inet_aton(my_ip)
+    target_ip = socket.inet_aton(target_ip)
+    rows = []
+    unsupported = set()
+    with open(path, 'rb') as fp:
+        for linktype,observed,data in pcapPackets(fp):
+            if linktype not in _link_headers:
+                if linktype not in unsupported:
+                    sys.stderr.write("WARN: skipping packets of unsupported link type %d in %s\n"
+                                     % (linktype, path))
+                    unsupported.add(linktype)
+                continue
+            fields = _extractPacketFields(linktype, data, my_ip, target_ip, target_port, payloads_only)
+            if fields != None:
+                rows.append((observed,)+fields)
+                if len(rows) >= chunk_size:
+                    yield _packetRecordArray(rows)
+                    rows = []
+    if len(rows) > 0:
+        yield _packetRecordArray(rows)
@@ -0,0 +1,241 @@
+#-*- mode: Python;-*-
+
+import sys
+import time
+import socket
+import asyncio
+
+from . import clientTiming
+
+
+# Raised when a probe still fails after max_retries attempts
+class ProbeError(Exception):
+    pass
+
+
+# Lower-overhead alternative to sending probes through requests.  Each probe
+# is a single HTTP/1.1 request on a fresh connection, written and read with
+# asyncio streams and timed with time.perf_counter_ns (see clientTiming).
+#
+# run() collects samples: each sample's probes are sent one after another in
+# tc_order, as the requests-based path does, but up to concurrency samples
+# may be in flight at once (each connection on its own source port).  While
+# that is the case, probes committed for later samples may overlap earlier
+# ones still running, so earliestPending() should be used to hold back
+# association (see streamingAssociator.horizon).
+#
+# With keep_alive set, probes are instead sent over persistent HTTP/1.1
+# connections, kept separately for each test case and concurrency slot (the
+# key passed to sendProbe), and each result includes the request's
+# request_seq on its connection.  Since a slot's samples run one after
+# another, requests on a connection are in time_of_day order.  A connection
+# is only reused if the server leaves it open, and is dropped after any
+# failure.
+class probeEngine(object):
+    host_ip = None
+    port = None
+    hostname = None
+    concurrency = 1
+    max_retries = 10
+    timeout = 30.0
+    retry_delay = 1.0
+    keep_alive = False
+    _pending = None
+    _idle = None
+    _stopped = False
+
+    def __init__(self, host_ip, port, hostname, concurrency=1, max_retries=10, timeout=30.0,
+                 keep_alive=False):
+        self.host_ip = host_ip
+        self.port = port
+        self.hostname = hostname
+        self.concurrency = concurrency
+        self.max_retries = max_retries
+        self.timeout = timeout
+        self.keep_alive = keep_alive
+        self._pending = {}
+        self._idle = {}
+
+    def _request(self, path):
+        return ("GET %s HTTP/1.1\r\n"
+                "Host: %s\r\n"
+                "User-Agent: nanown\r\n"
+                "Accept: */*\r\n"
+                "Connection: %s\r\n\r\n"
+                % (path, self.hostname, 'keep-alive' if self.keep_alive else 'close')).encode('ascii')
+
+    def _reusable(self, version, headers, body_read_to_eof):
+        connection = headers.get('connection','').lower()
+        if body_read_to_eof or connection == 'close':
+            return False
+        return version == 'HTTP/1.1' or connection == 'keep-alive'
+
+    async def _readResponse(self, reader, timing):
+        head = await reader.readexactly(1)
+        timing['client_first_read'] = time.perf_counter_ns()
+        head += await reader.readuntil(b'\r\n\r\n')
+        lines = head.decode('iso-8859-1').split('\r\n')
+        version,status = lines[0].split(' ')[0:2]
+        status = int(status)
+        headers = {}
+        for line in lines[1:]:
+            if ':' in line:
+                name,value = line.split(':', 1)
+                headers[name.strip().lower()] = value.strip()
+
+        read_to_eof = False
+        if 'content-length' in headers:
+            body = await reader.readexactly(int(headers['content-length']))
+        elif headers.get('transfer-encoding','').lower() == 'chunked':
+            body = b''
+            while True:
+                size = int((await reader.readuntil(b'\r\n')).split(b';')[0], 16)
+                if size == 0:
+                    await reader.readuntil(b'\r\n')
+                    break
+                body += await reader.readexactly(size)
+                await reader.readexactly(2)
+        else:
+            body = await reader.read()
+            read_to_eof = True
+
+        reusable = self._reusable(version, headers, read_to_eof)
+        return status,headers,body.decode('utf-8', 'replace'),reusable
+
+    async def _send(self, path, key):
+        timing = clientTiming()
+        connection = None
+        if self.keep_alive and self._idle.get(key):
+            connection = self._idle[key].pop()
+        else:
+            timing['client_connect_start'] = time.perf_counter_ns()
+            reader,writer = await asyncio.open_connection(self.host_ip, self.port)
+            timing['client_connect_end'] = time.perf_counter_ns()
+            writer.get_extra_info('socket').setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            connection = {'reader':reader, 'writer':writer, 'requests':0,
+                          'local_port':writer.get_extra_info('sockname')[1]}
+
+        reusable = False
+        try:
+            request = self._request(path)
+            timing['client_first_write'] = time.perf_counter_ns()
+            connection['writer'].write(request)
+            status,headers,body,reusable = await self._readResponse(connection['reader'], timing)
+            timing['client_last_read'] = time.perf_counter_ns()
+        finally:
+            if self.keep_alive and reusable:
+                self._idle.setdefault(key, []).append(connection)
+            else:
+                connection['writer'].close()
+
+        request_seq = connection['requests']
+        connection['requests'] += 1
+        # On keep-alive connections only the first request pays for the
+        # connect, so every request is timed from its first write to keep
+        # userspace_rtt comparable within a session.
+        if self.keep_alive:
+            start = timing['client_first_write']
+        else:
+            start = timing['client_connect_start']
+        ret_val = {'userspace_rtt':timing['client_last_read']-start,
+                   'timing':timing,
+                   'local_port':connection['local_port'],
+                   'status':status,
+                   'headers':headers,
+                   'body':body}
+        if self.keep_alive:
+            ret_val['request_seq'] = request_seq
+        return ret_val
+
+    def _closeIdle(self):
+        for connections in self._idle.values():
+            for connection in connections:
+                connection['writer'].close()
+        self._idle = {}
+
+    # Sends one probe, retrying failures up to max_retries times.  key
+    # selects the pool of keep-alive connections to use.
+    async def sendProbe(self, path, key=None):
+        attempt = 0
+        while True:
+            try:
+                return await asyncio.wait_for(self._send(path, key), self.timeout)
+            except (OSError, EOFError, ValueError, IndexError,
+                    asyncio.IncompleteReadError, asyncio.TimeoutError) as e:
+                sys.stderr.write("ERROR: HTTP request problem: %s\n" % repr(e))
+                attempt += 1
+                if attempt > self.max_retries:
+                    raise ProbeError("giving up on %s after %d attempts" % (path, attempt))
+                await asyncio.sleep(self.retry_delay)
+                sys.stderr.write("ERROR: retrying...\n")
+
+    async def _sample(self, sid, slot, probes, parse):
+        now = int(time.time()*1000000000)
+        self._pending[sid] = now
+        results = []
+        try:
+            for i,(probedata,path) in enumerate(probes):
+                response = await self.sendProbe(path, (slot,probedata.get('test_case')))
+                result = {'userspace_rtt':response['userspace_rtt'],
+                          'reported':parse(response['headers'], response['body']),
+                          'local_port':response['local_port']}
+                result.update(response['timing'])
+                if 'request_seq' in response:
+                    result['request_seq'] = response['request_seq']
+                result.update(probedata)
+                result.update({'tc_order':i, 'time_of_day':now})
+                results.append(result)
+        except ProbeError as e:
+            sys.stderr.write("ERROR: dropping sample %d: %s\n" % (sid, str(e)))
+            results = None
+        return sid,slot,results
+
+    # Starts no more samples; run() returns once those in flight finish
+    def stop(self):
+        self._stopped = True
+
+    # The time_of_day of the earliest sample still in flight, or None
+    def earliestPending(self):
+        try:
+            return min(self._pending.values())
+        except ValueError:
+            return None
+
+    async def _run(self, count, makeSample, sampleDone, parse):
+        try:
+            await self._runSamples(count, makeSample, sampleDone, parse)
+        finally:
+            self._closeIdle()
+
+    async def _runSamples(self, count, makeSample, sampleDone, parse):
+        running = set()
+        free_slots = list(range(self.concurrency-1,-1,-1))
+        next_sample = 0
+        self._stopped = False
+        while (next_sample < count and not self._stopped) or running:
+            while next_sample < count and free_slots and not self._stopped:
+                sid,probes = makeSample(next_sample)
+                running.add(asyncio.ensure_future(self._sample(sid, free_slots.pop(), probes, parse)))
+                next_sample += 1
+
+            done,running = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                sid,slot,results = task.result()
+                if results != None:
+                    sampleDone(results)
+                del self._pending[sid]
+                free_slots.append(slot)
+
+    # Collects count samples.  makeSample(k) returns (sample id, probes) for
+    # the k'th sample, where probes is a list of (probe data, request path)
+    # in tc_order; it is called in order, just before the sample starts.
+    # sampleDone(results) receives each completed sample's probe rows, with
+    # reported taken from parse(headers, body).  Samples whose probes could
+    # not be sent are dropped.  stop() (e.g. from sampleDone) ends the run
+    # early.
+    def run(self, count, makeSample, sampleDone, parse):
+        loop = asyncio.new_event_loop()
+        try:
+            loop.run_until_complete(self._run(count, makeSample, sampleDone, parse))
+        finally:
+            loop.close()
@@ -3,17 +3,23 @@
 import sys
 import threading
 import queue
+import multiprocessing
+import multiprocessing.connection
+import collections
 
 
 class WorkerThreads(object):
     workq = None
     resultq = None
     target = None
+    setup = None
     
-    def __init__(self, num_workers, target):
+    def __init__(self, num_workers, target, setup=None):
         self.workq = queue.Queue()
         self.resultq = queue.Queue()
         self.target = target
+        self.setup = setup
+        self.num_jobs = 0
         
         self.workers = []
         for i in range(num_workers):
@@ -29,16 +35,21 @@ class WorkerThreads(object):
                 self.workq.task_done()
                 break
 
-            job_id,args = item
+            job_key,job_id,args = item
             try:
+                if self.setup:
+                    self.setup(job_key)
                 self.resultq.put((job_id, self.target(*args)))
             except Exception as e:
                 sys.stderr.write("ERROR: Job '%s' failed with '%s'.  Dropping...\n" %
                                  (str(job_id),str(e)))
             self.workq.task_done()
 
-    def addJob(self, job_id, args):
-        self.workq.put((job_id, args))
+    def addJob(self, job_id, args, job_key=None):
+        if job_key == None:
+            job_key = self.num_jobs
+        self.workq.put((job_key, job_id, args))
+        self.num_jobs += 1
             
     def wait(self):
         self.workq.join()
@@ -58,3 +69,186 @@ class WorkerThreads(object):
             self.workq.put(None)
         for w in self.workers:
             w.join()
+
+
+# Same interface as WorkerThreads, but jobs run in forked processes so
+# CPU-bound targets are not serialized by the GIL.  Workers inherit the
+# parent's memory (copy-on-write) at construction, so anything the target
+# reads, such as db population caches, should be loaded beforehand.  Job
+# arguments and results must be picklable.
+#
+# If given, setup(job_key) is called before each job, where job_key
+# defaults to the number of earlier addJob() calls.  Seeding per-job state
+# from it makes results independent of the number of workers and of which
+# worker ran a job.
+#
+# Each worker has its own job and result pipes, and the parent hands out
+# jobs one at a time and tracks which one each worker holds, so no lock is
+# shared between processes.  A worker that dies (OOM kill, segfault,
+# os._exit), whether mid-job or idle, is noticed by wait(): any job it held
+# is dropped like one that raised, and a replacement worker is forked in
+# its place.  Workers acknowledge each job as they start it; one sent to a
+# worker that died before starting it is sent to another instead.
+class WorkerProcesses(object):
+    resultq = None
+    target = None
+    setup = None
+
+    def __init__(self, num_workers, target, setup=None):
+        self._ctx = multiprocessing.get_context('fork')
+        self.resultq = queue.Queue()
+        self.target = target
+        self.setup = setup
+        self.num_jobs = 0
+        self._queued = collections.deque()
+        self._jobs = {}
+
+        self.workers = []
+        self._jobw = []
+        self._resultr = []
+        self._running = []
+        self._started = []
+        for i in range(num_workers):
+            self.workers.append(None)
+            self._jobw.append(None)
+            self._resultr.append(None)
+            self._running.append(None)
+            self._started.append(False)
+            self._spawn(i)
+
+    def _spawn(self, index):
+        jobr,jobw = self._ctx.Pipe(duplex=False)
+        resultr,resultw = self._ctx.Pipe(duplex=False)
+        p = self._ctx.Process(target=self._worker, args=(jobr, resultw))
+        p.daemon = True
+        p.start()
+        # The child's ends now exist only in that worker, so the parent
+        # sees EOF rather than a partial message if it dies mid-send.
+        jobr.close()
+        resultw.close()
+
+        self.workers[index] = p
+        self._jobw[index] = jobw
+        self._resultr[index] = resultr
+        self._running[index] = None
+        self._started[index] = False
+
+    def _worker(self, jobr, resultw):
+        while True:
+            try:
+                item = jobr.recv()
+            except EOFError:
+                break
+            if item == None:
+                break
+
+            seq,job_key,job_id,args = item
+            resultw.send((seq, None, None))
+            try:
+                if self.setup:
+                    self.setup(job_key)
+                resultw.send((seq, True, self.target(*args)))
+            except Exception as e:
+                sys.stderr.write("ERROR: Job '%s' failed with '%s'.  Dropping...\n" %
+                                 (str(job_id),str(e)))
+                resultw.send((seq, False, None))
+
+    def addJob(self, job_id, args, job_key=None):
+        if job_key == None:
+            job_key = self.num_jobs
+        self._jobs[self.num_jobs] = job_id
+        self._queued.append((self.num_jobs, job_key, job_id, args))
+        self.num_jobs += 1
+        self._dispatch()
+
+    # Reads the start acknowledgement and result, if sent, of the job
+    # worker index holds
+    def _collect(self, index):
+        conn = self._resultr[index]
+        while self._running[index] != None and conn.poll():
+            try:
+                seq,ok,result = conn.recv()
+            except EOFError:
+                break
+            if ok == None:
+                self._started[index] = True
+                continue
+            self._running[index] = None
+            job_id = self._jobs.pop(seq, None)
+            if ok:
+                self.resultq.put((job_id, result))
+
+    def _reap(self, index):
+        # A worker may have sent its last messages just before it exited
+        self._collect(index)
+        w = self.workers[index]
+        item = self._running[index]
+        if item != None and not self._started[index]:
+            self._queued.appendleft(item)
+            sys.stderr.write("WARNING: Worker process exited with code %s before starting job '%s'.\n"
+                             % (str(w.exitcode),str(item[2])))
+        elif item != None and item[0] in self._jobs:
+            job_id = self._jobs.pop(item[0])
+            sys.stderr.write("ERROR: Job '%s' lost when its worker exited with code %s.  Dropping...\n" %
+                             (str(job_id),str(w.exitcode)))
+        else:
+            sys.stderr.write("WARNING: Worker process exited with code %s between jobs.\n"
+                             % str(w.exitcode))
+        w.join()
+        self._jobw[index].close()
+        self._resultr[index].close()
+        self._spawn(index)
+
+    def _reapDead(self):
+        for i,w in enumerate(self.workers):
+            if w.exitcode != None:
+                self._reap(i)
+
+    # Sends queued jobs to idle workers
+    def _dispatch(self):
+        self._reapDead()
+        for i in range(len(self.workers)):
+            if not self._queued:
+                break
+            if self._running[i] != None:
+                continue
+            item = self._queued.popleft()
+            self._running[i] = item
+            self._started[i] = False
+            try:
+                self._jobw[i].send(item)
+            except OSError:
+                # Exited since it was reaped; requeue for the next round
+                self._running[i] = None
+                self._queued.appendleft(item)
+
+    def wait(self):
+        while self._jobs:
+            self._dispatch()
+            sentinels = [w.sentinel for w in self.workers]
+            multiprocessing.connection.wait(self._resultr+sentinels, timeout=1.0)
+
+            for i in range(len(self.workers)):
+                self._collect(i)
+            self._reapDead()
+
+    def __del__(self):
+        self.stop()
+
+    def stop(self):
+        if not self.workers:
+            return
+
+        self._queued.clear()
+        self._jobs = {}
+
+        for jobw in self._jobw:
+            try:
+                jobw.send(None)
+            except OSError:
+                pass
+        for w in self.workers:
+            w.join()
+        for conn in self._jobw+self._resultr:
+            conn.close()
+        self.workers = []
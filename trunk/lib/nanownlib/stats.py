@@ -5,7 +5,8 @@ import functools
 import math
 import statistics
 import gzip
-import random
+import bisect
+import collections
 try:
     import numpy
 except:
@@ -13,9 +14,6 @@ except:
     sys.stderr.write('       Under Debian, the package name is "python3-numpy"\n.')
     sys.exit(1)
 
-# Don't trust numpy's seeding
-numpy.random.seed(random.SystemRandom().randint(0,2**32-1))
-
 
 def mad(arr):
     """ Median Absolute Deviation: a "Robust" version of standard deviation.
@@ -156,47 +154,257 @@ def arctanWeights2(derived,trust,alpha):
     return weights
 
 
-def midsummary(values, distance=25):
+# Values already sorted along their last axis.  percentile() and median()
+# answer these by indexing instead of partitioning again.
+class presorted(object):
+    def __init__(self, values):
+        self.values = values
+
+
+def _sortedPercentile(values, q):
+    # Mirrors numpy.percentile's default 'linear' method so results are
+    # identical to calling it on the unsorted values.
+    scalar = numpy.ndim(q) == 0
+    q = numpy.true_divide(q, 100)
+    n = values.shape[-1]
+    virtual = numpy.atleast_1d((n-1)*q)
+    previous = numpy.floor(virtual)
+    next = previous+1
+    above = virtual >= n-1
+    previous[above] = -1
+    next[above] = -1
+    below = virtual < 0
+    previous[below] = 0
+    next[below] = 0
+    gamma = (virtual-previous).reshape((-1,)+(1,)*(values.ndim-1))
+
+    a = numpy.moveaxis(values[...,previous.astype(numpy.intp)], -1, 0)
+    b = numpy.moveaxis(values[...,next.astype(numpy.intp)], -1, 0)
+    diff = b - a
+    ret_val = numpy.add(a, diff*gamma)
+    numpy.subtract(b, diff*(1-gamma), out=ret_val, where=gamma >= 0.5)
+    ret_val = numpy.where(numpy.isnan(values[...,-1]), numpy.nan, ret_val)
+
+    if scalar:
+        ret_val = ret_val[0]
+    if ret_val.ndim == 0:
+        ret_val = ret_val[()]
+    return ret_val
+
+
+# Exact order statistics of a stream of values, optionally limited to the
+# last size values inserted (older values are removed first).  percentile()
+# and median() (and so the summary functions) accept one in place of an
+# array, and give the same results numpy would for the current values.
+#
+# Values are kept in sorted blocks of up to 2*load values, with a Fenwick
+# tree over the block sizes, so an insert, removal or order statistic costs
+# a few binary searches plus shifting values within one block.  Blocks are
+# split when full and dropped when emptied; either rebuilds the tree.
+class windowedQuantiles(object):
+    load = 256
+
+    def __init__(self, size=None, values=()):
+        self.size = size
+        self._fifo = collections.deque()
+        self._blocks = []
+        self._maxes = []
+        self._tree = None
+        self._len = 0
+        self._nans = 0
+        for v in values:
+            self.insert(v)
+
+    def __len__(self):
+        return len(self._fifo)
+
+    def _rebuildTree(self):
+        tree = [0]+[len(b) for b in self._blocks]
+        for i in range(1, len(tree)):
+            parent = i + (i & -i)
+            if parent < len(tree):
+                tree[parent] += tree[i]
+        self._tree = tree
+
+    def _treeAdd(self, block, delta):
+        if self._tree == None:
+            return
+        i = block+1
+        while i < len(self._tree):
+            self._tree[i] += delta
+            i += i & -i
+
+    # (block, position) of the k'th smallest value (from 0)
+    def _locate(self, k):
+        if self._tree == None:
+            self._rebuildTree()
+        tree = self._tree
+        block = 0
+        step = 1 << (len(tree).bit_length()-1)
+        while step > 0:
+            if block+step < len(tree) and tree[block+step] <= k:
+                block += step
+                k -= tree[block]
+            step >>= 1
+        return block,k
+
+    def insert(self, value):
+        value = float(value)
+        self._fifo.append(value)
+        if math.isnan(value):
+            self._nans += 1
+        elif len(self._blocks) == 0:
+            self._blocks.append([value])
+            self._maxes.append(value)
+            self._tree = None
+            self._len += 1
+        else:
+            i = min(bisect.bisect_left(self._maxes, value), len(self._blocks)-1)
+            block = self._blocks[i]
+            bisect.insort(block, value)
+            self._maxes[i] = block[-1]
+            self._len += 1
+            if len(block) > 2*self.load:
+                self._blocks[i:i+1] = [block[:self.load], block[self.load:]]
+                self._maxes[i:i+1] = [block[self.load-1], block[-1]]
+                self._tree = None
+            else:
+                self._treeAdd(i, 1)
+
+        if self.size != None and len(self._fifo) > self.size:
+            self.removeOldest()
+
+    def removeOldest(self):
+        value = self._fifo.popleft()
+        if math.isnan(value):
+            self._nans -= 1
+            return value
+
+        i = bisect.bisect_left(self._maxes, value)
+        block = self._blocks[i]
+        del block[bisect.bisect_left(block, value)]
+        self._len -= 1
+        if len(block) == 0:
+            del self._blocks[i]
+            del self._maxes[i]
+            self._tree = None
+        else:
+            self._maxes[i] = block[-1]
+            self._treeAdd(i, -1)
+        return value
+
+    def orderStatistic(self, k):
+        block,position = self._locate(k)
+        return self._blocks[block][position]
+
+    # Mirrors numpy.percentile's default 'linear' method
+    def percentile(self, q):
+        if self._len == 0 or self._nans > 0:
+            ret_val = numpy.full(numpy.shape(q), numpy.nan)
+            return ret_val[()] if ret_val.ndim == 0 else ret_val
+
+        ret_val = []
+        n = self._len
+        for quantile in numpy.atleast_1d(numpy.true_divide(q, 100)).tolist():
+            virtual = (n-1)*quantile
+            previous = math.floor(virtual)
+            if virtual >= n-1:
+                previous = next = n-1
+            elif virtual < 0:
+                previous = next = 0
+            else:
+                next = previous+1
+            gamma = virtual-previous
+            a = self.orderStatistic(previous)
+            b = self.orderStatistic(next)
+            if gamma >= 0.5:
+                ret_val.append(b - (b-a)*(1-gamma))
+            else:
+                ret_val.append(a + (b-a)*gamma)
+
+        if numpy.ndim(q) == 0:
+            return numpy.float64(ret_val[0])
+        return numpy.array(ret_val)
+
+    def median(self):
+        if self._len == 0 or self._nans > 0:
+            return numpy.nan
+        n = self._len
+        return numpy.mean((self.orderStatistic((n-1)//2), self.orderStatistic(n//2)))
+
+    def sorted(self):
+        if self._nans > 0:
+            return numpy.array([v for b in self._blocks for v in b]+[numpy.nan]*self._nans)
+        return numpy.array([v for b in self._blocks for v in b])
+
+
+def percentile(values, q, axis=None):
+    if isinstance(values, presorted):
+        return _sortedPercentile(values.values, q)
+    if isinstance(values, windowedQuantiles):
+        return values.percentile(q)
+    return numpy.percentile(values, q, axis=axis)
+
+
+def median(values, axis=None):
+    if isinstance(values, windowedQuantiles):
+        return values.median()
+    if isinstance(values, presorted):
+        v = values.values
+        n = v.shape[-1]
+        ret_val = numpy.mean(numpy.stack((v[...,(n-1)//2],v[...,n//2])), axis=0)
+        ret_val = numpy.where(numpy.isnan(v[...,-1]), numpy.nan, ret_val)
+        if ret_val.ndim == 0:
+            ret_val = ret_val[()]
+        return ret_val
+    return numpy.median(values, axis=axis)
+
+
+# The summary functions below take an optional axis so that many windows
+# (one per row) can be summarized in a single call.  values may also be
+# presorted, in which case axis is ignored and the last axis is used, or a
+# windowedQuantiles.
+def midsummary(values, distance=25, axis=None):
     #return (numpy.percentile(values, 50-distance) + numpy.percentile(values, 50+distance))/2.0
-    l,h = numpy.percentile(values, (50-distance,50+distance))
+    l,h = percentile(values, (50-distance,50+distance), axis=axis)
     return (l+h)/2.0
 
-def trimean(values, distance=25):
-    return (midsummary(values, distance) + statistics.median(values))/2
+def trimean(values, distance=25, axis=None):
+    return (midsummary(values, distance, axis) + median(values, axis=axis))/2
 
-def ubersummary(values, distance=25):
+def ubersummary(values, distance=25, axis=None):
     left2 = 50-distance
     left3 = 50-(distance/2.0)
     left1 = left2/2.0
     right2 = 50+distance
     right3 = 50+(distance/2.0)
     right1 = (right2+100)/2.0
-    l1,l2,l3,r3,r2,r1 = numpy.percentile(values, (left1,left2,left3,right3,right2,right1))
+    l1,l2,l3,r3,r2,r1 = percentile(values, (left1,left2,left3,right3,right2,right1), axis=axis)
     #print(l1,l2,l3,m,r3,r2,r1)
     return (l1+l2*4+l3+r3+r2*4+r1)/12.0
     #return statistics.mean((l1,l2,l3,m,r3,r2,r1))
 
     
-def quadsummary(values, distance=25):
+def quadsummary(values, distance=25, axis=None):
     left1 = 50-distance
     left2 = (left1+50)/2.0
     right1 = 50+distance
     right2 = (right1+50)/2.0
-    l1,l2,r2,r1 = numpy.percentile(values, (left1,left2,right2,right1))
+    l1,l2,r2,r1 = percentile(values, (left1,left2,right2,right1), axis=axis)
     #print(left1,left2,left3,50,right3,right2,right1)
     #print(l1,l2,l3,m,r3,r2,r1)
     return (l1+l2+r2+r1)/4.0
     #return statistics.mean((l1,l2,l3,m,r3,r2,r1))
 
     
-def septasummary(values, distance=25):
+def septasummary(values, distance=25, axis=None):
     left2 = 50-distance
     left3 = 50-(distance/2.0)
     left1 = left2/2.0
     right2 = 50+distance
     right3 = 50+(distance/2.0)
     right1 = (right2+100)/2.0
-    l1,l2,l3,m,r3,r2,r1 = numpy.percentile(values, (left1,left2,left3,50,right3,right2,right1))
+    l1,l2,l3,m,r3,r2,r1 = percentile(values, (left1,left2,left3,50,right3,right2,right1), axis=axis)
     return (l1+l2+l3+m+r3+r2+r1)/7.0
 
 
@@ -233,12 +441,104 @@ def estimateMeanTsval(trustFunc, weightFunc, alpha, derived):
     return weightedMeanTsval(derived, weights)
 
 
+# Sorted copies of every window of a given size over one population
+# column, keyed by window offset and filled in as offsets are requested.
+# Windows wrap around the end of the population as in db.subseries().
+class sortedWindows(object):
+    def __init__(self, values, size):
+        self.values = values
+        self.size = size
+        self.rows = {}
+
+    def fill(self, offsets=None):
+        if offsets is None:
+            offsets = range(len(self.values))
+        missing = numpy.array([o for o in set(offsets) if o not in self.rows], dtype=numpy.int64)
+        if len(missing) == 0:
+            return
+        block = numpy.sort(self.values[(missing[:,numpy.newaxis] + numpy.arange(self.size)) % len(self.values)],
+                           axis=1)
+        self.rows.update(zip(missing.tolist(), block))
+
+    def __getitem__(self, offsets):
+        offsets = offsets.tolist()
+        self.fill(offsets)
+        return numpy.stack([self.rows[o] for o in offsets])
+
+    def __len__(self):
+        return len(self.rows)*self.size
+
+
+# Recently used sortedWindows, shared by every estimator (and classifier)
+# that bootstraps over the same population and window size.  Evicted
+# oldest first once they hold more than sorted_windows_limit values.
+sorted_windows_limit = 2**24
+_sorted_windows = collections.OrderedDict()
+
+def windowCache(values, size):
+    key = (id(values), size)
+    cache = _sorted_windows.get(key)
+    if cache == None or cache.values is not values:
+        cache = sortedWindows(values, size)
+        _sorted_windows[key] = cache
+    _sorted_windows.move_to_end(key)
+
+    total = sum(len(c) for c in _sorted_windows.values())
+    while total > sorted_windows_limit and len(_sorted_windows) > 1:
+        key,oldest = _sorted_windows.popitem(last=False)
+        total -= len(oldest)
+    return cache
+
+
+# Population columns gathered through a 2-D index matrix, so that
+# windows['unusual_packet'][t] is the t'th bootstrap window and
+# windows.sorted('unusual_packet') is the same windows, each sorted.
+class subseriesWindows(object):
+    def __init__(self, population, indices):
+        self.population = population
+        self.indices = indices
+        self._columns = {}
+        self._sorted = {}
+
+    def __getitem__(self, column):
+        if column not in self._columns:
+            self._columns[column] = self.population[column][self.indices]
+        return self._columns[column]
+
+    def sorted(self, column):
+        if column not in self._sorted:
+            cache = windowCache(self.population[column], self.indices.shape[1])
+            self._sorted[column] = presorted(cache[self.indices[:,0]])
+        return self._sorted[column]
+
+    def __len__(self):
+        return self.indices.shape[0]
+
+
+# Maps a per-window estimator to a version that evaluates every window of
+# a subseriesWindows at once, returning one result per window.
+_batch_estimators = {}
+
+def batchEstimator(estimator):
+    if isinstance(estimator, functools.partial):
+        batch = batchEstimator(estimator.func)
+        if batch == None:
+            return None
+        return functools.partial(batch, *estimator.args, **estimator.keywords)
+    return _batch_estimators.get(estimator)
+
+
+# Windows are drawn with db.rng, so seeding the db makes results reproducible.
 def bootstrap3(estimator, db, probe_type, unusual_case, subseries_size, num_trials):
-    ret_val = []
-    for t in range(num_trials):
-        ret_val.append(estimator(db.subseries(probe_type, unusual_case, subseries_size)))
+    indices = db.subseriesIndices(probe_type, unusual_case, subseries_size, num_trials)
 
-    return ret_val
+    batch = batchEstimator(estimator)
+    if batch != None:
+        windows = subseriesWindows(db.populationArrays(probe_type, unusual_case), indices)
+        return batch(windows).tolist()
+
+    population = db.subseries(probe_type, unusual_case, offset=0)
+    return [estimator([population[i] for i in window]) for window in indices]
 
 
 # Returns 1 if unusual_case is unusual in the expected direction
@@ -264,11 +564,55 @@ def multiBoxTest(params, greater, samples):
         
     return 0
 
+def multiBoxTestBatch(params, greater, windows):
+    uc_high,uc_low = percentile(windows.sorted('unusual_packet'), (params['high'],params['low']))
+    rest_high,rest_low = percentile(windows.sorted('other_packet'), (params['high'],params['low']))
+
+    expected = 1 if greater else -1
+    return numpy.where(uc_high < rest_low, -expected,
+                       numpy.where(rest_high < uc_low, expected, 0))
+
+_batch_estimators[multiBoxTest] = multiBoxTestBatch
+
+
+# multiBoxTest for many (low, high) boxes, each over its own windows.
+# offsets[k] holds the offsets (as in db.subseriesIndices) of the windows
+# of the given size that boxes[k] is tested on, and the result has the
+# same shape as offsets.  Every percentile any box needs is computed once
+# per distinct window, in one pass over its sorted values, and the boxes
+# are then compared as arrays.
+def multiBoxTestSurface(boxes, greater, population, size, offsets):
+    q,box_q = numpy.unique(numpy.asarray(boxes, dtype=float), return_inverse=True)
+    box_q = box_q.reshape(-1,1,2)
+    windows,rows = numpy.unique(offsets, return_inverse=True)
+    rows = rows.reshape(numpy.shape(offsets))
+
+    surfaces = []
+    step = max(1, 2**20//size)
+    for column in ('unusual_packet','other_packet'):
+        cache = windowCache(population[column], size)
+        surface = numpy.empty((len(q),len(windows)))
+        for i in range(0, len(windows), step):
+            surface[:,i:i+step] = percentile(presorted(cache[windows[i:i+step]]), q).reshape(len(q),-1)
+        surfaces.append(surface)
+    uc,rest = surfaces
+
+    uc_low,uc_high = uc[box_q[...,0],rows],uc[box_q[...,1],rows]
+    rest_low,rest_high = rest[box_q[...,0],rows],rest[box_q[...,1],rows]
+    expected = 1 if greater else -1
+    return numpy.where(uc_high < rest_low, -expected,
+                       numpy.where(rest_high < uc_low, expected, 0))
+
 
 # Returns 1 if unusual_case is unusual in the expected direction
 #         0 otherwise
+# samples may also be a windowedQuantiles of the differences, such as one
+# updated as samples arrive.
 def summaryTest(f, params, greater, samples):
-    diffs = [s['unusual_packet']-s['other_packet'] for s in samples]
+    if isinstance(samples, windowedQuantiles):
+        diffs = samples
+    else:
+        diffs = [s['unusual_packet']-s['other_packet'] for s in samples]
 
     mh = f(diffs, params['distance'])
     #print("estimate:", mh)
@@ -283,6 +627,15 @@ def summaryTest(f, params, greater, samples):
         else:
             return 0
 
+def summaryTestBatch(f, params, greater, windows):
+    mh = f(windows.sorted('packet_diff'), params['distance'])
+    if greater:
+        return (mh > params['threshold']).astype(int)
+    else:
+        return (mh < params['threshold']).astype(int)
+
+_batch_estimators[summaryTest] = summaryTestBatch
+
 
 midsummaryTest = functools.partial(summaryTest, midsummary)
 trimeanTest = functools.partial(summaryTest, trimean)
@@ -290,6 +643,85 @@ ubersummaryTest = functools.partial(summaryTest, ubersummary)
 quadsummaryTest = functools.partial(summaryTest, quadsummary)
 septasummaryTest = functools.partial(summaryTest, septasummary)
 
+# Sequential probability ratio test (SPRT) over one paired-difference
+# column (params['column'], e.g. packet_diff or client_diff; see trainSPRT).
+# Each difference falls into one of the bins split at params['edges'] and
+# adds that bin's log likelihood ratio (params['llr'], unusual vs. null) to
+# a running total.  Sampling stops, deciding 1, once the total reaches
+# log((1-beta)/alpha), or deciding 0 once it falls to log(beta/(1-alpha)),
+# where alpha and beta are the tolerated false positive and false negative
+# rates.  A run of samples that ends before either bound is decided by the
+# sign of the total.  Missing (nan) differences are skipped.
+def sprtBounds(params):
+    return (math.log(params['beta']/(1.0-params['alpha'])),
+            math.log((1.0-params['beta'])/params['alpha']))
+
+def sprtIncrements(params, diffs):
+    diffs = numpy.asarray(diffs, dtype=float)
+    llr = numpy.asarray(params['llr'])[numpy.searchsorted(params['edges'], diffs, side='right')]
+    return numpy.where(numpy.isnan(diffs), 0.0, llr)
+
+def sprtDiff(column, sample):
+    name = column[:-len('_diff')]
+    return sample['unusual_'+name]-sample['other_'+name]
+
+# Decisions and stopping points (number of samples used) for each row of
+# diffs, a 2-D array of differences in sampling order
+def sprtDecisions(params, diffs):
+    lower,upper = sprtBounds(params)
+    total = numpy.cumsum(sprtIncrements(params, numpy.atleast_2d(diffs)), axis=1)
+    if total.shape[1] == 0:
+        # No observations, so no evidence either way
+        return numpy.zeros(total.shape[0], dtype=int),numpy.zeros(total.shape[0], dtype=int)
+    crossed = (total >= upper) | (total <= lower)
+    stopped = crossed.any(axis=1)
+    stop = numpy.where(stopped, crossed.argmax(axis=1), total.shape[1]-1)
+    decided = total[numpy.arange(len(stop)),stop]
+    decisions = numpy.where(stopped, decided >= upper, decided > 0).astype(int)
+    return decisions,stop+1
+
+# Returns 1 if unusual_case is unusual, 0 otherwise.  The direction
+# (greater) is implied by the trained likelihood ratios.
+def sprtTest(params, greater, samples):
+    diffs = [sprtDiff(params['column'], s) for s in samples]
+    return int(sprtDecisions(params, [diffs])[0][0])
+
+def sprtTestBatch(params, greater, windows):
+    return sprtDecisions(params, windows[params['column']])[0]
+
+_batch_estimators[sprtTest] = sprtTestBatch
+
+
+# Online form of sprtTest: feed each sample's difference to update() as it
+# is collected.  update() returns None until a decision (1 or 0) is reached,
+# then the decision.  With max_observations, the decision is forced (by the
+# sign of the total) once that many samples have been seen.
+class sequentialTest(object):
+    params = None
+    max_observations = None
+    total = 0.0
+    observations = 0
+    decision = None
+
+    def __init__(self, params, max_observations=None):
+        self.params = params
+        self.max_observations = max_observations
+        self.lower,self.upper = sprtBounds(params)
+
+    def update(self, diff):
+        if self.decision != None:
+            return self.decision
+        self.observations += 1
+        self.total += float(sprtIncrements(self.params, [diff])[0])
+        if self.total >= self.upper:
+            self.decision = 1
+        elif self.total <= self.lower:
+            self.decision = 0
+        elif self.max_observations != None and self.observations >= self.max_observations:
+            self.decision = int(self.total > 0)
+        return self.decision
+
+
 def rmse(expected, measurements):
     s = sum([(expected-m)**2 for m in measurements])/len(measurements)
     return math.sqrt(s)
@@ -334,6 +766,25 @@ def kfilter(params, observations):
     return({'est':est, 'var':var})
 
 
+# Final kfilter estimates for every row of observations (one window per
+# row) at once.  With no movement, the variance never depends on the
+# observations, so each step is a few array operations across all rows,
+# and the results are the same as kfilter's for each row.  x0 (one
+# initial state per row) defaults to each row's quadsummary.
+def kfilterBatch(params, observations, x0=None):
+    x = numpy.atleast_2d(numpy.asarray(observations, dtype=float))
+    if x0 is None:
+        x0 = quadsummary(x, axis=-1)
+    est = numpy.array(x0, dtype=float)
+    P = numpy.full(x.shape[0], 10.0)
+    R = numpy.std(x, axis=-1)
+    for d in x.T:
+        est = (P*d + est*R)/(P+R)
+        P = 1./(1./P + 1./R)
+
+    return est
+
+
 def kalmanTest(params, greater, samples):
     diffs = [s['unusual_packet']-s['other_packet'] for s in samples]
 
@@ -349,6 +800,15 @@ def kalmanTest(params, greater, samples):
         else:
             return 0
 
+def kalmanTestBatch(params, greater, windows):
+    m = kfilterBatch(params, windows['packet_diff'], quadsummary(windows.sorted('packet_diff')))
+    if greater:
+        return (m > params['threshold']).astype(int)
+    else:
+        return (m < params['threshold']).astype(int)
+
+_batch_estimators[kalmanTest] = kalmanTestBatch
+
 
 def tsvalwmeanTest(params, greater, samples):
     m = tsvalwmean(samples)
@@ -364,17 +824,150 @@ def tsvalwmeanTest(params, greater, samples):
             return 0
 
 
-from pykalman import KalmanFilter
-def pyKalman4DTest(params, greater, samples):
-    kp = params['kparams']
-    #kp['initial_state_mean']=[quadsummary([s['unusual_packet'] for s in samples]),
-    #                          quadsummary([s['other_packet'] for s in samples]),
-    #                          numpy.mean([s['unusual_tsval'] for s in samples]),
-    #                          numpy.mean([s['other_tsval'] for s in samples])]
-    kf = KalmanFilter(n_dim_obs=4, n_dim_state=4, **kp)
-    smooth,covariance = kf.smooth([(s['unusual_packet'],s['other_packet'],s['unusual_tsval'],s['other_tsval'])
-                                   for s in samples])
-    m = numpy.mean(smooth)
+# Linear-Gaussian state space model of samples, observing the columns in
+# kalman4d_columns, with one state per column:
+#   x[t] = transition_matrices x[t-1] + transition_offsets + noise
+#   y[t] = observation_matrices x[t] + observation_offsets + noise
+# where the noise has transition_covariance and observation_covariance,
+# and x[0] has initial_state_mean and initial_state_covariance.  Parameter
+# names follow pykalman's, but only numpy is used.
+#
+# Filtering and smoothing use steady-state gains: those the filter and
+# smoother converge to over a long series.  With them, each step is a
+# fixed linear map, so many windows can be run at once for little more
+# than the cost of one.
+kalman4d_columns = ('unusual_packet','other_packet','unusual_tsval','other_tsval')
+
+def _kalman4dArrays(params):
+    return tuple(numpy.array(params[k], dtype=float)
+                 for k in ('transition_matrices','transition_offsets','transition_covariance',
+                           'observation_matrices','observation_offsets','observation_covariance',
+                           'initial_state_mean','initial_state_covariance'))
+
+
+# Returns the steady-state filter gain K, smoother gain J and smoothed
+# state covariance, iterating the covariance recursions until they settle.
+def kalman4dGains(params, max_iterations=10000, tolerance=1e-10):
+    A,b,Q,C,d,R,mu0,V0 = _kalman4dArrays(params)
+    P = V0
+    for i in range(max_iterations):
+        predicted = A.dot(P).dot(A.T) + Q
+        K = numpy.linalg.solve(C.dot(predicted).dot(C.T) + R, C.dot(predicted)).T
+        filtered = predicted - K.dot(C).dot(predicted)
+        filtered = (filtered+filtered.T)/2.0
+        converged = numpy.allclose(filtered, P, rtol=tolerance, atol=0.0)
+        P = filtered
+        if converged:
+            break
+
+    predicted = A.dot(P).dot(A.T) + Q
+    J = numpy.linalg.solve(predicted, A.dot(P)).T
+    smoothed = P
+    for i in range(max_iterations):
+        new = P + J.dot(smoothed - predicted).dot(J.T)
+        new = (new+new.T)/2.0
+        converged = numpy.allclose(new, smoothed, rtol=tolerance, atol=0.0)
+        smoothed = new
+        if converged:
+            break
+
+    return K,J,smoothed
+
+
+# Filtered and smoothed state means for observations of shape
+# (..., time, column), so a stack of windows is run in one call.
+def kalman4dSmooth(params, observations, gains=None):
+    if gains == None:
+        gains = kalman4dGains(params)
+    A,b,Q,C,d,R,mu0,V0 = _kalman4dArrays(params)
+    K,J,smoothed_covariance = gains
+    I = numpy.identity(len(b))
+
+    # x[t|t] = F x[t-1|t-1] + u[t], then x[t|n] = v[t] + J x[t+1|n]
+    y = numpy.asarray(observations, dtype=float)
+    F = (I - K.dot(C)).dot(A)
+    filtered = (y - d).dot(K.T) + (I - K.dot(C)).dot(b)
+    filtered[...,0,:] = (I - K.dot(C)).dot(mu0) + (y[...,0,:] - d).dot(K.T)
+    for t in range(1, y.shape[-2]):
+        filtered[...,t,:] += filtered[...,t-1,:].dot(F.T)
+
+    smoothed = filtered.dot((I - J.dot(A)).T) - J.dot(b)
+    smoothed[...,-1,:] = filtered[...,-1,:]
+    for t in range(y.shape[-2]-2, -1, -1):
+        smoothed[...,t,:] += smoothed[...,t+1,:].dot(J.T)
+
+    return filtered,smoothed
+
+
+# Mean smoothed difference between the unusual and other packet RTT
+# states, for each window
+def kalman4dEstimate(params, observations, gains=None):
+    filtered,smoothed = kalman4dSmooth(params, observations, gains)
+    return numpy.mean(smoothed[...,0]-smoothed[...,1], axis=-1)
+
+
+# Fits parameters to observations (rows of kalman4d_columns, in time order)
+# by expectation-maximization, starting from params if given.  The E-step
+# uses steady-state gains, which suits series much longer than it takes
+# the covariances to settle.  Noise variances are kept above a small
+# fraction of each column's variance (or 1.0), so that constant columns,
+# such as coarse TCP timestamps on fast networks, don't make them
+# singular.
+def kalman4dEM(observations, n_iter=10, params=None):
+    y = numpy.asarray(observations, dtype=float)
+    n,dim = y.shape
+    floor = numpy.diag(numpy.maximum(numpy.var(y, axis=0)*1e-6, 1.0))
+    if params == None:
+        covariance = numpy.cov(y.T) + floor
+        params = {'transition_matrices':numpy.identity(dim),
+                  'transition_offsets':numpy.zeros(dim),
+                  'transition_covariance':covariance/2.0,
+                  'observation_matrices':numpy.identity(dim),
+                  'observation_offsets':numpy.zeros(dim),
+                  'observation_covariance':covariance/2.0,
+                  'initial_state_mean':numpy.mean(y, axis=0),
+                  'initial_state_covariance':covariance}
+
+    ones = numpy.ones((n,1))
+    for i in range(n_iter):
+        gains = kalman4dGains(params)
+        K,J,Ps = gains
+        filtered,m = kalman4dSmooth(params, y, gains)
+        m1 = numpy.hstack((m, ones))
+
+        # Observations: regress y[t] on (x[t], 1)
+        Sxx = m1.T.dot(m1)
+        Sxx[:dim,:dim] += n*Ps
+        Cd = numpy.linalg.solve(Sxx, m1.T.dot(y)).T
+        C,d = Cd[:,:dim],Cd[:,dim]
+        residuals = y - m.dot(C.T) - d
+        R = residuals.T.dot(residuals)/n + C.dot(Ps).dot(C.T)
+
+        # Transitions: regress x[t] on (x[t-1], 1)
+        S00 = m1[:-1].T.dot(m1[:-1])
+        S00[:dim,:dim] += (n-1)*Ps
+        S10 = m[1:].T.dot(m1[:-1])
+        S10[:,:dim] += (n-1)*Ps.dot(J.T)
+        S11 = m[1:].T.dot(m[1:]) + (n-1)*Ps
+        Ab = numpy.linalg.solve(S00, S10.T).T
+        A,b = Ab[:,:dim],Ab[:,dim]
+        Q = (S11 - Ab.dot(S10.T))/(n-1)
+
+        params = {'transition_matrices':A,
+                  'transition_offsets':b,
+                  'transition_covariance':(Q+Q.T)/2.0 + floor,
+                  'observation_matrices':C,
+                  'observation_offsets':d,
+                  'observation_covariance':(R+R.T)/2.0 + floor,
+                  'initial_state_mean':m[0],
+                  'initial_state_covariance':Ps}
+
+    return {k:numpy.asarray(v).tolist() for k,v in params.items()}
+
+
+def kalman4dTest(params, greater, samples):
+    observations = [[s[c] for c in kalman4d_columns] for s in samples]
+    m = kalman4dEstimate(params['kparams'], observations)
     if greater:
         if m > params['threshold']:
             return 1
@@ -385,4 +978,14 @@ def pyKalman4DTest(params, greater, samples):
             return 1
         else:
             return 0
+
+def kalman4dTestBatch(params, greater, windows):
+    observations = numpy.stack([windows[c] for c in kalman4d_columns], axis=-1)
+    m = kalman4dEstimate(params['kparams'], observations)
+    if greater:
+        return (m > params['threshold']).astype(int)
+    else:
+        return (m < params['threshold']).astype(int)
+
+_batch_estimators[kalman4dTest] = kalman4dTestBatch
     
@@ -2,8 +2,7 @@
 
 import sys
 import os
-import uuid
-import random
+import time
 import threading
 import sqlite3
 try:
@@ -13,11 +12,115 @@ except:
     sys.stderr.write('       Under Debian, the package name is "python3-numpy"\n.')
     sys.exit(1)
 
-# Don't trust numpy's seeding
-numpy.random.seed(random.SystemRandom().randint(0,2**32-1))
+# Version 1 databases used random BLOB ids; version 2 uses rowids (INTEGER
+# PRIMARY KEY) and indexes the common access paths.  Older databases are
+# migrated in place when opened.
+SCHEMA_VERSION = 2
 
-def _newid():
-    return uuid.uuid4().hex
+# Each table's CREATE statement, with its name left as %s
+_tables = (
+    ('meta', """CREATE TABLE %s (id INTEGER PRIMARY KEY,
+                                 tcpts_mean REAL,
+                                 tcpts_stddev REAL,
+                                 tcpts_slopes TEXT,
+                                 unusual_case TEXT,
+                                 greater INTEGER,
+                                 schema_version INTEGER)
+             """),
+    # client_* are client-side timestamps (time.perf_counter_ns) of each
+    # probe's connection: connect start/end, first byte written, first and
+    # last bytes received.  request_seq is the position of each probe's
+    # request on a persistent (keep-alive) connection, starting at 0; NULL
+    # when each probe had its own.  userspace_rtt runs from connect start
+    # to last read, except with keep-alive, where it runs from first write
+    # to last read for every request.
+    ('probes', """CREATE TABLE %s (id INTEGER PRIMARY KEY,
+                                   sample INTEGER,
+                                   test_case TEXT,
+                                   type TEXT,
+                                   tc_order INTEGER,
+                                   time_of_day INTEGER,
+                                   local_port INTEGER,
+                                   reported INTEGER,
+                                   userspace_rtt INTEGER,
+                                   client_connect_start INTEGER,
+                                   client_connect_end INTEGER,
+                                   client_first_write INTEGER,
+                                   client_first_read INTEGER,
+                                   client_last_read INTEGER,
+                                   request_seq INTEGER,
+                                   UNIQUE (sample, test_case))
+               """),
+    ('packets', """CREATE TABLE %s (id INTEGER PRIMARY KEY,
+                                    probe_id INTEGER REFERENCES probes(id) ON DELETE CASCADE,
+                                    sent INTEGER,
+                                    observed INTEGER,
+                                    tsval INTEGER,
+                                    payload_len INTEGER,
+                                    tcpseq INTEGER,
+                                    tcpack INTEGER)
+                """),
+    ('analysis', """CREATE TABLE %s (id INTEGER PRIMARY KEY,
+                                     probe_id INTEGER UNIQUE REFERENCES probes(id) ON DELETE CASCADE,
+                                     suspect TEXT,
+                                     packet_rtt INTEGER,
+                                     tsval_rtt INTEGER)
+                 """),
+    ('trim_analysis', """CREATE TABLE %s (id INTEGER PRIMARY KEY,
+                                          probe_id INTEGER REFERENCES probes(id) ON DELETE CASCADE,
+                                          suspect TEXT,
+                                          packet_rtt INTEGER,
+                                          tsval_rtt INTEGER,
+                                          sent_trimmed INTEGER,
+                                          rcvd_trimmed INTEGER)
+                      """),
+    ('classifier_results', """CREATE TABLE %s (id INTEGER PRIMARY KEY,
+                                               classifier TEXT,
+                                               trial_type TEXT,
+                                               num_observations INTEGER,
+                                               num_trials INTEGER,
+                                               params TEXT,
+                                               false_positives REAL,
+                                               false_negatives REAL)
+                           """),
+    # Statistics reported by nanown-listen during each sampling run.
+    # Counters are cumulative within a run; the row with final=1 holds the
+    # totals.  latency_* (ns between a packet's timestamp and its
+    # processing) cover only the interval since the previous row.
+    ('capture_stats', """CREATE TABLE %s (id INTEGER PRIMARY KEY,
+                                          sample_type TEXT,
+                                          time_of_day INTEGER,
+                                          final INTEGER,
+                                          capture_method TEXT,
+                                          buffer_size INTEGER,
+                                          immediate INTEGER,
+                                          timeout INTEGER,
+                                          tstamp_source TEXT,
+                                          nano_precision INTEGER,
+                                          received INTEGER,
+                                          dropped INTEGER,
+                                          ifdropped INTEGER,
+                                          captured INTEGER,
+                                          latency_mean INTEGER,
+                                          latency_max INTEGER,
+                                          ring_capacity INTEGER,
+                                          ring_used INTEGER,
+                                          ring_high_water INTEGER,
+                                          ring_dropped INTEGER)
+                      """),
+)
+
+_indexes = (
+    # populationSize, findUnusualTestCase, _buildSamplePairs
+    "CREATE INDEX IF NOT EXISTS probes_type ON probes (type, test_case, sample)",
+    # _loadProbeIntervals, keepAliveConnections
+    "CREATE INDEX IF NOT EXISTS probes_port ON probes (local_port, time_of_day)",
+    # analyzeProbes, splitKeepAliveConnections
+    "CREATE INDEX IF NOT EXISTS packets_probe ON packets (probe_id)",
+    # fetchClassifierResult, deleteClassifierResults
+    "CREATE INDEX IF NOT EXISTS classifier_results_lookup"
+    " ON classifier_results (classifier, trial_type, num_observations)",
+)
 
 
 class db(threading.local):
@@ -25,81 +128,142 @@ class db(threading.local):
     cursor = None
     _population_sizes = None
     _population_cache = None
+    _array_cache = None
     _offset_cache = None
     _cur_offsets = None
-    
-    def __init__(self, path):
+    _skip_offsets = 0
+    rng = None
+
+    # seed is passed to numpy.random.default_rng.  Each thread gets its own
+    # generator from the same seed, so a given seed reproduces the same
+    # subseries offsets (and anything else drawn from db.rng).
+    #
+    # journal_mode, synchronous and cache_size set the SQLite pragmas of the
+    # same names (on each thread's connection) when not None.  The sampler
+    # uses WAL with synchronous=NORMAL, so commits don't wait on fsync and
+    # readers (e.g. streamingAssociator) don't block the writer.
+    def __init__(self, path, seed=None, journal_mode=None, synchronous=None, cache_size=None):
         exists = os.path.exists(path)
         self.conn = sqlite3.connect(path)
         self.conn.execute("PRAGMA foreign_keys = ON;")
+        if journal_mode != None:
+            self.conn.execute("PRAGMA journal_mode = %s;" % journal_mode)
+        if synchronous != None:
+            self.conn.execute("PRAGMA synchronous = %s;" % synchronous)
+        if cache_size != None:
+            self.conn.execute("PRAGMA cache_size = %d;" % cache_size)
         self.conn.row_factory = sqlite3.Row
+        self.rng = numpy.random.default_rng(seed)
         self._population_sizes = {}
         self._population_cache = {}
+        self._array_cache = {}
         self._offset_cache = {}
         self._cur_offsets = {}
         
         if not exists:
-            self.conn.execute(
-                """CREATE TABLE meta (id BLOB PRIMARY KEY,
-                                      tcpts_mean REAL,
-                                      tcpts_stddev REAL,
-                                      tcpts_slopes TEXT,
-                                      unusual_case TEXT,
-                                      greater INTEGER)
-                """)
-
-            self.conn.execute(
-                """CREATE TABLE probes (id BLOB PRIMARY KEY,
-                                        sample INTEGER,
-                                        test_case TEXT,
-                                        type TEXT,
-                                        tc_order INTEGER,
-                                        time_of_day INTEGER,
-                                        local_port INTEGER,
-                                        reported INTEGER,
-                                        userspace_rtt INTEGER,
-                                        UNIQUE (sample, test_case))
-                """)
-
-            self.conn.execute(
-                """CREATE TABLE packets (id BLOB PRIMARY KEY,
-                                         probe_id REFERENCES probes(id) ON DELETE CASCADE,
-                                         sent INTEGER,
-                                         observed INTEGER,
-                                         tsval INTEGER,
-                                         payload_len INTEGER,
-                                         tcpseq INTEGER,
-                                         tcpack INTEGER)
-                """)
-
-            self.conn.execute(
-                """CREATE TABLE analysis (id BLOB PRIMARY KEY,
-                                          probe_id UNIQUE REFERENCES probes(id) ON DELETE CASCADE,
-                                          suspect TEXT,
-                                          packet_rtt INTEGER,
-                                          tsval_rtt INTEGER)
-                """)
-
-            self.conn.execute(
-                """CREATE TABLE trim_analysis (id BLOB PRIMARY KEY,
-                                               probe_id REFERENCES probes(id) ON DELETE CASCADE,
-                                               suspect TEXT,
-                                               packet_rtt INTEGER,
-                                               tsval_rtt INTEGER,
-                                               sent_trimmed INTEGER,
-                                               rcvd_trimmed INTEGER)
-                """)
-
-            self.conn.execute(
-                """CREATE TABLE classifier_results (id BLOB PRIMARY KEY,
-                                                    classifier TEXT,
-                                                    trial_type TEXT,
-                                                    num_observations INTEGER,
-                                                    num_trials INTEGER,
-                                                    params TEXT,
-                                                    false_positives REAL,
-                                                    false_negatives REAL)
-                """)
+            for name,ddl in _tables:
+                self.conn.execute(ddl % name)
+            self.conn.execute("INSERT INTO meta (schema_version) VALUES (?)", (SCHEMA_VERSION,))
+
+        self._upgradeSchema()
+
+    def _addMissingColumns(self, table, columns):
+        existing = [row[1] for row in self.conn.execute("PRAGMA table_info(%s)" % table)]
+        missing = [(c,t) for c,t in columns if c not in existing]
+        for column,column_type in missing:
+            self.conn.execute("ALTER TABLE %s ADD COLUMN %s %s" % (table, column, column_type))
+        return len(missing) > 0
+
+    def schemaVersion(self):
+        columns = [row[1] for row in self.conn.execute("PRAGMA table_info(meta)")]
+        if 'schema_version' not in columns:
+            return 1
+        version = self.conn.execute("SELECT max(schema_version) FROM meta").fetchone()[0]
+        return version if version != None else 1
+
+    # Rebuilds every table from _tables in place, giving each row its old
+    # rowid as its id and mapping probe_id references to match.  Columns the
+    # old tables lack are left NULL.
+    def _migrateToV2(self):
+        sys.stderr.write("INFO: upgrading database to schema version %d...\n" % SCHEMA_VERSION)
+        self.conn.commit()
+        # Dropping the old tables must not cascade
+        self.conn.execute("PRAGMA foreign_keys = OFF;")
+        existing = set(row[0] for row in self.conn.execute("SELECT name FROM sqlite_master WHERE type='table'"))
+        self.conn.execute("DROP TABLE IF EXISTS temp.probe_ids")
+        self.conn.execute("CREATE TEMP TABLE probe_ids (old PRIMARY KEY, new INTEGER)")
+        if 'probes' in existing:
+            self.conn.execute("INSERT INTO probe_ids SELECT id,rowid FROM probes")
+
+        for name,ddl in _tables:
+            self.conn.execute(ddl % (name+'_v2'))
+            if name in existing:
+                old_columns = set(row[1] for row in self.conn.execute("PRAGMA table_info(%s)" % name))
+                columns = [row[1] for row in self.conn.execute("PRAGMA table_info(%s_v2)" % name)
+                           if row[1] in old_columns and row[1] not in ('id','probe_id')]
+                selected = ['o.rowid'] + ['o.'+c for c in columns]
+                if 'probe_id' in old_columns:
+                    columns.append('probe_id')
+                    selected.append('(SELECT new FROM probe_ids WHERE old=o.probe_id)')
+                self.conn.execute("INSERT INTO %s_v2 (id,%s) SELECT %s FROM %s o ORDER BY o.rowid"
+                                  % (name, ','.join(columns), ','.join(selected), name))
+                self.conn.execute("DROP TABLE %s" % name)
+            self.conn.execute("ALTER TABLE %s_v2 RENAME TO %s" % (name, name))
+
+        if self.conn.execute("SELECT count(*) FROM meta").fetchone()[0] == 0:
+            self.conn.execute("INSERT INTO meta (schema_version) VALUES (?)", (SCHEMA_VERSION,))
+        else:
+            self.conn.execute("UPDATE meta SET schema_version=?", (SCHEMA_VERSION,))
+        self.conn.execute("DROP TABLE temp.probe_ids")
+        self.conn.commit()
+        self.conn.execute("PRAGMA foreign_keys = ON;")
+        self.conn.execute("VACUUM")
+    
+    def _upgradeSchema(self):
+        if self.schemaVersion() < SCHEMA_VERSION:
+            self._migrateToV2()
+        for index in _indexes:
+            self.conn.execute(index)
+        
+        # Per-sample unusual vs. other case values, materialized from
+        # probes/analysis by _buildSamplePairs.  Any change to analysis or
+        # probes invalidates every unusual_case that has been built (see
+        # _invalidateSamplePairs).
+        self.conn.execute(
+            """CREATE TABLE IF NOT EXISTS sample_pairs (type TEXT,
+                                                     unusual_case TEXT,
+                                                     sample INTEGER,
+                                                     time_of_day INTEGER,
+                                                     unusual_packet INTEGER,
+                                                     other_packet REAL,
+                                                     unusual_tsval INTEGER,
+                                                     other_tsval REAL,
+                                                     unusual_reported INTEGER,
+                                                     other_reported REAL,
+                                                     unusual_client INTEGER,
+                                                     other_client REAL,
+                                                     PRIMARY KEY (unusual_case, type, sample))
+            """)
+        self.conn.execute(
+            """CREATE TABLE IF NOT EXISTS sample_pairs_built (unusual_case TEXT PRIMARY KEY)""")
+        if self._addMissingColumns('sample_pairs', (('unusual_client','INTEGER'),('other_client','REAL'))):
+            self.conn.execute("DELETE FROM sample_pairs_built")
+
+        # Model parameters fitted to sample_pairs by trainers (params is
+        # JSON), kept so that retraining at other sizes skips the fit.
+        self.conn.execute(
+            """CREATE TABLE IF NOT EXISTS fitted_models (model TEXT,
+                                                       unusual_case TEXT,
+                                                       params TEXT,
+                                                       PRIMARY KEY (model, unusual_case))
+            """)
+        for table in ('analysis','probes'):
+            for event in ('INSERT','UPDATE','DELETE'):
+                # Replaced by _invalidateSamplePairs; a per-row DELETE
+                # slowed every probe insert.
+                for target in ('pairs','models'):
+                    self.conn.execute("DROP TRIGGER IF EXISTS %s_%s_%s" % (table, event.lower(), target))
+        self.conn.commit()
 
     def __del__(self):
         if self.conn:
@@ -121,41 +285,82 @@ class db(threading.local):
             return 0
 
 
-    def subseries(self, probe_type, unusual_case, size=None, offset=None):
-        cache_key = (probe_type,unusual_case)
-        if cache_key not in self._population_cache:
-            query="""
-            SELECT packet_rtt AS unusual_packet,
-                   (SELECT avg(packet_rtt) FROM probes,analysis
-                    WHERE analysis.probe_id=probes.id AND probes.test_case!=:unusual_case AND probes.type=:probe_type AND sample=u.sample) AS other_packet,
-
-                   tsval_rtt AS unusual_tsval,
-                   (SELECT avg(tsval_rtt) FROM probes,analysis
-                    WHERE analysis.probe_id=probes.id AND probes.test_case!=:unusual_case AND probes.type=:probe_type AND sample=u.sample) AS other_tsval,
-
-                   reported AS unusual_reported,
-                   (SELECT avg(reported) FROM probes,analysis
-                    WHERE analysis.probe_id=probes.id AND probes.test_case!=:unusual_case AND probes.type=:probe_type AND sample=u.sample) AS other_reported
-
-            FROM   (SELECT probes.sample,packet_rtt,tsval_rtt,reported FROM probes,analysis 
-                    WHERE analysis.probe_id=probes.id AND probes.test_case =:unusual_case AND probes.type=:probe_type) u
-            """
-    
-            params = {"probe_type":probe_type, "unusual_case":unusual_case}
-            cursor = self.conn.cursor()
-            cursor.execute(query, params)
-            p = [dict(row) for row in cursor.fetchall()]
-            self._population_cache[cache_key] = p
-            self._offset_cache[cache_key] = tuple(numpy.random.random_integers(0,len(p)-1, len(p)/5))
+    # Samples are paired over analyzed probes only, unless nothing has been
+    # analyzed at all (no packet capture), in which case the client-side
+    # RTTs of every probe are paired.
+    def _buildSamplePairs(self, unusual_case):
+        query="""
+        INSERT OR REPLACE INTO sample_pairs
+        SELECT probes.type, :unusual_case, sample,
+               max(CASE WHEN test_case=:unusual_case THEN time_of_day END),
+               max(CASE WHEN test_case=:unusual_case THEN packet_rtt END),
+               avg(CASE WHEN test_case!=:unusual_case THEN packet_rtt END),
+               max(CASE WHEN test_case=:unusual_case THEN tsval_rtt END),
+               avg(CASE WHEN test_case!=:unusual_case THEN tsval_rtt END),
+               max(CASE WHEN test_case=:unusual_case THEN reported END),
+               avg(CASE WHEN test_case!=:unusual_case THEN reported END),
+               max(CASE WHEN test_case=:unusual_case THEN client_first_read-client_first_write END),
+               avg(CASE WHEN test_case!=:unusual_case THEN client_first_read-client_first_write END)
+        FROM probes LEFT JOIN analysis ON analysis.probe_id=probes.id
+        WHERE analysis.probe_id IS NOT NULL OR NOT EXISTS (SELECT 1 FROM analysis)
+        GROUP BY probes.type,sample
+        HAVING count(CASE WHEN test_case=:unusual_case THEN 1 END) > 0
+        """
+        params = {"unusual_case":unusual_case}
+        self.conn.execute("DELETE FROM sample_pairs WHERE unusual_case=:unusual_case", params)
+        self.conn.execute(query, params)
+        self.conn.execute("INSERT OR REPLACE INTO sample_pairs_built VALUES (:unusual_case)", params)
+        self.conn.commit()
+
+    def samplePairs(self, probe_type, unusual_case):
+        cursor = self.conn.cursor()
+        cursor.execute("SELECT 1 FROM sample_pairs_built WHERE unusual_case=?", (unusual_case,))
+        if cursor.fetchone() == None:
+            self._buildSamplePairs(unusual_case)
+
+        cursor.execute("""SELECT time_of_day,unusual_packet,other_packet,unusual_tsval,other_tsval,
+                                 unusual_reported,other_reported,unusual_client,other_client
+                          FROM sample_pairs WHERE type=? AND unusual_case=? ORDER BY sample""",
+                       (probe_type, unusual_case))
+        return cursor
+
+    _pair_columns = ('unusual_packet','other_packet','unusual_tsval','other_tsval',
+                     'unusual_reported','other_reported','unusual_client','other_client')
+
+    def _loadPopulation(self, cache_key):
+        if cache_key in self._population_cache:
+            return self._population_cache[cache_key]
+
+        p = [dict(row) for row in self.samplePairs(*cache_key)]
+        for row in p:
+            del row['time_of_day']
+        self._population_cache[cache_key] = p
+        arrays = {c:numpy.array([row[c] for row in p], dtype=float) for c in self._pair_columns}
+        for rtt_type in ('packet','tsval','reported','client'):
+            arrays[rtt_type+'_diff'] = arrays['unusual_'+rtt_type] - arrays['other_'+rtt_type]
+        self._array_cache[cache_key] = arrays
+        return p
+
+    def _nextOffset(self, cache_key):
+        if cache_key not in self._offset_cache:
+            n = len(self._population_cache[cache_key])
+            self._offset_cache[cache_key] = tuple(self.rng.integers(0,n, n//5))
             self._cur_offsets[cache_key] = 0
+            for i in range(self._skip_offsets):
+                self._nextOffset(cache_key)
 
-        population = self._population_cache[cache_key]
+        offset = self._offset_cache[cache_key][self._cur_offsets[cache_key]]
+        self._cur_offsets[cache_key] = (offset + 1) % len(self._offset_cache[cache_key])
+        return offset
+    
+    def subseries(self, probe_type, unusual_case, size=None, offset=None):
+        cache_key = (probe_type,unusual_case)
+        population = self._loadPopulation(cache_key)
 
         if size == None or size > len(population):
             size = len(population)
         if offset == None or offset >= len(population) or offset < 0:
-            offset = self._offset_cache[cache_key][self._cur_offsets[cache_key]]
-            self._cur_offsets[cache_key] = (offset + 1) % len(self._offset_cache[cache_key])
+            offset = self._nextOffset(cache_key)
         
         try:
             offset = int(offset)
@@ -169,8 +374,41 @@ class db(threading.local):
             ret_val += population[0:size-len(ret_val)]
         
         return ret_val
+
+
+    # Population columns as float arrays (NULL becomes nan), in the same
+    # order subseries() windows over.  Also includes packet_diff, tsval_diff,
+    # reported_diff and client_diff (unusual minus other).
+    def populationArrays(self, probe_type, unusual_case):
+        cache_key = (probe_type,unusual_case)
+        self._loadPopulation(cache_key)
+        return self._array_cache[cache_key]
+
+
+    # Row indices of num_trials consecutive subseries() windows, one
+    # window per row.  Consumes offsets exactly as that many subseries()
+    # calls would, including the wrap-around at the end of the population.
+    def subseriesIndices(self, probe_type, unusual_case, size, num_trials):
+        cache_key = (probe_type,unusual_case)
+        population_size = len(self._loadPopulation(cache_key))
+        if size == None or size > population_size:
+            size = population_size
+
+        offsets = numpy.array([self._nextOffset(cache_key) for t in range(num_trials)], dtype=numpy.int64)
+        return (offsets[:,numpy.newaxis] + numpy.arange(int(size))) % population_size
+
     
-    
+    # Replaces db.rng with one seeded from seed (anything
+    # numpy.random.default_rng accepts) and redraws all subseries offsets
+    # from it.  Populations stay cached.  The first skip offsets of each
+    # population are passed over, so a run of subseries() calls can be
+    # resumed after a reseed.
+    def reseedOffsets(self, seed, skip=0):
+        self.rng = numpy.random.default_rng(seed)
+        self._skip_offsets = skip
+        self._offset_cache = {}
+        self._cur_offsets = {}
+
     def resetOffsets(self):
         for k in self._cur_offsets.keys():
             self._cur_offsets[k] = 0
@@ -178,19 +416,18 @@ class db(threading.local):
             
     def clearCache(self):
         self._population_cache = {}
+        self._array_cache = {}
         self._offset_cache = {}
         self._cur_offsets = {}
 
         
     def _insert(self, table, row):
-        rid = _newid()
         keys = row.keys()
         columns = ','.join(keys)
         placeholders = ':'+', :'.join(keys)
-        query = "INSERT INTO %s (id,%s) VALUES ('%s',%s)" % (table, columns, rid, placeholders)
+        query = "INSERT INTO %s (%s) VALUES (%s)" % (table, columns, placeholders)
         #print(query,row)
-        self.conn.execute(query, row)
-        return rid
+        return self.conn.execute(query, row).lastrowid
 
     def _insertMany(self, table, rows):
         if len(rows) < 1:
@@ -199,38 +436,198 @@ class db(threading.local):
         keys = rows[0].keys()
         columns = ','.join(keys)
         placeholders = ':'+', :'.join(keys)
-        query = "INSERT INTO %s (id,%s) VALUES (hex(randomblob(16)),%s)" % (table, columns, placeholders)
+        query = "INSERT INTO %s (%s) VALUES (%s)" % (table, columns, placeholders)
         #print(query,row)
         self.conn.executemany(query, rows)
     
+    # meta holds a single row (created along with the database)
     def addMeta(self, meta):
-        ret_val = self._insert('meta', meta)
+        row = self.conn.execute("SELECT id FROM meta LIMIT 1").fetchone()
+        if row == None:
+            ret_val = self._insert('meta', meta)
+        else:
+            ret_val = row[0]
+            assignments = ','.join("%s=:%s" % (k,k) for k in meta.keys())
+            self.conn.execute("UPDATE meta SET %s WHERE id=:id" % assignments, dict(meta, id=ret_val))
         self.conn.commit()
         return ret_val
     
+    # Called once per statement by every method that writes probes or
+    # analysis, rather than from row triggers on those tables.  Models
+    # fitted to the old sample_pairs go with them.
+    def _invalidateSamplePairs(self):
+        self.conn.execute("DELETE FROM sample_pairs_built")
+        self.conn.execute("DELETE FROM fitted_models")
+
     def addProbes(self, p):
-        return [self._insert('probes', row) for row in p]
-
-    def addPackets(self, pkts, window_size):
-        query = ("INSERT INTO packets (id,probe_id,sent,observed,tsval,payload_len,tcpseq,tcpack)"
-                 " VALUES(hex(randomblob(16)),"
-                 "(SELECT id FROM probes WHERE local_port=:local_port AND :observed>time_of_day"
-                 " AND :observed<time_of_day+userspace_rtt+%d" 
-                 " ORDER BY time_of_day ASC LIMIT 1),"
-                 ":sent,:observed,:tsval,:payload_len,:tcpseq,:tcpack)") % window_size
+        rows = {}
+        for row in p:
+            rows.setdefault(tuple(row.keys()), []).append(row)
+        for batch in rows.values():
+            self._insertMany('probes', batch)
+        if rows:
+            self._invalidateSamplePairs()
+
+    # Index of the first probe of each probe's connection, for probes sorted
+    # by (local_port,time_of_day,rowid).  A connection is a run of probes on
+    # one local_port whose request_seq (NULL meaning a connection per probe)
+    # doesn't restart at 0.
+    def _connectionHeads(self, ports, request_seq):
+        is_head = (request_seq <= 0)
+        if len(is_head) > 0:
+            is_head[0] = True
+            is_head[1:] |= ports[1:] != ports[:-1]
+        return numpy.maximum.accumulate(numpy.where(is_head, numpy.arange(len(is_head)), 0))
+
+    _connection_query = ("SELECT id,local_port,time_of_day,coalesce(request_seq,0) AS request_seq,"
+                         "time_of_day+userspace_rtt+? AS window_end"
+                         " FROM probes WHERE local_port IS NOT NULL AND time_of_day IS NOT NULL"
+                         " ORDER BY local_port,time_of_day,rowid")
+
+    # Probes that share persistent connections, as (first probe's id,
+    # {request_seq:probe id}) per connection
+    def keepAliveConnections(self):
+        cursor = self.conn.cursor()
+        cursor.execute(self._connection_query, (0,))
+        rows = cursor.fetchall()
+        ports = numpy.array([r['local_port'] for r in rows], dtype=numpy.int64)
+        request_seq = numpy.array([r['request_seq'] for r in rows], dtype=numpy.int64)
+        heads = self._connectionHeads(ports, request_seq)
+
+        connections = {}
+        for row,head in zip(rows, heads.tolist()):
+            connections.setdefault(head, {})[row['request_seq']] = row['id']
+        return [(rows[head]['id'],requests) for head,requests in sorted(connections.items())
+                if len(requests) > 1]
+    
+    def _loadProbeIntervals(self, window_size):
+        # Probes sorted by (local_port,time_of_day), along with a running
+        # maximum of each probe's window end within its port.  Since the
+        # running maximum never decreases, the earliest probe whose window
+        # still covers a packet can be found with a binary search.
+        #
+        # Probes sharing a keep-alive connection are matched as one, to the
+        # connection's first probe with a window covering all of them;
+        # analyzeProbes later splits the connection's packets by request.
+        cursor = self.conn.cursor()
+        cursor.execute(self._connection_query, (window_size,))
+        rows = cursor.fetchall()
+
+        ids = [r['id'] for r in rows]
+        ports = numpy.array([r['local_port'] for r in rows], dtype=numpy.int64)
+        starts = numpy.array([r['time_of_day'] for r in rows], dtype=numpy.int64)
+        ends = numpy.array([r['window_end'] if r['window_end'] != None else numpy.iinfo(numpy.int64).min
+                            for r in rows], dtype=numpy.int64)
+
+        request_seq = numpy.array([r['request_seq'] for r in rows], dtype=numpy.int64)
+        if (request_seq > 0).any():
+            heads = self._connectionHeads(ports, request_seq)
+            first = numpy.flatnonzero(heads == numpy.arange(len(heads)))
+            ends = numpy.maximum.reduceat(ends, first)
+            ids = [ids[i] for i in first.tolist()]
+            ports = ports[first]
+            starts = starts[first]
+            rows = first
+
+        max_ends = ends
+        if len(rows) > 0:
+            # Grouped running maximum: rank the window ends, then lift each
+            # port's ranks above all earlier ports' so one accumulate works.
+            values,ranks = numpy.unique(ends, return_inverse=True)
+            segment = numpy.cumsum(numpy.append(False, ports[1:] != ports[:-1]))
+            lifted = numpy.maximum.accumulate(ranks + segment*len(values))
+            max_ends = values[lifted - segment*len(values)]
+
+        return ids,ports,starts,max_ends
+
+
+    def _matchProbes(self, intervals, local_ports, observed):
+        ids,ports,starts,max_ends = intervals
+
+        # Vectorized binary searches within each packet's local_port segment
+        def segmentSearch(keys, lo, hi, goes_left):
+            lo = lo.copy()
+            hi = hi.copy()
+            while True:
+                active = lo < hi
+                if not active.any():
+                    return lo
+                mid = (lo+hi)//2
+                left = goes_left(keys[numpy.minimum(mid, len(keys)-1)])
+                hi = numpy.where(active & left, mid, hi)
+                lo = numpy.where(active & ~left, mid+1, lo)
+
+        seg_lo = numpy.searchsorted(ports, local_ports, side='left')
+        seg_hi = numpy.searchsorted(ports, local_ports, side='right')
+        # Probes that started strictly before each packet: [seg_lo,before)
+        before = segmentSearch(starts, seg_lo, seg_hi, lambda k: k >= observed)
+        # Earliest of those whose window ends strictly after the packet
+        match = segmentSearch(max_ends, seg_lo, before, lambda k: k > observed)
+
+        return [ids[m] if m < b else None for m,b in zip(match.tolist(), before.tolist())]
+
+
+    def _insertPacketColumns(self, cursor, intervals, columns):
+        query = ("INSERT INTO packets (probe_id,sent,observed,tsval,payload_len,tcpseq,tcpack)"
+                 " VALUES(?,?,?,?,?,?,?)")
+        local_ports = numpy.asarray(columns['local_port'], dtype=numpy.int64)
+        observed = numpy.asarray(columns['observed'], dtype=numpy.int64)
+        probe_ids = self._matchProbes(intervals, local_ports, observed)
+        values = [columns[c] if isinstance(columns[c], list) else columns[c].tolist()
+                  for c in ('sent','observed','tsval','payload_len','tcpseq','tcpack')]
+        cursor.executemany(query, zip(probe_ids, *values))
+
+    def addPackets(self, pkts, window_size, batch_size=100000):
+        columns = ('local_port','sent','observed','tsval','payload_len','tcpseq','tcpack')
+        intervals = self._loadProbeIntervals(window_size)
+
         self.conn.execute("PRAGMA foreign_keys = OFF;")
-        self.conn.execute("CREATE INDEX IF NOT EXISTS probes_port ON probes (local_port)")
         cursor = self.conn.cursor()
-        #print(query, list(pkts)[0:3])
-        cursor.executemany(query, pkts)
+        batch = []
+        def flush():
+            self._insertPacketColumns(cursor, intervals, {c:[p[c] for p in batch] for c in columns})
+            batch.clear()
+
+        for p in pkts:
+            batch.append(p)
+            if len(batch) >= batch_size:
+                flush()
+        if len(batch) > 0:
+            flush()
         self.conn.commit()
         self.conn.execute("PRAGMA foreign_keys = ON;")
 
+    # Like addPackets, but for a structured array of packet records, such as
+    # those returned by capture.readPacketLog.
+    def addPacketRecords(self, records, window_size, batch_size=100000):
+        intervals = self._loadProbeIntervals(window_size)
+
+        self.conn.execute("PRAGMA foreign_keys = OFF;")
+        cursor = self.conn.cursor()
+        for start in range(0, len(records), batch_size):
+            batch = records[start:start+batch_size]
+            self._insertPacketColumns(cursor, intervals, {c:batch[c] for c in batch.dtype.names})
+        self.conn.commit()
+        self.conn.execute("PRAGMA foreign_keys = ON;")
+
+    def deletePackets(self):
+        self.conn.execute("DELETE FROM packets")
+        self._invalidateSamplePairs()
+        self.conn.commit()
+
+    def addCaptureStats(self, stats, sample_type=None):
+        self._insertMany('capture_stats', [dict(s, sample_type=sample_type) for s in stats])
+        self.conn.commit()
+
     def addAnalyses(self, analyses):
-        return [self._insert('analysis', row) for row in analyses]
+        self._insertMany('analysis', analyses)
+        if len(analyses) > 0:
+            self._invalidateSamplePairs()
 
-    def addTrimAnalyses(self, analyses):
-        self._insertMany('trim_analysis', analyses)
+    def deleteAnalyses(self):
+        self.conn.execute("DELETE FROM analysis")
+        self._invalidateSamplePairs()
+        self.conn.commit()
 
     def addClassifierResult(self, results):
         ret_val = self._insert('classifier_results', results)
@@ -272,13 +669,25 @@ class db(threading.local):
         self.conn.execute(query, params)
         self.conn.commit()
     
+    def addFittedModel(self, model, unusual_case, params):
+        self.conn.execute("INSERT OR REPLACE INTO fitted_models VALUES (?,?,?)", (model, unusual_case, params))
+        self.conn.commit()
+
+    def fetchFittedModel(self, model, unusual_case):
+        cursor = self.conn.cursor()
+        cursor.execute("SELECT params FROM fitted_models WHERE model=? AND unusual_case=?", (model, unusual_case))
+        row = cursor.fetchone()
+        if row == None:
+            return None
+        return row[0]
+
     def setUnusualCase(self, unusual_case, greater):
         query = """SELECT * FROM meta LIMIT 1"""
         cursor = self.conn.cursor()
         cursor.execute(query)
         row = cursor.fetchone()
         if row == None:
-            params = {"id":_newid()}
+            params = {}
         else:
             params = dict(row)
 
@@ -302,3 +711,107 @@ class db(threading.local):
             return None
         else:
             return tuple(row)
+
+
+# Buffers probes for a db and inserts them from a separate writer thread, so
+# the sampling loop never waits on disk.  Buffered probes are inserted in one
+# transaction once max_rows of them are waiting or the oldest has waited
+# max_delay seconds, whichever comes first.
+#
+# Until committed, buffered probes are invisible to other connections, so
+# earliestPending() gives the earliest time_of_day still buffered, for use
+# in a streamingAssociator horizon.
+class probeWriter(object):
+    db = None
+    max_rows = 1000
+    max_delay = 1.0
+    error = None
+    _thread = None
+    _lock = None
+    _buffer = None
+    _buffered_since = None
+    _writing = None
+    _flushing = False
+    _closing = False
+
+    def __init__(self, db, max_rows=1000, max_delay=1.0):
+        self.db = db
+        self.max_rows = max_rows
+        self.max_delay = max_delay
+        self._lock = threading.Condition()
+        self._buffer = []
+        self._writing = []
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def addProbes(self, p):
+        with self._lock:
+            if self.error != None:
+                raise self.error
+            if len(self._buffer) == 0 or len(self._buffer)+len(p) >= self.max_rows:
+                self._lock.notify_all()
+            if len(self._buffer) == 0:
+                self._buffered_since = time.monotonic()
+            self._buffer.extend(p)
+
+    def earliestPending(self):
+        with self._lock:
+            times = [row['time_of_day'] for row in self._buffer+self._writing
+                     if row.get('time_of_day') != None]
+        if len(times) == 0:
+            return None
+        return min(times)
+
+    # Blocks until everything buffered so far has been committed
+    def flush(self):
+        with self._lock:
+            self._flushing = True
+            self._lock.notify_all()
+            while (len(self._buffer) > 0 or len(self._writing) > 0) and self.error == None:
+                self._lock.wait()
+            self._flushing = False
+            if self.error != None:
+                raise self.error
+
+    def close(self):
+        with self._lock:
+            self._closing = True
+            self._lock.notify_all()
+        self._thread.join()
+        if self.error != None:
+            raise self.error
+
+    def _ready(self):
+        if len(self._buffer) == 0:
+            return self._closing
+        return (self._flushing or self._closing or len(self._buffer) >= self.max_rows
+                or time.monotonic() - self._buffered_since >= self.max_delay)
+
+    def _run(self):
+        while True:
+            with self._lock:
+                while not self._ready():
+                    if len(self._buffer) > 0:
+                        self._lock.wait(self._buffered_since + self.max_delay - time.monotonic())
+                    else:
+                        self._lock.wait()
+                if len(self._buffer) == 0:
+                    return
+                self._writing,self._buffer = self._buffer,[]
+
+            try:
+                self.db.addProbes(self._writing)
+                self.db.conn.commit()
+            except Exception as e:
+                sys.stderr.write("ERROR: failed to store probes: %s\n" % repr(e))
+                self.db.conn.rollback()
+                with self._lock:
+                    self.error = e
+                    self._writing = []
+                    self._lock.notify_all()
+                return
+
+            with self._lock:
+                self._writing = []
+                self._lock.notify_all()
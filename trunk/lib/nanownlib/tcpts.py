@@ -5,6 +5,7 @@ import queue
 import statistics
 import threading
 import json
+import numpy
 from .stats import OLSRegression
 
 
@@ -64,12 +65,18 @@ def runTimestampProbes(host_ip, port, hostname, num_trials, concurrency=4):
     return ports
 
 
+# sniffer_fp is either a file of JSON packet lines or an array of binary
+# packet records (see capture.readPacketLog).
 def computeTimestampPrecision(sniffer_fp, ports):
     rcvd = []
-    for line in sniffer_fp:
-        p = json.loads(line)
-        if p['sent']==0:
-            rcvd.append((p['observed'],p['tsval'],int(p['local_port'])))
+    if isinstance(sniffer_fp, numpy.ndarray):
+        r = sniffer_fp[sniffer_fp['sent']==0]
+        rcvd = list(zip(r['observed'].tolist(), r['tsval'].tolist(), r['local_port'].tolist()))
+    else:
+        for line in sniffer_fp:
+            p = json.loads(line)
+            if p['sent']==0:
+                rcvd.append((p['observed'],p['tsval'],int(p['local_port'])))
 
     slopes = []
     for port in ports:
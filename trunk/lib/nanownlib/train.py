@@ -6,56 +6,200 @@ import pprint
 import json
 
 from .stats import *
-from .parallel import WorkerThreads
+from .parallel import WorkerProcesses
+
+# Number of processes used for each trainer's parameter search
+num_workers = 2
+
+
+# Starts workers for a trainer's parameter search.  The training
+# populations are loaded first so forked workers share them, and each job
+# draws its subseries offsets from its own RNG stream so results do not
+# depend on num_workers.  Sorted windows of the given columns are also
+# built up front, when they fit in the window cache, so that workers and
+# later trainers using the same window size don't sort them again.
+def _searchWorkers(db, unusual_case, trainAux, num_observations=None, columns=()):
+    for probe_type in ('train','train_null'):
+        population = db.populationArrays(probe_type, unusual_case)
+        for column in columns:
+            values = population[column]
+            size = min(num_observations, len(values))
+            if len(values)*size*len(columns)*2 <= sorted_windows_limit:
+                windowCache(values, size).fill()
+    seed = int(db.rng.integers(0,2**31))
+
+    def setup(job_key):
+        if isinstance(job_key, tuple):
+            # From _searchStage: (stage, candidate) stream, resumed at a trial
+            stream,skip = job_key
+            db.reseedOffsets((seed,)+stream, skip)
+        else:
+            db.reseedOffsets((seed,job_key))
+
+    wt = WorkerProcesses(num_workers, trainAux, setup=setup)
+    wt.num_stages = 0
+    wt.seed = seed
+    return wt
+
+
+# When true, _searchStage evaluates candidates with a few trials first and
+# drops those whose error is confidently worse than the best candidate's
+# before spending the full number of trials on the rest.
+adaptive_search = False
+adaptive_min_trials = 25
+adaptive_z = 2.576
+
+
+def _stageScores(fp, fn, n, balance):
+    # fp and fn are counts out of n trials each.  Add-one smoothing keeps
+    # the variance estimate away from zero when no errors have been seen.
+    pfp = (fp+1.0)/(n+2.0)
+    pfn = (fn+1.0)/(n+2.0)
+    if balance:
+        score = abs(fp-fn)/n
+        sd = numpy.sqrt((pfp*(1-pfp)+pfn*(1-pfn))/n)
+    else:
+        score = (fp+fn)/(2.0*n)
+        sd = numpy.sqrt((pfp*(1-pfp)+pfn*(1-pfn))/(4.0*n))
+    return score, numpy.maximum(score-adaptive_z*sd, 0.0), score+adaptive_z*sd
+
+
+# Runs trainAux(*(args+(num_trials,))) for each (job_id,args) in
+# candidates and returns [(score, job_id, false_negatives, false_positives)]
+# sorted best first.  The score is (fp+fn)/2, or abs(fp-fn) if balance is
+# set.  With adaptive_search, the keep best candidates are never dropped.
+#
+# Each candidate's trials come from its own offset stream, and later rounds
+# resume that stream, so a candidate that survives to num_trials gets the
+# same results it would without adaptive_search.
+def _searchStage(wt, candidates, num_trials, balance=False, keep=1):
+    def runRound(ids, trials):
+        for job_id in ids:
+            wt.addJob(job_id, candidates[job_id]+(trials,), job_key=(streams[job_id],done))
+        wt.wait()
+        while not wt.resultq.empty():
+            job_id,errors = wt.resultq.get()
+            fp,fn = errors
+            counts[job_id] += (round(fp*trials/100.0), round(fn*trials/100.0), trials)
+
+    candidates = dict(candidates)
+    streams = {job_id:(wt.num_stages,i) for i,job_id in enumerate(candidates)}
+    wt.num_stages += 1
+    counts = {job_id:numpy.zeros(3) for job_id in candidates}
+    survivors = list(candidates.keys())
+    done = 0
+    if adaptive_search:
+        trials = max(adaptive_min_trials, num_trials//8)
+        while len(survivors) > 1 and done+trials < num_trials:
+            runRound(survivors, trials)
+            done += trials
+            trials = done
+
+            survivors = [job_id for job_id in survivors if counts[job_id][2] > 0]
+            if len(survivors) == 0:
+                break
+            fp,fn,n = numpy.array([counts[job_id] for job_id in survivors]).T
+            score,lower,upper = _stageScores(fp, fn, n, balance)
+            cutoff = numpy.sort(upper)[min(keep,len(upper))-1]
+            survivors = [job_id for job_id,l in zip(survivors,lower) if l <= cutoff]
+
+    if num_trials > done:
+        runRound(survivors, num_trials-done)
+
+    performance = []
+    for job_id in survivors:
+        fp,fn,n = counts[job_id].tolist()
+        if n == 0:
+            continue
+        fp = 100.0*fp/n
+        fn = 100.0*fn/n
+        if balance:
+            performance.append((abs(fp-fn), job_id, fn, fp))
+        else:
+            performance.append(((fp+fn)/2.0, job_id, fn, fp))
+    performance.sort()
+    return performance
+
+
+# Tests each (job_id,box) in candidates on the windows it would get as its
+# own _searchStage job (or, given streams, on those drawn after reseeding
+# with (seed,)+streams[k]), but hands each worker a whole list of boxes so
+# that percentiles are shared between boxes tested on the same windows.
+# Returns [(score, job_id, false_negatives, false_positives)] sorted best
+# first.  Every box gets all num_trials, even with adaptive_search.
+def _boxTestStage(wt, candidates, num_trials, balance=False, streams=None):
+    if streams == None:
+        streams = [(wt.num_stages,i) for i in range(len(candidates))]
+        wt.num_stages += 1
+    seeds = [(wt.seed,)+tuple(stream) for stream in streams]
+
+    chunk = -(-len(candidates)//num_workers)
+    for i in range(0, len(candidates), chunk):
+        boxes = [box for job_id,box in candidates[i:i+chunk]]
+        wt.addJob(i, (seeds[i:i+chunk],boxes,num_trials))
+    wt.wait()
+    errors = [None]*len(candidates)
+    while not wt.resultq.empty():
+        i,results = wt.resultq.get()
+        errors[i:i+len(results)] = results
+
+    performance = []
+    for (job_id,box),result in zip(candidates, errors):
+        if result == None:
+            continue
+        fp,fn = result
+        if balance:
+            performance.append((abs(fp-fn), job_id, fn, fp))
+        else:
+            performance.append(((fp+fn)/2.0, job_id, fn, fp))
+    performance.sort()
+    return performance
+
 
 def trainBoxTest(db, unusual_case, greater, num_observations):
     db.resetOffsets()
-    
-    def trainAux(low,high,num_trials):
-        estimator = functools.partial(multiBoxTest, {'low':low, 'high':high}, greater)
-        estimates = bootstrap3(estimator, db, 'train', unusual_case, num_observations, num_trials)
-        null_estimates = bootstrap3(estimator, db, 'train_null', unusual_case, num_observations, num_trials)
 
-        bad_estimates = len([e for e in estimates if e != 1])
-        bad_null_estimates = len([e for e in null_estimates if e != 0])
-        
-        false_negatives = 100.0*bad_estimates/num_trials
-        false_positives = 100.0*bad_null_estimates/num_trials
-        return false_positives,false_negatives
+    # Returns [(false_positives,false_negatives)], one per box, drawing each
+    # box's windows after db.reseedOffsets() with its seed.
+    def trainAux(seeds,boxes,num_trials):
+        offsets = {'train':[], 'train_null':[]}
+        for seed in seeds:
+            db.reseedOffsets(seed)
+            for probe_type in ('train','train_null'):
+                # Windows of size 1 consume offsets just as full ones do
+                offsets[probe_type].append(db.subseriesIndices(probe_type, unusual_case, 1, num_trials)[:,0])
+
+        estimates = {}
+        for probe_type in ('train','train_null'):
+            population = db.populationArrays(probe_type, unusual_case)
+            size = min(num_observations, len(population['unusual_packet']))
+            estimates[probe_type] = multiBoxTestSurface(boxes, greater, population, size,
+                                                        numpy.array(offsets[probe_type]))
+
+        false_negatives = 100.0*(estimates['train'] != 1).sum(axis=1)/num_trials
+        false_positives = 100.0*(estimates['train_null'] != 0).sum(axis=1)/num_trials
+        return list(zip(false_positives.tolist(), false_negatives.tolist()))
 
     #start = time.time()
-    wt = WorkerThreads(2, trainAux)
+    wt = _searchWorkers(db, unusual_case, trainAux, num_observations, ('unusual_packet','other_packet'))
     
     num_trials = 200
     width = 1.0
-    performance = []
-    for low in range(0,50):
-        wt.addJob(low, (low,low+width,num_trials))
-    wt.wait()
-    while not wt.resultq.empty():
-        job_id,errors = wt.resultq.get()
-        fp,fn = errors
-        performance.append(((fp+fn)/2.0, job_id, fn, fp))
-    performance.sort()
+    performance = _boxTestStage(wt, [(low,(low,low+width)) for low in range(0,50)], num_trials)
     #pprint.pprint(performance)
     #print(time.time()-start)
     
     num_trials = 200
     lows = [p[1] for p in performance[0:5]]
     widths = [w/10.0 for w in range(5,155,10)]
+    # Each box in this grid is seeded by its position in the search (after
+    # the 50 boxes above), rather than by stage.
+    grid = [((width,low),(low,low+width)) for width in widths for low in lows]
+    grid = _boxTestStage(wt, grid, num_trials, streams=[(k,) for k in range(50,50+len(grid))])
     performance = []
     for width in widths:
-        false_positives = []
-        false_negatives = []
-        for low in lows:
-            wt.addJob(low,(low,low+width,num_trials))
-        wt.wait()
-        while not wt.resultq.empty():
-            job_id,errors = wt.resultq.get()
-            fp,fn = errors
-            false_negatives.append(fn)
-            false_positives.append(fp)
-
+        false_negatives = [fn for score,job_id,fn,fp in grid if job_id[0] == width]
+        false_positives = [fp for score,job_id,fn,fp in grid if job_id[0] == width]
         #print(width, false_negatives)
         #print(width, false_positives)
         #performance.append(((statistics.mean(false_positives)+statistics.mean(false_negatives))/2.0,
@@ -69,15 +213,7 @@ def trainBoxTest(db, unusual_case, greater, num_observations):
 
 
     num_trials = 500
-    performance = []
-    for low in lows:
-        wt.addJob(low, (low,low+good_width,num_trials))
-    wt.wait()
-    while not wt.resultq.empty():
-        job_id,errors = wt.resultq.get()
-        fp,fn = errors
-        performance.append(((fp+fn)/2.0, job_id, fn, fp))
-    performance.sort()
+    performance = _boxTestStage(wt, [(low,(low,low+good_width)) for low in lows], num_trials)
     #pprint.pprint(performance)
     best_low = performance[0][1]
     #print("best_low:", best_low)
@@ -85,16 +221,8 @@ def trainBoxTest(db, unusual_case, greater, num_observations):
     
     num_trials = 500
     widths = [good_width+(x/100.0) for x in range(-120,125,5) if good_width+(x/100.0) > 0.0]
-    performance = []
-    for width in widths:
-        wt.addJob(width, (best_low,best_low+width,num_trials))
-    wt.wait()
-    while not wt.resultq.empty():
-        job_id,errors = wt.resultq.get()
-        fp,fn = errors
-        #performance.append(((fp+fn)/2.0, job_id, fn, fp))
-        performance.append((abs(fp-fn), job_id, fn, fp))
-    performance.sort()
+    performance = _boxTestStage(wt, [(width,(best_low,best_low+width)) for width in widths], num_trials,
+                                balance=True)
     #pprint.pprint(performance)
     best_width=performance[0][1]
     #print("best_width:",best_width)
@@ -131,67 +259,35 @@ def trainSummary(summaryFunc, db, unusual_case, greater, num_observations):
     threshold = summaryFunc(mean_diffs)/2.0
     #print("init_threshold:", threshold)
     
-    wt = WorkerThreads(2, trainAux)
+    wt = _searchWorkers(db, unusual_case, trainAux, num_observations, ('packet_diff',))
     
     num_trials = 500
-    performance = []
-    for distance in range(1,50):
-        wt.addJob(distance, (distance,threshold,num_trials))
-    wt.wait()
-    while not wt.resultq.empty():
-        job_id,errors = wt.resultq.get()
-        fp,fn = errors
-        performance.append(((fp+fn)/2.0, job_id, fn, fp))
-    
-    performance.sort()
+    performance = _searchStage(wt, [(distance,(distance,threshold)) for distance in range(1,50)], num_trials)
     #pprint.pprint(performance)
     good_distance = performance[0][1]
     #print("good_distance:",good_distance)
 
     
     num_trials = 500
-    performance = []
-    for t in range(80,122,2):
-        wt.addJob(threshold*(t/100.0), (good_distance,threshold*(t/100.0),num_trials))
-    wt.wait()
-    while not wt.resultq.empty():
-        job_id,errors = wt.resultq.get()
-        fp,fn = errors
-        #performance.append(((fp+fn)/2.0, job_id, fn, fp))
-        performance.append((abs(fp-fn), job_id, fn, fp))
-    performance.sort()
+    performance = _searchStage(wt, [(threshold*(t/100.0),(good_distance,threshold*(t/100.0)))
+                                    for t in range(80,122,2)], num_trials, balance=True)
     #pprint.pprint(performance)
     good_threshold = performance[0][1]
     #print("good_threshold:", good_threshold)
 
     
     num_trials = 500
-    performance = []
-    for d in [good_distance+s for s in range(-4,5)
-              if good_distance+s > -1 and good_distance+s < 51]:
-        wt.addJob(d, (d,good_threshold,num_trials))
-    wt.wait()
-    while not wt.resultq.empty():
-        job_id,errors = wt.resultq.get()
-        fp,fn = errors
-        performance.append(((fp+fn)/2.0, job_id, fn, fp))
-    performance.sort()
+    performance = _searchStage(wt, [(d,(d,good_threshold)) for d in [good_distance+s for s in range(-4,5)
+                                                                  if good_distance+s > -1 and good_distance+s < 51]],
+                               num_trials)
     #pprint.pprint(performance)
     best_distance = performance[0][1]
     #print("best_distance:",best_distance)
 
     
     num_trials = 500
-    performance = []
-    for t in range(90,111):
-        wt.addJob(good_threshold*(t/100.0), (best_distance,good_threshold*(t/100.0),num_trials))
-    wt.wait()
-    while not wt.resultq.empty():
-        job_id,errors = wt.resultq.get()
-        fp,fn = errors
-        #performance.append(((fp+fn)/2.0, job_id, fn, fp))
-        performance.append((abs(fp-fn), job_id, fn, fp))
-    performance.sort()
+    performance = _searchStage(wt, [(good_threshold*(t/100.0),(best_distance,good_threshold*(t/100.0)))
+                                    for t in range(90,111)], num_trials, balance=True)
     #pprint.pprint(performance)
     best_threshold = performance[0][1]
     #print("best_threshold:", best_threshold)
@@ -206,6 +302,60 @@ def trainSummary(summaryFunc, db, unusual_case, greater, num_observations):
             'false_negatives':performance[0][2]}
 
 
+# Number of bins (of equal training population) sprtTest splits differences
+# into
+sprt_bins = 16
+
+# Trains sprtTest on the given difference column.  Bin likelihood ratios
+# come from the train and train_null populations; the error bounds
+# (alpha=beta) are then chosen for samples cut off at num_observations.
+# Returns None if the column has no data (e.g. client_diff for sessions
+# recorded without client timing).
+def trainSPRT(column, db, unusual_case, greater, num_observations):
+    db.resetOffsets()
+    train = db.populationArrays('train', unusual_case)[column]
+    null = db.populationArrays('train_null', unusual_case)[column]
+    train = train[~numpy.isnan(train)]
+    null = null[~numpy.isnan(null)]
+    if len(train) == 0 or len(null) == 0:
+        return None
+
+    edges = numpy.unique(numpy.percentile(numpy.concatenate((train,null)),
+                                          numpy.linspace(0, 100, sprt_bins+1)[1:-1]))
+    # Add-one smoothing keeps empty bins from deciding a test on their own
+    train_freq = (numpy.bincount(numpy.searchsorted(edges, train, side='right'), minlength=len(edges)+1)+1.0)
+    null_freq = (numpy.bincount(numpy.searchsorted(edges, null, side='right'), minlength=len(edges)+1)+1.0)
+    llr = numpy.log(train_freq/train_freq.sum()) - numpy.log(null_freq/null_freq.sum())
+    params = {'column':column, 'edges':edges.tolist(), 'llr':llr.tolist()}
+
+    def trainAux(error, num_trials):
+        estimator = functools.partial(sprtTest, dict(params, alpha=error, beta=error), greater)
+        estimates = bootstrap3(estimator, db, 'train', unusual_case, num_observations, num_trials)
+        null_estimates = bootstrap3(estimator, db, 'train_null', unusual_case, num_observations, num_trials)
+
+        bad_estimates = len([e for e in estimates if e != 1])
+        bad_null_estimates = len([e for e in null_estimates if e != 0])
+        
+        false_negatives = 100.0*bad_estimates/num_trials
+        false_positives = 100.0*bad_null_estimates/num_trials
+        return false_positives,false_negatives
+
+    wt = _searchWorkers(db, unusual_case, trainAux)
+    num_trials = 500
+    performance = _searchStage(wt, [(e,(e,)) for e in (0.001,0.0025,0.005,0.01,0.025,0.05,0.1)], num_trials)
+    #pprint.pprint(performance)
+    best_error = performance[0][1]
+    wt.stop()
+
+    params.update({'alpha':best_error, 'beta':best_error})
+    return {'trial_type':"train",
+            'num_observations':num_observations,
+            'num_trials':num_trials,
+            'params':json.dumps(params, sort_keys=True),
+            'false_positives':performance[0][3],
+            'false_negatives':performance[0][2]}
+
+
 def trainKalman(db, unusual_case, greater, num_observations):
     db.resetOffsets()
 
@@ -224,7 +374,7 @@ def trainKalman(db, unusual_case, greater, num_observations):
     mean_diffs = [s['unusual_packet']-s['other_packet'] for s in db.subseries('train', unusual_case)]
     good_threshold = kfilter({},mean_diffs)['est'][-1]/2.0
 
-    wt = WorkerThreads(2, trainAux)
+    wt = _searchWorkers(db, unusual_case, trainAux)
     num_trials = 200
     performance = []
     for t in range(90,111):
@@ -271,7 +421,7 @@ def trainTsval(db, unusual_case, greater, num_observations):
     null = db.subseries('train_null', unusual_case)
     good_threshold = (tsvalwmean(train)+tsvalwmean(null))/2.0
 
-    wt = WorkerThreads(2, trainAux)
+    wt = _searchWorkers(db, unusual_case, trainAux)
     num_trials = 200
     performance = []
     for t in range(90,111):
@@ -299,68 +449,39 @@ def trainTsval(db, unusual_case, greater, num_observations):
             'false_negatives':performance[0][2]}
 
 
-from pykalman import KalmanFilter
-_pykalman4d_params = None
-_pykalman4d_params = {'observation_covariance': [[11960180434.411114, 4760272534.795976, 8797551081.431936, 6908794128.927051], [4760272534.795962, 12383598172.428213, 5470747537.2599745, 11252625555.297853], [8797551081.431955, 5470747537.2601185, 1466222848395.7058, 72565713883.12643], [6908794128.927095, 11252625555.297981, 72565713883.12654, 1519760903943.507]], 'transition_offsets': [592.5708159274, 583.3804671015271, 414.4187239098291, 562.166786712371], 'observation_offsets': [165.2279084503762, 157.76807691937614, 168.4235495099334, 225.33433430227353], 'initial_state_covariance': [[33599047.5, -18251285.25, 3242535690.59375, -8560730487.84375], [-18251285.25, 9914252.3125, -1761372688.59375, 4650260880.1875], [3242535690.59375, -1761372688.59375, 312926663745.03125, -826168494791.7188], [-8560730487.84375, 4650260880.1875, -826168494791.7188, 2181195982530.4688]], 'initial_state_mean': [12939012.5625, 12934563.71875, 13134751.608, 13138990.9985], 'transition_covariance': [[2515479496.145993, -401423541.70620924, 1409951418.1627903, 255932902.74454522], [-401423541.706214, 2744353887.676857, 1162316.2019491254, 1857251491.3987627], [1409951418.1628358, 1162316.2020361447, 543279068599.8229, -39399311190.5746], [255932902.74459982, 1857251491.398838, -39399311190.574585, 537826124257.5266]], 'observation_matrices': [[1.4255288693095167, -0.4254638445329988, 0.0003406844036817347, -0.0005475021956726778], [-0.46467270827589857, 1.4654311778340343, -0.0003321330280128265, -0.0002853945703691352], [-0.2644570970067974, -0.33955835481495455, 1.7494161615202275, -0.15394117603733548], [-0.3419097544041847, -0.23992883666045373, -0.15587790880447727, 1.7292393175137022]], 'transition_matrices': [[0.52163952865412, 0.47872618354122665, -0.0004322286766109684, 0.00017293351811531466], [0.5167436693545113, 0.48319044922845933, 7.765428142114672e-05, -0.00021518950285326355], [0.2091705950622469, 0.41051399729482796, 0.19341113299389256, 0.19562916616052917], [0.368592004009912, 0.22263632461118732, 0.20756792378812872, 0.20977025833570906]]}
-_pykalman4d_good_threshold = 2009.25853272
-_pykalman4d_params = None
+# Rows of each training population used to fit the kalman4d model
+kalman4d_em_rows = 50000
 
-_pykalman4d_params = {'observation_covariance': [[32932883342.63772, 18054300398.442295, 27538911550.824535, 17152378956.778696], [18054300398.446983, 436546443436.5115, 37327644533.69647, 424485386677.31274], [27538911550.838238, 37327644533.706024, 3276324705772.982, 456017515263.88715], [17152378956.788027, 424485386677.317, 456017515263.88245, 3767844180658.1724]], 'observation_matrices': [[1.025773112769464, -0.028755990114063934, 0.0003540921897382532, 0.0025748564713126143], [-0.8595457826320256, 1.8607522167556567, -0.003520779053701517, 0.002309145982167138], [-0.5806427858959466, 0.22466075141448982, 1.6247192012813798, -0.27363797512617793], [-0.5853369461874607, 0.262177909212312, -0.28415108658843735, 1.6020343138710018]], 'initial_state_mean': [0.0, 0.0, 0.0, 0.0], 'observation_offsets': [549.4498515668686, 484.2106453284049, 648.556719142234, 380.10978090584763], 'transition_covariance': [[4147844406.7768326, -1308763245.5992138, 2920744388.523955, 860096280.797968], [-1308763245.5998695, 171190325905.83395, 3557618712.218984, 165332873663.83142], [2920744388.532502, 3557618712.2283373, 1054894349089.0673, -117551209299.73402], [860096280.805706, 165332873663.83963, -117551209299.73474, 1223605046475.7324]], 'transition_offsets': [1156.9264087977374, 1150.752680207601, 1312.2595286459816, 1267.4069537452415], 'initial_state_covariance': [[667999273207241.0, 669330484615232.1, 713726904326576.2, 731731206363217.4], [669330484615390.9, 670664348906228.8, 715149243295271.9, 733189424910272.2], [713726904326843.4, 715149243295370.6, 762584802695960.9, 781821582244358.5], [731731206363417.0, 733189424910299.0, 781821582244278.6, 801543624134758.0]], 'transition_matrices': [[0.9680677036616316, 0.03260717171917804, 0.0005279411071512641, -0.0012363486571871363], [0.9555219601128613, 0.03851351491891819, 0.00411268796118236, 0.0017357967358293536], [0.622254432930994, -0.2583795512595657, 0.31745705251401546, 0.32357126976364725], [0.6644076824932768, -0.33545285094373867, 0.3295778964272671, 0.34682391469482354]]}
-_pykalman4d_good_threshold = -253.849393803
-def trainPyKalman4D(db, unusual_case, greater, num_observations):
-    global _pykalman4d_params
-    global _pykalman4d_good_threshold
+# The model is fitted by kalman4dEM on the train and train_null
+# populations' complete rows once per unusual_case, and kept in the db (see
+# db.fetchFittedModel).  Returns None if either population has no complete
+# rows (e.g. sessions without TCP timestamps).
+def trainKalman4D(db, unusual_case, greater, num_observations):
     db.resetOffsets()
 
-    if _pykalman4d_params == None:
-        train = db.subseries('train',unusual_case, offset=0)
-        null = db.subseries('train_null',unusual_case, offset=0)
-        train_array = numpy.asarray([(s['unusual_packet'],s['other_packet'],s['unusual_tsval'],s['other_tsval'])
-                                     for s in train])
-        null_array = numpy.asarray([(s['unusual_packet'],s['other_packet'],s['unusual_tsval'],s['other_tsval'])
-                                    for s in null])
-        kf = KalmanFilter(n_dim_obs=4, n_dim_state=4)
-        #initial_state_mean=[quadsummary([s['unusual_packet'] for s in train]),
-        #                                      quadsummary([s['other_packet'] for s in train]),
-        #                                      numpy.mean([s['unusual_tsval'] for s in train]),
-        #                                      numpy.mean([s['other_tsval'] for s in train])])
-
-        kf = kf.em(train_array+null_array[0:50000], n_iter=10,
-                   em_vars=('transition_matrices',
-                            'observation_matrices',
-                            'transition_offsets',
-                            'observation_offsets',
-                            'transition_covariance',
-                            'observation_covariance',
-                            'initial_state_covariance'))
-        _pykalman4d_params = {'transition_matrices': kf.transition_matrices.tolist(),
-                              'observation_matrices': kf.observation_matrices.tolist(),
-                              'transition_offsets': kf.transition_offsets.tolist(),
-                              'observation_offsets': kf.observation_offsets.tolist(),
-                              'transition_covariance': kf.transition_covariance.tolist(),
-                              'observation_covariance': kf.observation_covariance.tolist(),
-                              'initial_state_mean': kf.initial_state_mean.tolist(),
-                              'initial_state_covariance': kf.initial_state_covariance.tolist()}
-        print(_pykalman4d_params)
-    
-        kf = KalmanFilter(n_dim_obs=4, n_dim_state=4, **_pykalman4d_params)
-        smoothed,covariance = kf.smooth(train_array)
-        null_smoothed,covariance = kf.smooth(null_array)
-
-        kp = _pykalman4d_params.copy()
-        #kp['initial_state_mean']=[quadsummary([s['unusual_packet'] for s in train]),
-        #                          quadsummary([s['other_packet'] for s in train]),
-        #                          numpy.mean([s['unusual_tsval'] for s in train]),
-        #                          numpy.mean([s['other_tsval'] for s in train])]
-        #kf = KalmanFilter(n_dim_obs=4, n_dim_state=4, **kp)
-        #null_smoothed,covariance = kf.smooth(null_array)
-        
-        _pykalman4d_good_threshold = (numpy.mean([m[0]-m[1] for m in smoothed])+numpy.mean([m[0]-m[1] for m in null_smoothed]))/2.0
-        print(_pykalman4d_good_threshold)
-
+    populations = {}
+    for probe_type in ('train','train_null'):
+        arrays = db.populationArrays(probe_type, unusual_case)
+        rows = numpy.stack([arrays[c] for c in kalman4d_columns], axis=-1)
+        populations[probe_type] = rows[numpy.isfinite(rows).all(axis=1)]
+        if len(populations[probe_type]) < 2:
+            return None
+
+    kparams = db.fetchFittedModel('kalman4d', unusual_case)
+    if kparams == None:
+        kparams = kalman4dEM(numpy.concatenate([populations['train'][0:kalman4d_em_rows],
+                                                populations['train_null'][0:kalman4d_em_rows]]),
+                             n_iter=10)
+        db.addFittedModel('kalman4d', unusual_case, json.dumps(kparams))
+    else:
+        kparams = json.loads(kparams)
+
+    gains = kalman4dGains(kparams)
+    good_threshold = (kalman4dEstimate(kparams, populations['train'], gains)
+                      + kalman4dEstimate(kparams, populations['train_null'], gains))/2.0
     
     def trainAux(params, num_trials):
-        estimator = functools.partial(pyKalman4DTest, params, greater)
+        estimator = functools.partial(kalman4dTest, params, greater)
         estimates = bootstrap3(estimator, db, 'train', unusual_case, num_observations, num_trials)
         null_estimates = bootstrap3(estimator, db, 'train_null', unusual_case, num_observations, num_trials)
         
@@ -371,13 +492,13 @@ def trainPyKalman4D(db, unusual_case, greater, num_observations):
         false_positives = 100.0*bad_null_estimates/num_trials
         return false_positives,false_negatives
 
-    params = {'threshold':_pykalman4d_good_threshold, 'kparams':_pykalman4d_params}
+    params = {'threshold':good_threshold, 'kparams':kparams}
 
-    wt = WorkerThreads(2, trainAux)
-    num_trials = 50
+    wt = _searchWorkers(db, unusual_case, trainAux)
+    num_trials = 200
     performance = []
     for t in range(-80,100,20):
-        thresh = _pykalman4d_good_threshold + abs(_pykalman4d_good_threshold)*(t/100.0)
+        thresh = good_threshold + abs(good_threshold)*(t/100.0)
         params['threshold'] = thresh
         wt.addJob(thresh, (params.copy(),num_trials))
     wt.wait()
@@ -402,13 +523,14 @@ def trainPyKalman4D(db, unusual_case, greater, num_observations):
             'false_negatives':performance[0][2]}
 
 
-
 classifiers = {'boxtest':{'train':trainBoxTest, 'test':multiBoxTest, 'train_results':[]},
                'midsummary':{'train':functools.partial(trainSummary, midsummary), 'test':midsummaryTest, 'train_results':[]},
                #'ubersummary':{'train':functools.partial(trainSummary, ubersummary), 'test':ubersummaryTest, 'train_results':[]},
                'quadsummary':{'train':functools.partial(trainSummary, quadsummary), 'test':quadsummaryTest, 'train_results':[]},
                'septasummary':{'train':functools.partial(trainSummary, septasummary), 'test':septasummaryTest, 'train_results':[]},
-               #'pykalman4d':{'train':trainPyKalman4D, 'test':pyKalman4DTest, 'train_results':[]},
+               'sprt':{'train':functools.partial(trainSPRT, 'packet_diff'), 'test':sprtTest, 'train_results':[]},
+               'sprt_client':{'train':functools.partial(trainSPRT, 'client_diff'), 'test':sprtTest, 'train_results':[]},
+               'kalman4d':{'train':trainKalman4D, 'test':kalman4dTest, 'train_results':[]},
                #'tsvalwmean':{'train':trainTsval, 'test':tsvalwmeanTest, 'train_results':[]},
                #'kalman':{'train':trainKalman, 'test':kalmanTest, 'train_results':[]},
                #'_trimean':{'train':None, 'test':trimeanTest, 'train_results':[]},
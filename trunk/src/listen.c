@@ -18,8 +18,23 @@ that the following conditions are met:
 #include <sys/stat.h>
 #include <fcntl.h>
 #include <errno.h>
+#include <unistd.h>
+#include <signal.h>
+#include <time.h>
+#include <sys/mman.h>
 #include <netinet/in.h>
+#include <arpa/inet.h>
 #include <pcap.h>
+#ifdef __linux__
+#include <poll.h>
+#include <net/if.h>
+#include <sys/ioctl.h>
+#include <sys/socket.h>
+#include <linux/if_packet.h>
+#include <linux/if_ether.h>
+#include <linux/filter.h>
+#define HAVE_TPACKET_V3 1
+#endif
 
 #define DEBUG 0
 
@@ -98,6 +113,8 @@ struct in_addr target_ip_raw;
 uint16_t target_port;
 
 FILE* output;
+pcap_t* handle;
+volatile sig_atomic_t stopping = 0;
 
 struct useful_info
 {
@@ -111,7 +128,111 @@ struct useful_info
 
 
 char* output_template = "{\"local_port\":%u,\"sent\":%u,\"payload_len\":%u,\"tcpseq\":%u,\"tcpack\":%u,\"observed\":%lu%06lu000,\"tsval\":%u}\n";
+char* nano_output_template = "{\"local_port\":%u,\"sent\":%u,\"payload_len\":%u,\"tcpseq\":%u,\"tcpack\":%u,\"observed\":%lu%09lu,\"tsval\":%u}\n";
 uint8_t payloads_only = 1;
+uint8_t nano_precision = 0;
+
+
+/* Binary output format (-b).  The file starts with one capture_header,
+ * followed by one capture_record per packet.  All fields are in host byte
+ * order, which the reader (nanownlib.capture) expects to be little-endian.
+ * Bump CAPTURE_VERSION whenever either layout changes.
+ */
+#define CAPTURE_MAGIC "NANOWNPK"
+#define CAPTURE_VERSION 1
+#define CAPTURE_FLAG_NANO 0x1
+#define CAPTURE_FLUSH_NS 100000000ULL /* flush buffered records every 100ms */
+
+struct capture_header
+{
+  char magic[8];
+  uint32_t version;
+  uint32_t header_size;
+  uint32_t record_size;
+  uint32_t flags;
+  uint8_t reserved[8];
+};
+
+struct capture_record
+{
+  uint64_t observed;  /* nanoseconds since the epoch */
+  uint32_t tcpseq;
+  uint32_t tcpack;
+  uint32_t tsval;
+  uint16_t local_port;
+  uint16_t payload_len;
+  uint8_t sent;
+  uint8_t reserved[7];
+};
+
+uint8_t binary_output = 0;
+uint64_t last_flush = 0;
+
+
+/* Shared-memory ring output (-r).  The consumer (nanownlib.capture.packetRing)
+ * creates and sizes the file, initializing magic, version, sizes and
+ * capacity; we map it and act as the single producer.  write_index and
+ * read_index count records ever written and consumed; a record goes in slot
+ * (index % capacity).  Records that arrive while the ring is full are
+ * counted in dropped instead.  Each index lives on its own cache line.
+ */
+#define RING_MAGIC "NANOWNRB"
+#define RING_VERSION 1
+#define RING_STATE_RUNNING 1
+#define RING_STATE_STOPPED 2
+
+struct ring_header
+{
+  char magic[8];
+  uint32_t version;
+  uint32_t header_size;
+  uint32_t record_size;
+  uint32_t capacity;
+  uint32_t flags;
+  uint8_t reserved1[36];
+
+  /* written by producer */
+  uint64_t write_index;
+  uint64_t dropped;
+  uint32_t state;
+  uint8_t reserved2[44];
+
+  /* written by consumer */
+  uint64_t read_index;
+  uint8_t reserved3[56];
+};
+
+struct ring_header* ring = NULL;
+struct capture_record* ring_records = NULL;
+size_t ring_size = 0;
+uint64_t ring_high_water = 0;
+
+
+/* Capture statistics (-s).  One JSON line is appended to the stats file
+ * every STATS_INTERVAL_NS while capturing and a final one (with "final":1)
+ * on exit.  Counters are cumulative since the capture started; pcap's
+ * received/dropped/ifdropped are 32-bit and may wrap on long runs.
+ */
+#define STATS_INTERVAL_NS 1000000000ULL
+
+FILE* stats_output = NULL;
+uint64_t last_stats = 0;
+uint64_t captured = 0;
+uint64_t latency_sum = 0;
+uint64_t latency_count = 0;
+uint64_t latency_max = 0;
+const char* tstamp_source = "default";
+
+
+/* Capture tuning (-B, -I, -t, -m).  buffer_size is in bytes; 0 keeps the
+ * libpcap default (or TPACKET_DEFAULT_BUFFER for -m).  In immediate mode
+ * packets are delivered as soon as they arrive rather than when the kernel
+ * buffer fills or timeout_ms expires, trading CPU for capture latency.
+ */
+int buffer_size = 0;
+uint8_t immediate_mode = 0;
+int timeout_ms = 1000;
+uint8_t mmap_capture = 0;
 
 
 pcap_t* create_listener(const char* dev, int snaplen, int promisc, int to_ms, char* errbuf)
@@ -137,6 +258,20 @@ pcap_t* create_listener(const char* dev, int snaplen, int promisc, int to_ms, ch
   if (status < 0)
     goto fail;
 
+  if(buffer_size > 0)
+  {
+    status = pcap_set_buffer_size(ret_val, buffer_size);
+    if (status < 0)
+      goto fail;
+  }
+
+  if(immediate_mode)
+  {
+    status = pcap_set_immediate_mode(ret_val, 1);
+    if (status < 0)
+      goto fail;
+  }
+
 
   /* Try to select the best timestamp source for packet capture */
   tstcount = pcap_list_tstamp_types(ret_val, &tstypes);
@@ -193,6 +328,8 @@ pcap_t* create_listener(const char* dev, int snaplen, int promisc, int to_ms, ch
 #endif
       if(pcap_set_tstamp_type(ret_val, besttst) != 0)
         fprintf(stderr, "WARN: Failed to set preferred timestamp source.\n");
+      else
+        tstamp_source = pcap_tstamp_type_val_to_name(besttst);
     }
   }
   
@@ -200,7 +337,10 @@ pcap_t* create_listener(const char* dev, int snaplen, int promisc, int to_ms, ch
   if(pcap_set_tstamp_precision(ret_val, PCAP_TSTAMP_PRECISION_NANO) != 0)
     fprintf(stderr, "INFO: Failed to set packet capture nanosecond precision.\n");
   else
-    output_template = "{\"local_port\":%u,\"sent\":%u,\"payload_len\":%u,\"tcpseq\":%u,\"tcpack\":%u,\"observed\":%lu%09lu,\"tsval\":%u}\n";
+  {
+    nano_precision = 1;
+    output_template = nano_output_template;
+  }
 
 
   status = pcap_activate(ret_val);
@@ -288,53 +428,520 @@ static int extract_packet_fields(const struct pcap_pkthdr *header,
 }
 
 
+static uint64_t monotonic_ns()
+{
+  struct timespec now;
+  clock_gettime(CLOCK_MONOTONIC, &now);
+  return (uint64_t)now.tv_sec*1000000000ULL + now.tv_nsec;
+}
+
+
+static int write_capture_header(FILE* out)
+{
+  struct capture_header h;
+
+  memset(&h, 0, sizeof(h));
+  memcpy(h.magic, CAPTURE_MAGIC, sizeof(h.magic));
+  h.version = CAPTURE_VERSION;
+  h.header_size = sizeof(struct capture_header);
+  h.record_size = sizeof(struct capture_record);
+  h.flags = nano_precision ? CAPTURE_FLAG_NANO : 0;
+
+  if(fwrite(&h, sizeof(h), 1, out) != 1)
+    return 0;
+  return (fflush(out) == 0);
+}
+
+
+/* Binary records are buffered by stdio; make them visible to readers
+ * tailing the file at least every CAPTURE_FLUSH_NS.
+ */
+static void flush_output()
+{
+  uint64_t now;
+
+  now = monotonic_ns();
+  if(now - last_flush >= CAPTURE_FLUSH_NS)
+  {
+    fflush(output);
+    last_flush = now;
+  }
+}
+
+
+static uint64_t realtime_ns()
+{
+  struct timespec now;
+  clock_gettime(CLOCK_REALTIME, &now);
+  return (uint64_t)now.tv_sec*1000000000ULL + now.tv_nsec;
+}
+
+
+#ifdef HAVE_TPACKET_V3
+/* Packet-mmap capture (-m).  Instead of going through libpcap, we read
+ * packets straight out of a TPACKET_V3 receive ring shared with the kernel.
+ * The ring is divided into blocks which the kernel hands over once they
+ * fill up or timeout_ms passes (1ms in immediate mode), each holding a
+ * variable number of packets with nanosecond timestamps.  libpcap is only
+ * used to compile the filter, which is attached to the socket.
+ */
+#define TPACKET_BLOCK_SIZE (1<<20)
+#define TPACKET_FRAME_SIZE 2048
+#define TPACKET_DEFAULT_BUFFER (32<<20)
+
+struct tpacket_listener
+{
+  int fd;
+  uint8_t* map;
+  size_t map_size;
+  unsigned int block_nr;
+  unsigned int cur_block;
+  uint8_t loopback;
+  uint64_t received;
+  uint64_t dropped;
+};
+
+struct tpacket_listener tpacket;
+
+
+static int open_tpacket(const char* dev, struct bpf_program* filter, char* errbuf)
+{
+  int version = TPACKET_V3;
+  struct tpacket_req3 req;
+  struct sock_fprog fprog;
+  struct sockaddr_ll sll;
+  struct ifreq ifr;
+  int size;
+
+  memset(&tpacket, 0, sizeof(tpacket));
+  tpacket.fd = socket(AF_PACKET, SOCK_RAW, htons(ETH_P_ALL));
+  if(tpacket.fd < 0)
+    goto fail;
+
+  /* Filter before binding, so nothing unfiltered gets queued */
+  if(filter->bf_len > 0)
+  {
+    fprog.len = filter->bf_len;
+    fprog.filter = (struct sock_filter*)filter->bf_insns;
+    if(setsockopt(tpacket.fd, SOL_SOCKET, SO_ATTACH_FILTER, &fprog, sizeof(fprog)) != 0)
+      goto fail;
+  }
+
+  if(setsockopt(tpacket.fd, SOL_PACKET, PACKET_VERSION, &version, sizeof(version)) != 0)
+    goto fail;
+
+  size = (buffer_size > 0) ? buffer_size : TPACKET_DEFAULT_BUFFER;
+  memset(&req, 0, sizeof(req));
+  req.tp_block_size = TPACKET_BLOCK_SIZE;
+  req.tp_block_nr = (size + TPACKET_BLOCK_SIZE - 1)/TPACKET_BLOCK_SIZE;
+  if(req.tp_block_nr < 2)
+    req.tp_block_nr = 2;
+  req.tp_frame_size = TPACKET_FRAME_SIZE;
+  req.tp_frame_nr = req.tp_block_nr*(TPACKET_BLOCK_SIZE/TPACKET_FRAME_SIZE);
+  req.tp_retire_blk_tov = immediate_mode ? 1 : timeout_ms;
+  if(setsockopt(tpacket.fd, SOL_PACKET, PACKET_RX_RING, &req, sizeof(req)) != 0)
+    goto fail;
+
+  tpacket.block_nr = req.tp_block_nr;
+  tpacket.map_size = (size_t)req.tp_block_nr*req.tp_block_size;
+  tpacket.map = mmap(NULL, tpacket.map_size, PROT_READ|PROT_WRITE,
+                     MAP_SHARED|MAP_LOCKED, tpacket.fd, 0);
+  if(tpacket.map == MAP_FAILED)
+    tpacket.map = mmap(NULL, tpacket.map_size, PROT_READ|PROT_WRITE, MAP_SHARED, tpacket.fd, 0);
+  if(tpacket.map == MAP_FAILED)
+  {
+    tpacket.map = NULL;
+    goto fail;
+  }
+
+  /* As libpcap does, ignore the outgoing copy of packets on loopback */
+  memset(&ifr, 0, sizeof(ifr));
+  strncpy(ifr.ifr_name, dev, sizeof(ifr.ifr_name)-1);
+  if(ioctl(tpacket.fd, SIOCGIFFLAGS, &ifr) == 0)
+    tpacket.loopback = (ifr.ifr_flags & IFF_LOOPBACK) != 0;
+
+  memset(&sll, 0, sizeof(sll));
+  sll.sll_family = AF_PACKET;
+  sll.sll_protocol = htons(ETH_P_ALL);
+  sll.sll_ifindex = if_nametoindex(dev);
+  if(sll.sll_ifindex == 0 || bind(tpacket.fd, (struct sockaddr*)&sll, sizeof(sll)) != 0)
+    goto fail;
+
+  /* Kernel timestamps on this path are always nanosecond software stamps */
+  nano_precision = 1;
+  output_template = nano_output_template;
+  tstamp_source = "kernel";
+  return 1;
+
+ fail:
+  snprintf(errbuf, PCAP_ERRBUF_SIZE, "TPACKET_V3 setup failed: %s", strerror(errno));
+  if(tpacket.map)
+    munmap(tpacket.map, tpacket.map_size);
+  if(tpacket.fd >= 0)
+    close(tpacket.fd);
+  tpacket.fd = -1;
+  return 0;
+}
+
+
+static void close_tpacket()
+{
+  munmap(tpacket.map, tpacket.map_size);
+  close(tpacket.fd);
+}
+
+
+/* The kernel resets its counters each time they are read */
+static void tpacket_stats()
+{
+  struct tpacket_stats_v3 st;
+  socklen_t len = sizeof(st);
+
+  memset(&st, 0, sizeof(st));
+  if(getsockopt(tpacket.fd, SOL_PACKET, PACKET_STATISTICS, &st, &len) != 0)
+  {
+    fprintf(stderr, "WARN: could not read capture statistics: %s\n", strerror(errno));
+    return;
+  }
+  tpacket.received += st.tp_packets;
+  tpacket.dropped += st.tp_drops;
+}
+#endif
+
+
+static void write_stats(int final)
+{
+  struct pcap_stat ps;
+  uint64_t now;
+  uint64_t received, dropped, ifdropped;
+  uint64_t ring_used = 0, ring_dropped = 0;
+  uint32_t ring_capacity = 0;
+
+  if(stats_output == NULL)
+    return;
+  now = monotonic_ns();
+  if(!final && now - last_stats < STATS_INTERVAL_NS)
+    return;
+  last_stats = now;
+
+  if(mmap_capture)
+  {
+#ifdef HAVE_TPACKET_V3
+    tpacket_stats();
+    received = tpacket.received;
+    dropped = tpacket.dropped;
+    ifdropped = 0;
+#endif
+  }
+  else
+  {
+    memset(&ps, 0, sizeof(ps));
+    if(pcap_stats(handle, &ps) != 0)
+      fprintf(stderr, "WARN: could not read capture statistics: %s\n", pcap_geterr(handle));
+    received = ps.ps_recv;
+    dropped = ps.ps_drop;
+    ifdropped = ps.ps_ifdrop;
+  }
+
+  if(ring)
+  {
+    ring_used = ring->write_index - __atomic_load_n(&ring->read_index, __ATOMIC_ACQUIRE);
+    ring_dropped = ring->dropped;
+    ring_capacity = ring->capacity;
+  }
+
+  fprintf(stats_output, "{\"time_of_day\":%"PRIu64",\"final\":%d,\"capture_method\":\"%s\","
+          "\"buffer_size\":%d,\"immediate\":%u,\"timeout\":%d,\"tstamp_source\":\"%s\",\"nano_precision\":%u,"
+          "\"received\":%"PRIu64",\"dropped\":%"PRIu64",\"ifdropped\":%"PRIu64",\"captured\":%"PRIu64","
+          "\"latency_mean\":%"PRIu64",\"latency_max\":%"PRIu64","
+          "\"ring_capacity\":%u,\"ring_used\":%"PRIu64",\"ring_high_water\":%"PRIu64",\"ring_dropped\":%"PRIu64"}\n",
+          realtime_ns(), final, mmap_capture ? "tpacket_v3" : "pcap",
+          buffer_size, immediate_mode, timeout_ms, tstamp_source, nano_precision,
+          received, dropped, ifdropped, captured,
+          latency_count ? latency_sum/latency_count : 0, latency_max,
+          ring_capacity, ring_used, ring_high_water, ring_dropped);
+  fflush(stats_output);
+
+  /* latency is reported per interval */
+  latency_sum = latency_count = latency_max = 0;
+}
+
+
+static int open_ring(const char* path)
+{
+  int fd;
+  struct stat st;
+
+  fd = open(path, O_RDWR);
+  if(fd < 0)
+    return 0;
+  if(fstat(fd, &st) != 0 || st.st_size < sizeof(struct ring_header))
+  {
+    close(fd);
+    errno = EINVAL;
+    return 0;
+  }
+
+  ring_size = st.st_size;
+  ring = mmap(NULL, ring_size, PROT_READ|PROT_WRITE, MAP_SHARED, fd, 0);
+  close(fd);
+  if(ring == MAP_FAILED)
+  {
+    ring = NULL;
+    return 0;
+  }
+
+  if(memcmp(ring->magic, RING_MAGIC, sizeof(ring->magic)) != 0
+     || ring->version != RING_VERSION
+     || ring->header_size != sizeof(struct ring_header)
+     || ring->record_size != sizeof(struct capture_record)
+     || ring->capacity == 0
+     || ring_size < ring->header_size + (size_t)ring->capacity*ring->record_size)
+  {
+    munmap(ring, ring_size);
+    ring = NULL;
+    errno = EINVAL;
+    return 0;
+  }
+
+  ring_records = (struct capture_record*)((char*)ring + ring->header_size);
+  if(nano_precision)
+    ring->flags |= CAPTURE_FLAG_NANO;
+  __atomic_store_n(&ring->state, RING_STATE_RUNNING, __ATOMIC_RELEASE);
+  return 1;
+}
+
+
+static void close_ring()
+{
+  if(ring != NULL)
+  {
+    __atomic_store_n(&ring->state, RING_STATE_STOPPED, __ATOMIC_RELEASE);
+    munmap(ring, ring_size);
+    ring = NULL;
+  }
+}
+
+
+static void ring_push(const struct capture_record* record)
+{
+  uint64_t w, r;
+
+  w = ring->write_index;
+  r = __atomic_load_n(&ring->read_index, __ATOMIC_ACQUIRE);
+  if(w - r >= ring->capacity)
+  {
+    __atomic_store_n(&ring->dropped, ring->dropped+1, __ATOMIC_RELAXED);
+    return;
+  }
+
+  ring_records[w % ring->capacity] = *record;
+  __atomic_store_n(&ring->write_index, w+1, __ATOMIC_RELEASE);
+  if(w+1 - r > ring_high_water)
+    ring_high_water = w+1 - r;
+}
+
+
 void process_packet(u_char *args, const struct pcap_pkthdr *header, const u_char *packet)
 {
   struct useful_info fields;
+  struct capture_record record;
+  uint64_t observed, now;
 
   if(extract_packet_fields(header, packet, &fields))
   {
-    fprintf(output, output_template, fields.local_port, fields.sent,
-            fields.payload_len, fields.tcpseq, fields.tcpack,
-            header->ts.tv_sec, header->ts.tv_usec, fields.tsval);
-    fflush(output);
+    observed = (uint64_t)header->ts.tv_sec*1000000000ULL
+      + (nano_precision ? header->ts.tv_usec : header->ts.tv_usec*1000ULL);
+
+    /* Capture latency: how long after its timestamp a packet reached us */
+    now = realtime_ns();
+    if(now > observed)
+    {
+      latency_sum += now - observed;
+      latency_count++;
+      if(now - observed > latency_max)
+        latency_max = now - observed;
+    }
+
+    captured++;
+    if(binary_output || ring)
+    {
+      memset(&record, 0, sizeof(record));
+      record.observed = observed;
+      record.tcpseq = fields.tcpseq;
+      record.tcpack = fields.tcpack;
+      record.tsval = fields.tsval;
+      record.local_port = fields.local_port;
+      record.payload_len = fields.payload_len;
+      record.sent = fields.sent;
+      if(ring)
+        ring_push(&record);
+      else
+        fwrite(&record, sizeof(record), 1, output);
+    }
+    else
+    {
+      fprintf(output, output_template, fields.local_port, fields.sent,
+              fields.payload_len, fields.tcpseq, fields.tcpack,
+              header->ts.tv_sec, header->ts.tv_usec, fields.tsval);
+      fflush(output);
+    }
   }
 }
 
 
+#ifdef HAVE_TPACKET_V3
+/* Processes the packets in the next block the kernel has handed over,
+ * waiting up to timeout_ms for one.  Returns the number of packets or -1 on
+ * error, mirroring pcap_dispatch.
+ */
+static int tpacket_dispatch()
+{
+  struct tpacket_block_desc* block;
+  struct tpacket3_hdr* pkt;
+  struct sockaddr_ll* sll;
+  struct pcap_pkthdr header;
+  struct pollfd pfd;
+  uint32_t i, count = 0;
+
+  block = (struct tpacket_block_desc*)(tpacket.map + (size_t)tpacket.cur_block*TPACKET_BLOCK_SIZE);
+  if(!(__atomic_load_n(&block->hdr.bh1.block_status, __ATOMIC_ACQUIRE) & TP_STATUS_USER))
+  {
+    pfd.fd = tpacket.fd;
+    pfd.events = POLLIN|POLLERR;
+    pfd.revents = 0;
+    if(poll(&pfd, 1, timeout_ms) < 0 && errno != EINTR)
+      return -1;
+    return 0;
+  }
+
+  pkt = (struct tpacket3_hdr*)((uint8_t*)block + block->hdr.bh1.offset_to_first_pkt);
+  for(i=0; i < block->hdr.bh1.num_pkts; i++)
+  {
+    sll = (struct sockaddr_ll*)((uint8_t*)pkt + TPACKET_ALIGN(sizeof(struct tpacket3_hdr)));
+    if(!(tpacket.loopback && sll->sll_pkttype == PACKET_OUTGOING))
+    {
+      /* nano_precision is always set on this path, so tv_usec holds ns */
+      header.ts.tv_sec = pkt->tp_sec;
+      header.ts.tv_usec = pkt->tp_nsec;
+      header.caplen = pkt->tp_snaplen;
+      header.len = pkt->tp_len;
+      process_packet(NULL, &header, (uint8_t*)pkt + pkt->tp_mac);
+      count++;
+    }
+    pkt = (struct tpacket3_hdr*)((uint8_t*)pkt + pkt->tp_next_offset);
+  }
+
+  __atomic_store_n(&block->hdr.bh1.block_status, TP_STATUS_KERNEL, __ATOMIC_RELEASE);
+  tpacket.cur_block = (tpacket.cur_block + 1) % tpacket.block_nr;
+  return count;
+}
+#endif
+
+
+static void handle_signal(int sig)
+{
+  stopping = 1;
+  if(handle != NULL)
+    pcap_breakloop(handle);
+}
+
+
+static void usage(const char* prog)
+{
+  fprintf(stderr, "USAGE:\n  %s [-b|-r] [-s {stats_file}] [-B {bytes}] [-I] [-t {ms}] [-m] {interface} {my_ip} {target_ip} {target_port} {output_file} [{payloads_only?}]\n"
+          "  -b  Write fixed-width binary records instead of JSON lines\n"
+          "  -r  Write binary records to the shared-memory ring in output_file,\n"
+          "      which must already have been created by the consumer\n"
+          "  -s {stats_file}  Append capture statistics to stats_file as JSON lines\n"
+          "  -B {bytes}  Kernel capture buffer size\n"
+          "  -I  Immediate mode: deliver packets as soon as they arrive\n"
+          "  -t {ms}  Capture timeout (default: 1000)\n", prog);
+#ifdef HAVE_TPACKET_V3
+  fprintf(stderr, "  -m  Capture from a TPACKET_V3 packet-mmap ring rather than through libpcap\n");
+#endif
+}
+
+
 
 int main(int argc, char** argv)
 {
   char* dev;                      /* The device to sniff on */
   char* my_ip;
   char* target_ip;
-  pcap_t* handle;                 /* Session handle */
   char bpf[255];                  /* The filter expression (length of 168 should be enough)*/
   char errbuf[PCAP_ERRBUF_SIZE];  /* Error string */
   struct bpf_program fp;          /* The compiled filter */
   bpf_u_int32 mask;               /* Our netmask */
   bpf_u_int32 net;                /* Our IP */
-  struct pcap_pkthdr header;      /* The header that pcap gives us */
-  const u_char *packet;           /* The actual packet */
-    
-  if(argc < 6)
+  struct sigaction sa;
+  int opt;
+  int status;
+  char** args;
+  int nargs;
+  uint8_t ring_output = 0;
+  char* stats_file = NULL;
+
+  while((opt = getopt(argc, argv, "brs:B:It:m")) != -1)
   {
-    fprintf(stderr, "USAGE:\n  %s {interface} {my_ip} {target_ip} {target_port} {output_file} [{payloads_only?}]\n", argv[0]);
+    switch(opt)
+    {
+    case 'b':
+      binary_output = 1;
+      break;
+    case 'r':
+      ring_output = 1;
+      break;
+    case 's':
+      stats_file = optarg;
+      break;
+    case 'B':
+      buffer_size = atoi(optarg);
+      break;
+    case 'I':
+      immediate_mode = 1;
+      break;
+    case 't':
+      timeout_ms = atoi(optarg);
+      break;
+#ifdef HAVE_TPACKET_V3
+    case 'm':
+      mmap_capture = 1;
+      break;
+#endif
+    default:
+      usage(argv[0]);
+      return 1;
+    }
+  }
+  args = argv + optind;
+  nargs = argc - optind;
+
+  if(nargs < 5 || (binary_output && ring_output) || buffer_size < 0 || timeout_ms <= 0)
+  {
+    usage(argv[0]);
     return 1;
   }
 
-  dev = argv[1];
-  my_ip = argv[2];
-  target_ip = argv[3];
-  target_port = atoi(argv[4]);
-  if(argc == 7 && argv[6][0] == '0')
+  dev = args[0];
+  my_ip = args[1];
+  target_ip = args[2];
+  target_port = atoi(args[3]);
+  if(nargs == 6 && args[5][0] == '0')
     payloads_only = 0;
   
-  if(!(output = fopen(argv[5], "w+")))
+  if(!ring_output && !(output = fopen(args[4], "w+")))
   {
     fprintf(stderr, "ERROR: could not open output file due to: %s\n", strerror(errno));
     return 2;
   }
+  if(binary_output)
+    setvbuf(output, NULL, _IOFBF, 1<<20);
+  if(stats_file && !(stats_output = fopen(stats_file, "a")))
+  {
+    fprintf(stderr, "ERROR: could not open stats file due to: %s\n", strerror(errno));
+    return 2;
+  }
   
   snprintf(bpf, 255, "(src host %s and dst host %s and tcp and src port %u) or (dst host %s and src host %s and tcp and dst port %u)",
            target_ip, my_ip, target_port, target_ip, my_ip, target_port);
@@ -364,7 +971,10 @@ int main(int argc, char** argv)
   
   /* Open the session in promiscuous mode */
   /* XXX: does to_ms timeout (param 4) matter? */
-  handle = create_listener(dev, BUFSIZ, 0, 1000, errbuf);
+  if(mmap_capture)
+    handle = pcap_open_dead(DLT_EN10MB, BUFSIZ);
+  else
+    handle = create_listener(dev, BUFSIZ, 0, timeout_ms, errbuf);
   if (handle == NULL)
   {
     fprintf(stderr, "Couldn't open device %s: %s\n", dev, errbuf);
@@ -377,18 +987,75 @@ int main(int argc, char** argv)
     fprintf(stderr, "Couldn't parse filter %s: %s\n", bpf, pcap_geterr(handle));
     return 2;
   }
+
+#ifdef HAVE_TPACKET_V3
+  if (mmap_capture && !open_tpacket(dev, &fp, errbuf))
+  {
+    fprintf(stderr, "Couldn't open device %s: %s\n", dev, errbuf);
+    return 2;
+  }
+#endif
   
-  if (pcap_setfilter(handle, &fp) == -1)
+  if (!mmap_capture && pcap_setfilter(handle, &fp) == -1)
   {
     fprintf(stderr, "Couldn't install filter %s: %s\n", bpf, pcap_geterr(handle));
     return 2;
   }
 
-  /* XXX: report errors */
-  pcap_loop(handle, 0, process_packet, NULL);
+  if(binary_output && !write_capture_header(output))
+  {
+    fprintf(stderr, "ERROR: could not write output file header due to: %s\n", strerror(errno));
+    return 2;
+  }
+  if(ring_output && !open_ring(args[4]))
+  {
+    fprintf(stderr, "ERROR: could not open ring buffer due to: %s\n", strerror(errno));
+    return 2;
+  }
+
+  /* Stop cleanly on SIGTERM/SIGINT so buffered records reach the file */
+  memset(&sa, 0, sizeof(sa));
+  sa.sa_handler = handle_signal;
+  sigaction(SIGTERM, &sa, NULL);
+  sigaction(SIGINT, &sa, NULL);
+
+  status = 0;
+  while(!stopping)
+  {
+#ifdef HAVE_TPACKET_V3
+    if(mmap_capture)
+    {
+      status = tpacket_dispatch();
+      if(status == PCAP_ERROR)
+        fprintf(stderr, "ERROR: capture failed: %s\n", strerror(errno));
+    }
+    else
+#endif
+    {
+      status = pcap_dispatch(handle, -1, process_packet, NULL);
+      if(status == PCAP_ERROR)
+        fprintf(stderr, "ERROR: capture failed: %s\n", pcap_geterr(handle));
+    }
+    if(status < 0)
+      break;
+    if(binary_output)
+      flush_output();
+    write_stats(0);
+  }
+  write_stats(1);
   
   /* And close the session */
+#ifdef HAVE_TPACKET_V3
+  if(mmap_capture)
+    close_tpacket();
+#endif
   pcap_close(handle);
+  if(ring_output)
+    close_ring();
+  else
+    fclose(output);
+  if(stats_output)
+    fclose(stats_output);
 
-  return 0;
+  return (status == PCAP_ERROR) ? 2 : 0;
 }
@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+#-*- mode: Python;-*-
+
+# Writes the capture fixtures used by test_capture.py: one short session
+# (two samples of two test cases, one connection per probe) between
+# 10.0.0.1 and 10.0.0.2:80, plus packets readPcap should skip, as
+#
+#   session-us.pcap   microsecond pcap, Ethernet, one 802.1Q-tagged frame
+#   session-ns.pcap   nanosecond pcap, Linux cooked (SLL)
+#   session-sll2.pcap nanosecond pcap, Linux cooked v2 (SLL2), as from
+#                     tcpdump -i any
+#   session.pcapng    little-endian pcapng; an Ethernet interface with
+#                     if_tsresol=9 and an SLL interface with the default
+#                     (microsecond) resolution
+#
+# Run from this directory to regenerate them.
+
+import socket
+import struct
+
+my_ip = '10.0.0.1'
+target_ip = '10.0.0.2'
+target_port = 80
+start = 1700000000*1000000000
+
+# (local_port, time_of_day, rtt) of each probe, in the order of
+# test_capture.probes
+probes = [(40001, start, 5000789),
+          (40002, start+10000000, 1000321),
+          (40003, start+20000000, 5100654),
+          (40004, start+30000000, 1200987)]
+
+
+def session():
+    # (observed, sent, local_port, tcpseq, tcpack, tsval, payload_len)
+    packets = []
+    for i,(port,time_of_day,rtt) in enumerate(probes):
+        iss = 1000000*(i+1)
+        irs = 7000000*(i+1)
+        ts = 500+100*i
+        request = time_of_day+300789
+        packets += [(time_of_day+100123, 1, port, iss, 0, ts, 0),
+                    (time_of_day+200456, 0, port, irs, iss+1, 9000+ts, 0),
+                    (request, 1, port, iss+1, irs+1, ts+1, 100),
+                    (request+rtt, 0, port, irs+1, iss+101, 9005+ts, 200),
+                    (request+rtt+50000, 1, port, iss+101, irs+201, ts+6, 0)]
+    return packets
+
+
+def tcpFrame(sent, port, seq, ack, tsval, payload_len, src_port=None):
+    src,dst = (my_ip,target_ip) if sent else (target_ip,my_ip)
+    sport,dport = (port,target_port) if sent else (target_port,port)
+    if src_port != None:
+        sport = src_port
+    options = b'\x01\x01\x08\x0a' + struct.pack('!II', tsval, 0)
+    tcp = struct.pack('!HHIIBBHHH', sport, dport, seq, ack, (5+len(options)//4) << 4, 0x18, 65535, 0, 0)
+    ip = struct.pack('!BBHHHBBH4s4s', 0x45, 0, 20+len(tcp)+len(options)+payload_len, 0, 0, 64, 6, 0,
+                     socket.inet_aton(src), socket.inet_aton(dst))
+    # Payloads are left out, as with a short snaplen
+    return ip+tcp+options
+
+
+def ethernet(ip, vlan=None):
+    header = b'\x02\x00\x00\x00\x00\x02' + b'\x02\x00\x00\x00\x00\x01'
+    if vlan != None:
+        header += struct.pack('!HH', 0x8100, vlan)
+    return header + b'\x08\x00' + ip
+
+
+def sll(ip):
+    return struct.pack('!HHH8sH', 0, 1, 6, b'\x02\x00\x00\x00\x00\x01', 0x0800) + ip
+
+
+def sll2(ip):
+    return struct.pack('!HHIHBB8s', 0x0800, 0, 2, 1, 0, 6, b'\x02\x00\x00\x00\x00\x01') + ip
+
+
+links = {1:None, 113:sll, 276:sll2}
+
+
+arp = (b'\xff'*6 + b'\x02\x00\x00\x00\x00\x01' + b'\x08\x06'
+       + struct.pack('!HHBBH6s4s6s4s', 1, 0x0800, 6, 4, 1, b'\x02\x00\x00\x00\x00\x01',
+                     socket.inet_aton(my_ip), b'\x00'*6, socket.inet_aton(target_ip)))
+
+
+def frames(link):
+    packets = session()
+    ret_val = []
+    for n,(observed,sent,port,seq,ack,tsval,payload_len) in enumerate(packets):
+        ip = tcpFrame(sent, port, seq, ack, tsval, payload_len)
+        vlan = 5 if n == 8 else None
+        ret_val.append((observed, link(ip) if link != None else ethernet(ip, vlan)))
+    # Traffic readPcap should ignore: another service on the target and
+    # (on Ethernet) ARP
+    other = tcpFrame(0, 40005, 1, 1, 1, 0, src_port=443)
+    ret_val.append((start+5000000, link(other) if link != None else ethernet(other)))
+    if link == None:
+        ret_val.append((start+6000000, arp))
+    return sorted(ret_val, key=lambda f: f[0])
+
+
+def writePcap(path, magic, linktype, scale):
+    with open(path, 'wb') as f:
+        f.write(struct.pack('<IHHiIII', magic, 2, 4, 0, 0, 65535, linktype))
+        for observed,data in frames(links[linktype]):
+            sec,frac = divmod(observed, 1000000000)
+            f.write(struct.pack('<IIII', sec, frac//scale, len(data), len(data)+200))
+            f.write(data)
+
+
+def pcapngBlock(block_type, body):
+    body += b'\x00'*(-len(body) % 4)
+    return struct.pack('<II', block_type, len(body)+12) + body + struct.pack('<I', len(body)+12)
+
+
+def writePcapng(path):
+    shb = struct.pack('<IHHq', 0x1a2b3c4d, 1, 0, -1)
+    # if_tsresol (9) = 9: nanoseconds
+    idb0 = struct.pack('<HHI', 1, 0, 65535) + struct.pack('<HHB3x', 9, 1, 9) + struct.pack('<HH', 0, 0)
+    idb1 = struct.pack('<HHI', 113, 0, 65535) + struct.pack('<HH', 0, 0)
+    blocks = [pcapngBlock(0x0a0d0d0a, shb), pcapngBlock(1, idb0), pcapngBlock(1, idb1)]
+
+    ether = frames(None)
+    cooked = dict(frames(sll))
+    for observed,data in ether:
+        # Packets of the last two probes were seen on the SLL interface
+        if observed >= probes[2][1] and observed in cooked:
+            iface,ts,data = 1,observed//1000,cooked[observed]
+        else:
+            iface,ts = 0,observed
+        blocks.append(pcapngBlock(6, struct.pack('<IIIII', iface, ts >> 32, ts & 0xffffffff,
+                                                 len(data), len(data)) + data))
+    with open(path, 'wb') as f:
+        f.write(b''.join(blocks))
+
+
+if __name__ == "__main__":
+    writePcap('session-us.pcap', 0xa1b2c3d4, 1, 1000)
+    writePcap('session-ns.pcap', 0xa1b23c4d, 113, 1)
+    writePcap('session-sll2.pcap', 0xa1b23c4d, 276, 1)
+    writePcapng('session.pcapng')
@@ -0,0 +1,154 @@
+import os
+
+import pytest
+
+import nanownlib
+import nanownlib.storage
+from nanownlib import capture
+
+
+data_dir = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'data')
+columns = ['observed','local_port','sent','tsval','payload_len','tcpseq','tcpack']
+start = 1700000000*1000000000
+
+# The session in the fixtures (see data/make_captures.py), as readPcap
+# should extract it from the nanosecond capture
+session = [(1700000000000100123, 40001, 1, 500, 0, 1000000, 0),
+           (1700000000000200456, 40001, 0, 9500, 0, 7000000, 1000001),
+           (1700000000000300789, 40001, 1, 501, 100, 1000001, 7000001),
+           (1700000000005301578, 40001, 0, 9505, 200, 7000001, 1000101),
+           (1700000000005351578, 40001, 1, 506, 0, 1000101, 7000201),
+           (1700000000010100123, 40002, 1, 600, 0, 2000000, 0),
+           (1700000000010200456, 40002, 0, 9600, 0, 14000000, 2000001),
+           (1700000000010300789, 40002, 1, 601, 100, 2000001, 14000001),
+           (1700000000011301110, 40002, 0, 9605, 200, 14000001, 2000101),
+           (1700000000011351110, 40002, 1, 606, 0, 2000101, 14000201),
+           (1700000000020100123, 40003, 1, 700, 0, 3000000, 0),
+           (1700000000020200456, 40003, 0, 9700, 0, 21000000, 3000001),
+           (1700000000020300789, 40003, 1, 701, 100, 3000001, 21000001),
+           (1700000000025401443, 40003, 0, 9705, 200, 21000001, 3000101),
+           (1700000000025451443, 40003, 1, 706, 0, 3000101, 21000201),
+           (1700000000030100123, 40004, 1, 800, 0, 4000000, 0),
+           (1700000000030200456, 40004, 0, 9800, 0, 28000000, 4000001),
+           (1700000000030300789, 40004, 1, 801, 100, 4000001, 28000001),
+           (1700000000031501776, 40004, 0, 9805, 200, 28000001, 4000101),
+           (1700000000031551776, 40004, 1, 806, 0, 4000101, 28000201)]
+
+# (sample, test_case, local_port, time_of_day) of each probe
+probes = [(0, 'long', 40001, start),
+          (0, 'short', 40002, start+10000000),
+          (1, 'long', 40003, start+20000000),
+          (1, 'short', 40004, start+30000000)]
+
+
+def microseconds(records):
+    return [(r[0] - r[0] % 1000,)+r[1:] for r in records]
+
+
+# Each fixture's expected records: microsecond timestamps lose their last
+# three digits, and session.pcapng has the last two probes' packets on its
+# microsecond SLL interface.
+fixtures = {'session-us.pcap':microseconds(session),
+            'session-ns.pcap':session,
+            'session-sll2.pcap':session,
+            'session.pcapng':session[:10]+microseconds(session[10:])}
+
+
+def readRecords(name, **kwargs):
+    return [tuple(r) for chunk in capture.readPcap(os.path.join(data_dir, name), '10.0.0.1', '10.0.0.2', 80, **kwargs)
+            for r in chunk[columns].tolist()]
+
+
+@pytest.mark.parametrize('name', sorted(fixtures))
+def testReadPcap(name):
+    assert readRecords(name) == fixtures[name]
+
+
+@pytest.mark.parametrize('name', sorted(fixtures))
+def testReadPcapChunks(name):
+    chunks = list(capture.readPcap(os.path.join(data_dir, name), '10.0.0.1', '10.0.0.2', 80, chunk_size=3))
+    assert [len(c) for c in chunks] == [3]*6+[2]
+    assert readRecords(name, chunk_size=3) == readRecords(name)
+    assert readRecords(name, chunk_size=1) == readRecords(name)
+
+
+def testReadPcapPayloadsOnly():
+    assert readRecords('session-ns.pcap', payloads_only=True) == [r for r in session if r[4] > 0]
+
+
+def testReadPcapUnsupportedLinktype(tmp_path, capsys):
+    # session-ns.pcap relabelled as DLT_PPP (9)
+    with open(os.path.join(data_dir, 'session-ns.pcap'), 'rb') as f:
+        data = bytearray(f.read())
+    data[20:24] = (9).to_bytes(4, 'little')
+    path = str(tmp_path / 'ppp.pcap')
+    with open(path, 'wb') as f:
+        f.write(data)
+
+    assert list(capture.readPcap(path, '10.0.0.1', '10.0.0.2', 80)) == []
+    assert capsys.readouterr().err.count('unsupported link type 9') == 1
+
+
+def makeSession(path):
+    db = nanownlib.storage.db(path)
+    db.addProbes([{'sample':sample, 'test_case':test_case, 'type':'train', 'tc_order':i % 2,
+                   'time_of_day':time_of_day, 'local_port':port, 'reported':time_of_day,
+                   'userspace_rtt':8000000}
+                  for i,(sample,test_case,port,time_of_day) in enumerate(probes)])
+    db.conn.execute("UPDATE meta SET tcpts_mean=1000.0")
+    db.conn.commit()
+    return db
+
+
+def associations(db):
+    cursor = db.conn.cursor()
+    cursor.execute("SELECT local_port,observed FROM packets,probes WHERE packets.probe_id=probes.id ORDER BY observed")
+    return [tuple(row) for row in cursor]
+
+
+def analyses(db):
+    cursor = db.conn.cursor()
+    cursor.execute("SELECT local_port,packet_rtt,tsval_rtt,suspect FROM analysis,probes"
+                   " WHERE analysis.probe_id=probes.id ORDER BY local_port")
+    return [tuple(row) for row in cursor]
+
+
+@pytest.mark.parametrize('name', sorted(fixtures))
+def testAssociatePcap(name, tmp_path):
+    db = makeSession(str(tmp_path / 'session.db'))
+    path = os.path.join(data_dir, name)
+    assert nanownlib.associatePcap(path, db, '10.0.0.1', '10.0.0.2', 80, chunk_size=4) == len(session)
+    records = fixtures[name]
+    assert associations(db) == [(r[1],r[0]) for r in records]
+
+    assert nanownlib.analyzeProbes(db, recompute=True) == len(probes)
+    # Each probe's RTT runs from its request to its response; the TCP
+    # timestamps of the SYN-ACK and response are 5 ticks of 1000ns apart.
+    expected = []
+    for port in (40001,40002,40003,40004):
+        request,response = [r[0] for r in records if r[1] == port and r[4] > 0]
+        expected.append((port, response-request, 5000, ''))
+    assert analyses(db) == expected
+    if name == 'session-ns.pcap':
+        assert [a[1] for a in expected] == [5000789, 1000321, 5100654, 1200987]
+    assert nanownlib.findUnusualTestCase(db)[0] == 'long'
+
+
+def testAssociatePcapTwice(tmp_path):
+    db = makeSession(str(tmp_path / 'session.db'))
+    path = os.path.join(data_dir, 'session-ns.pcap')
+    nanownlib.associatePcap(path, db, '10.0.0.1', '10.0.0.2', 80)
+    with pytest.raises(nanownlib.PacketsExistError):
+        nanownlib.associatePcap(path, db, '10.0.0.1', '10.0.0.2', 80)
+    assert len(associations(db)) == len(session)
+
+    # An invalid file is refused before the existing packets are deleted
+    bogus = str(tmp_path / 'bogus.pcap')
+    with open(bogus, 'wb') as f:
+        f.write(b'not a capture')
+    with pytest.raises(ValueError):
+        nanownlib.associatePcap(bogus, db, '10.0.0.1', '10.0.0.2', 80, replace=True)
+    assert len(associations(db)) == len(session)
+
+    assert nanownlib.associatePcap(path, db, '10.0.0.1', '10.0.0.2', 80, replace=True) == len(session)
+    assert associations(db) == [(r[1],r[0]) for r in session]
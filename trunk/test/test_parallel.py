@@ -0,0 +1,44 @@
+import os
+import signal
+
+from nanownlib.parallel import WorkerProcesses
+
+
+def square(x):
+    # Job 3 takes its worker down without raising, as an OOM kill would
+    if x == 3:
+        os._exit(1)
+    if x == 5:
+        raise ValueError(x)
+    return x*x
+
+
+def results(wp):
+    ret_val = []
+    while not wp.resultq.empty():
+        ret_val.append(wp.resultq.get())
+    return sorted(ret_val)
+
+
+def testWorkerProcessesSurviveWorkerExit():
+    wp = WorkerProcesses(2, square)
+    for i in range(10):
+        wp.addJob(i, (i,))
+    wp.wait()
+    ret_val = results(wp)
+    wp.stop()
+
+    assert ret_val == [(i, i*i) for i in range(10) if i not in (3, 5)]
+
+
+def testWorkerProcessesSurviveIdleWorkerKill():
+    wp = WorkerProcesses(2, square)
+    os.kill(wp.workers[0].pid, signal.SIGKILL)
+    wp.workers[0].join()
+    for i in (0, 1, 2, 4, 6, 7):
+        wp.addJob(i, (i,))
+    wp.wait()
+    ret_val = results(wp)
+    wp.stop()
+
+    assert ret_val == [(i, i*i) for i in (0, 1, 2, 4, 6, 7)]
@@ -0,0 +1,75 @@
+import random
+
+import numpy
+import pytest
+
+from nanownlib.stats import *
+
+
+quantiles = (0, 2.5, 10, 25, 33.3, 50, 66.6, 75, 90, 97.5, 100)
+
+
+def checkWindow(w, window):
+    # numpy.percentile propagates a NaN anywhere in the window, as does
+    # windowedQuantiles; assert_equal treats NaNs as equal.
+    numpy.testing.assert_equal(w.sorted(), numpy.sort(window))
+    numpy.testing.assert_equal(percentile(w, quantiles), numpy.percentile(window, quantiles))
+    numpy.testing.assert_equal(percentile(w, 37.5), numpy.percentile(window, 37.5))
+    numpy.testing.assert_equal(median(w), numpy.median(window))
+    for summary in (midsummary, trimean, quadsummary, septasummary):
+        for distance in (5, 25):
+            numpy.testing.assert_equal(summary(w, distance), summary(window, distance))
+
+
+def randomValue(rng):
+    # Mostly a handful of repeated values, so blocks fill with duplicates
+    r = rng.random()
+    if r < 0.02:
+        return float('nan')
+    if r < 0.7:
+        return float(rng.randint(-3, 3))
+    return rng.gauss(0, 100)
+
+
+@pytest.mark.parametrize('size', [None, 1, 2, 9, 40])
+def testWindowedQuantilesMatchNumpy(size):
+    rng = random.Random(size)
+    w = windowedQuantiles(size)
+    # Blocks split beyond 2*load values, so a small load exercises splits
+    # and emptied blocks within a few dozen values.
+    w.load = 2
+    window = []
+    for i in range(1500):
+        v = randomValue(rng)
+        w.insert(v)
+        window.append(v)
+        if size != None:
+            window = window[-size:]
+        # Drain well below the window size now and then, emptying blocks
+        if len(window) > 1 and rng.random() < (0.5 if size == None else 0.05):
+            for j in range(rng.randint(1, len(window)-1)):
+                assert numpy.array_equal(w.removeOldest(), window.pop(0), equal_nan=True)
+        assert len(w) == len(window)
+        checkWindow(w, window)
+
+
+def testWindowedQuantilesInitialValues(monkeypatch):
+    monkeypatch.setattr(windowedQuantiles, 'load', 1)
+    values = [3.0, 1.0, 1.0, float('nan'), 2.0, 1.0, 5.0]
+    w = windowedQuantiles(4, values)
+    checkWindow(w, values[-4:])
+    w.insert(1.0)
+    checkWindow(w, values[-3:]+[1.0])
+    # The NaN has left the window
+    w.insert(4.0)
+    checkWindow(w, values[-2:]+[1.0, 4.0])
+
+
+def testWindowedQuantilesEmpty():
+    w = windowedQuantiles(3)
+    assert numpy.isnan(percentile(w, 50))
+    assert numpy.isnan(median(w))
+    assert len(w.sorted()) == 0
+    w.insert(7.0)
+    w.removeOldest()
+    assert numpy.isnan(percentile(w, 50))